@@ -23,6 +23,28 @@ class Defaults:
     DOC_PROB = 0.0
     DOC_PROB_PARALLEL = 0.0
     SHUFFLE = True
+    TRANSPORT = "pipe"
+    SHM_SIZE = 64 * 1024 * 1024
+    WRITE_QUEUE_SIZE = 4
+    WRITE_BUFFER_SIZE = 1024 * 1024
+    WORKER_TIMEOUT = 0
+    BATCH_BYTES = 1024 * 1024
+    BATCH_LATENCY = 0.25
+    METRICS_INTERVAL = 10.0
+    MAX_RESTARTS = 10
+    SHARD_CODEC = "gz"
+    # processes for splitting data files in Python (0: use the pigz/sed/split shell pipeline)
+    SPLIT_PROCESSES = 0
+    SPLIT_CACHE_KEY = "fingerprint"
+    # bytes to keep the split cache within (0: unlimited)
+    SPLIT_CACHE_SIZE = 0
+    PREFETCH_CHUNKS = 0
+    BUFFER_BYTES = 0
+    PACKED_BUFFER = False
+    # lines per batch, for pipelines that pass batches between their stages
+    STAGE_BATCH_SIZE = 1024
+    # the extensions of the (compressed) shards that are read from data directories
+    SHARD_EXTENSIONS = (".gz", ".zst", ".lz4", ".sidx")
 
 
 from .filters import *
@@ -1,32 +1,101 @@
 import os
-import gzip
+import codecs
 import string
 import random
 import logging
-from typing import Iterator, Iterable, Callable
+from array import array
+from collections import deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Iterable, Callable, Dict, List, Optional, Tuple, Union
 from subprocess import Popen, PIPE
 
 import titlecase
-from infinibatch.datasets import chunked_dataset_iterator
-
-from sotastream.data import Line
+from infinibatch.datasets import bump_seed, chunked_dataset_iterator
+from infinibatch.iterators import (
+    BlockwiseShuffleIterator,
+    CheckpointableIterator,
+    MapIterator,
+    SelectManyIterator,
+    create_source_iterator,
+)
+
+from sotastream.data import Columns, Line, PackedLines
 from sotastream import Defaults
-
+from sotastream.utils import metrics
+from sotastream.utils.compression import open_compressed
+from sotastream.utils.indexed import IndexedShard, IndexedShardIterator, is_indexed
+from sotastream.utils.manifest import is_complete as manifest_is_complete, read_manifest
+from sotastream.utils.profiling import stage
+from sotastream.utils.sharding import GrowingShardIterator, ShardPartPath, assign_shards, global_partition
 
 logger = logging.getLogger(f"sotastream")
 
 
-def UTF8File(path: str) -> Iterator[str]:
+# How much compressed data UTF8File reads (and decompresses and decodes) at a time
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# The line boundaries recognized by str.splitlines()
+LINE_BREAKS = "\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+@stage(inputs=None)
+def UTF8File(path: str, block_size: int = READ_BLOCK_SIZE) -> Iterator[str]:
     """
     Opens a file and returns a stream of Line objects.
-    """
-    with open(path, "rb") as f:
-        data = f.read()
-        if path.endswith('.gz'):
-            data = gzip.decompress(data)
 
-    for line in data.decode(encoding='utf-8').splitlines():
-        yield Line(line)
+    The file is decompressed according to its extension (see sotastream.utils.compression),
+    and decompressed and decoded incrementally, block by block, so memory use is
+    proportional to the block size rather than the file size. The lines are the same as
+    those of str.splitlines() over the whole decoded file. Indexed shards (.sidx, see
+    sotastream.utils.indexed) are read line by line, in order.
+
+    Given the path of a part of a shard (see sotastream.utils.sharding.ShardPartPath), as chunk
+    processors are by DataSource, only the lines of the part are returned.
+    """
+    lines = _read_lines(path, block_size)
+    if isinstance(path, ShardPartPath):
+        path.selected = True
+        return path.part.select(lines)
+    return lines
+
+
+def _read_lines(path: str, block_size: int) -> Iterator[Line]:
+    if is_indexed(path):
+        shard = IndexedShard(path)
+        try:
+            for line in shard:
+                yield Line(line)
+        finally:
+            shard.close()
+        return
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    # the part of the last line seen so far
+    partial = ""
+    # whether the previous block ended in \r, so that a \n starting this block belongs to it
+    after_cr = False
+    with open_compressed(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            final = not block
+            text = decoder.decode(block, final=final)
+            if after_cr and text:
+                after_cr = False
+                if text[0] == "\n":
+                    text = text[1:]
+            text = partial + text
+            if text:
+                lines = text.splitlines()
+                if final or text[-1] in LINE_BREAKS:
+                    partial = ""
+                    after_cr = text[-1] == "\r"
+                else:
+                    partial = lines.pop()
+                for line in lines:
+                    yield Line(line)
+            if final:
+                break
 
 
 def enumerate_files(dir: str, ext: str):
@@ -37,73 +106,408 @@ def enumerate_files(dir: str, ext: str):
     ]
 
 
+class ChunkPrefetchIterator(CheckpointableIterator):
+    """
+    Reads chunks ahead of demand. Takes an iterator over chunk references, and returns an iterator
+    over the chunks' contents (as lists), in the same order. Up to num_chunks chunks are read
+    (e.g., decompressed and decoded) in a background thread while the pipeline works on the
+    current one. File I/O and decompression release the GIL, so this overlaps with the pipeline.
+    """
+
+    def __init__(self, source_iterator: CheckpointableIterator, read_chunk_fn: Callable, num_chunks: int):
+        """
+        :param source_iterator: The chunk references, e.g., from infinibatch's create_source_iterator()
+        :param read_chunk_fn: Reads a chunk: function(chunk_ref) -> Iterator
+        :param num_chunks: How many chunks to read ahead
+        """
+        self._source_iterator = source_iterator
+        self._read_chunk_fn = read_chunk_fn
+        self._num_chunks = max(1, num_chunks)
+        # a single thread, so that chunks are read one after the other, in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sotastream-prefetch")
+        self._pending = deque()
+        self.setstate(None)
+
+    def _read(self, chunk_ref):
+        return list(self._read_chunk_fn(chunk_ref))
+
+    def _fill(self):
+        while len(self._pending) < self._num_chunks and not self._exhausted:
+            try:
+                chunk_ref = next(self._source_iterator)
+            except StopIteration:
+                self._exhausted = True
+                break
+            # the source state after this chunk is where to resume once it has been delivered
+            self._pending.append(
+                (self._executor.submit(self._read, chunk_ref), self._source_iterator.getstate())
+            )
+
+    def getstate(self) -> Dict:
+        return {"source_state": self._source_state}
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        for future, _ in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._source_state = checkpoint["source_state"] if checkpoint else None
+        self._source_iterator.setstate(self._source_state)
+        self._exhausted = False
+
+    def __next__(self):
+        self._fill()
+        if not self._pending:
+            raise StopIteration
+        future, self._source_state = self._pending.popleft()
+        # start on the next chunk right away
+        self._fill()
+        return future.result()
+
+    def close(self):
+        for future, _ in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+        self._source_iterator.close()
+
+
+class ChunkLimitIterator(CheckpointableIterator):
+    """
+    Passes chunk references on until a condition holds (e.g., that enough lines have been read from
+    them), and then ends.
+    """
+
+    def __init__(self, source_iterator: CheckpointableIterator, done: Callable[[], bool]):
+        """
+        :param source_iterator: The chunk references
+        :param done: Whether to end, checked before each chunk reference
+        """
+        self._source_iterator = source_iterator
+        self._done = done
+
+    def getstate(self) -> Dict:
+        return self._source_iterator.getstate()
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        self._source_iterator.setstate(checkpoint)
+
+    def __next__(self):
+        if self._done():
+            raise StopIteration
+        return next(self._source_iterator)
+
+    def close(self):
+        self._source_iterator.close()
+
+
+class PackedShuffleIterator(CheckpointableIterator):
+    """
+    Shuffles lines block by block, like infinibatch's BlockwiseShuffleIterator, and with the same
+    result for the same block size and seed. But each block is kept packed as bytes (PackedLines),
+    its positions are shuffled, and a Line object is only created when it is delivered. A block
+    ends after block_size lines or block_bytes bytes, whichever comes first (0 means no limit).
+    The delivered block is released before the next one is filled.
+    """
+
+    def __init__(
+        self,
+        source_iterator: CheckpointableIterator,
+        block_size: int = 0,
+        block_bytes: int = 0,
+        seed: int = 0,
+    ):
+        """
+        :param source_iterator: The lines
+        :param block_size: The maximum number of lines per block (0: no limit)
+        :param block_bytes: The maximum size of a block in bytes (0: no limit)
+        :param seed: The random seed
+        """
+        assert block_size > 0 or block_bytes > 0, "Either block_size or block_bytes has to be positive"
+        self._source_iterator = source_iterator
+        self._block_size = block_size or float("inf")
+        self._block_bytes = block_bytes or float("inf")
+        self._random = random.Random(seed)
+        self._initial_random_state = self._random.getstate()
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        # enough to fill and shuffle the current block again
+        return {
+            "source_state": self._block_source_state,
+            "random_state": self._block_random_state,
+            "num_served": self._position,
+        }
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        self._block_source_state = checkpoint["source_state"] if checkpoint else None
+        self._block_random_state = checkpoint["random_state"] if checkpoint else self._initial_random_state
+        self._source_iterator.setstate(self._block_source_state)
+        self._random.setstate(self._block_random_state)
+        self.block = None
+        self._position = 0
+        if checkpoint and checkpoint["num_served"] > 0:
+            self._fill()
+            self._position = checkpoint["num_served"]
+
+    def _fill(self):
+        self.block = block = PackedLines()
+        for line in self._source_iterator:
+            block.append(line)
+            if len(block) >= self._block_size or block.nbytes >= self._block_bytes:
+                break
+        order = array("Q", range(len(block)))
+        self._random.shuffle(order)
+        block.order = order
+
+    def __next__(self) -> Line:
+        if self.block is None or self._position >= len(self.block):
+            self.block = None
+            self._block_source_state = self._source_iterator.getstate()
+            self._block_random_state = self._random.getstate()
+            self._position = 0
+            self._fill()
+            if not len(self.block):
+                raise StopIteration
+        line = self.block[self.block.order[self._position]]
+        self._position += 1
+        return line
+
+    def close(self):
+        self._source_iterator.close()
+
+
+@stage(inputs=None)
 def DataSource(
     path: str,
     processChunk: Callable = UTF8File,
-    ext: str = ".gz",
+    ext: Union[str, Tuple[str, ...]] = Defaults.SHARD_EXTENSIONS,
     buffer_size: int = Defaults.BUFFER_SIZE,
     seed: int = 1234,
     shuffle: bool = True,
     worker_id: int = 0,
     num_workers: int = 1,
+    prefetch: int = 0,
+    buffer_bytes: int = 0,
+    packed: bool = False,
+    max_epochs: float = 0,
 ):
     """
     Creates an infinibatch data source from a directory of files that all
-    have extension {ext}.
+    have extension {ext} (by default, any of the supported compressed formats).
+    If the directory has a manifest (see sotastream.utils.manifest), the shards are
+    taken from it instead of listing the directory, and assigned to workers by line count.
+
+    A directory of indexed shards (.sidx) read with the default processChunk is shuffled
+    shard by shard, by permuting line numbers (see sotastream.utils.indexed.IndexedShardIterator),
+    rather than through a buffer of buffer_size lines.
+
+    A directory that is still being split (see sotastream.utils.split.split_file_into_chunks(stream=True))
+    is read as its shards appear (see sotastream.utils.sharding.GrowingShardIterator).
 
     :param path: directory containing chunks
-    :param processChunk: function to call on each chunk
-    :param ext: the file extension to glob over
+    :param processChunk: function to call on each chunk. To read a part of a shard (with more partitions
+        than shards), it has to read the chunk with UTF8File, which selects the lines of the part.
+    :param ext: the file extension (or a tuple of extensions) to glob over
     :param buffer_size: how many lines infinibatch loads into memory at a time
     :param seed: the random seed
     :param shuffle: whether to shuffle results across shards
     :param worker_id: For multiprocessing, this worker's ID (0-based)
     :param num_workers: For multiprocessing, the number of workers
+    :param prefetch: How many chunks to read ahead in a background thread (0: read chunks on demand)
+    :param buffer_bytes: If positive, the shuffle buffer holds up to this many bytes of lines instead of
+        buffer_size lines. Implies packed.
+    :param packed: Whether to keep the lines in the shuffle buffer packed as bytes (see PackedShuffleIterator),
+        which takes much less memory than Line objects. The lines are shuffled the same way.
+    :param max_epochs: If positive, the source ends after delivering this many passes over this worker's
+        shards (e.g., 2.5), counted in lines as they are read, before the shuffle buffer, so that one epoch
+        delivers each line once. A Mixer stops when any of its sources ends.
     """
 
-    # This is used to ensure that infinibatch iterators (a) differ on each node
-    # and (b) see the same data in the same order, when called multiple times.
-    # However, having multiple workers on a single node breaks this, because they
-    # write to their shared queue in an unpredictable order. To fix this, we'd have
-    # to do round-robin on the queue.
+    # All workers of all instances (MPI ranks) split the shards between them, so infinibatch
+    # itself is run as a single instance.
+    # However, having multiple workers on a single node means they write to their shared queue
+    # in an unpredictable order. To fix this, we'd have to do round-robin on the queue.
+    partition, num_partitions = global_partition(worker_id, num_workers)
     if "OMPI_COMM_WORLD_SIZE" in os.environ:
-        num_instances = int(os.environ["OMPI_COMM_WORLD_SIZE"])
-        instance_rank = int(os.environ["OMPI_COMM_WORLD_RANK"])
+        instance_rank = os.environ["OMPI_COMM_WORLD_RANK"]
+        num_instances = os.environ["OMPI_COMM_WORLD_SIZE"]
         logger.info(f"Opening path {path} on instance {instance_rank} out of {num_instances} instances")
     else:
-        num_instances = 1
-        instance_rank = 0
         logger.info(f"Opening path {path}")
 
-    # Worker ID i will only see every ith chunk
-    chunk_file_paths = []
-    total_chunks = 0
-    subpaths = enumerate_files(path, ext)
-    for pathno, subpath in enumerate(subpaths):
-        total_chunks += 1
-        if len(subpaths) < num_workers or pathno % num_workers == worker_id:
-            chunk_file_paths.append(subpath)
-    chunk_file_paths.sort()  # make sure file order is always the same, independent of OS
-
-    logger.info(f"Worker {worker_id} gets {len(chunk_file_paths)} / {total_chunks} segments in path {path}")
-    ds = chunked_dataset_iterator(
-        chunk_refs=chunk_file_paths,
-        read_chunk_fn=processChunk,
-        shuffle=shuffle,
-        buffer_size=buffer_size,
-        seed=seed,
-        use_windowed=False,
-        num_instances=num_instances,
-        instance_rank=instance_rank,
+    # Each worker gets shards (or, with more workers than shards, parts of shards) of about the same size
+    shards = read_manifest(path)
+    growing = shards is not None and not manifest_is_complete(path)
+    if growing:
+        # shards are assigned as they are split
+        logger.info(f"Path {path} is still being split: {len(shards)} shards so far")
+        subpaths = []
+        num_lines = None
+    elif shards is not None:
+        subpaths = [
+            os.path.join(path, shard.name) for shard in shards if ext is None or shard.name.endswith(ext)
+        ]
+        num_lines = {os.path.join(path, shard.name): shard.lines for shard in shards}
+        logger.info(
+            f"Path {path} has {sum(num_lines[p] for p in subpaths):,} lines in {len(subpaths)} shards"
+        )
+    else:
+        subpaths = enumerate_files(path, ext)
+        num_lines = None
+    chunk_refs = assign_shards(subpaths, partition, num_partitions, num_lines=num_lines)
+
+    if not growing:
+        parts = "".join(
+            f" (part {part.part + 1} of {part.num_parts})" for part in chunk_refs if part.num_parts > 1
+        )
+        logger.info(
+            f"Worker {worker_id} gets {len(chunk_refs)} / {len(subpaths)} segments{parts} in path {path}"
+        )
+
+    # Lines read from the chunks but not delivered yet are sitting in the shuffle buffer
+    chunks_read = metrics.counter("sotastream_source_chunks_read_total", source=path)
+    lines_read = metrics.counter("sotastream_source_lines_read_total", source=path)
+    lines_delivered = metrics.counter("sotastream_source_lines_total", source=path)
+    metrics.gauge(
+        "sotastream_shuffle_buffer_lines",
+        lambda: lines_read.value - lines_delivered.value,
+        source=path,
+    )
+    indexed_shards = (
+        bool(chunk_refs) and all(is_indexed(part.path) for part in chunk_refs) and processChunk is UTF8File
     )
 
-    return ds
+    # The lines this worker reads per pass (summed over workers, those of the whole source): from
+    # the manifest or the indexed shards, or else counted as the first pass is read (unless the
+    # shards are still being split, when it is not known)
+    if growing:
+        epoch_lines = None
+    elif num_lines is not None:
+        epoch_lines = sum(len(part.line_range()) for part in chunk_refs)
+    elif indexed_shards:
+        epoch_lines = 0
+        for part in chunk_refs:
+            shard = IndexedShard(part.path)
+            epoch_lines += len(part.line_range(len(shard)))
+            shard.close()
+    else:
+        epoch_lines = None
+    metrics.gauge("sotastream_source_epoch_lines", lambda: epoch_lines or 0, source=path)
+
+    # the counts of this data source (the metrics are shared by all data sources of the same path)
+    chunks_so_far = lines_so_far = delivered_so_far = 0
+
+    def read_chunk(part):
+        nonlocal epoch_lines, chunks_so_far, lines_so_far
+        if not growing and chunks_so_far == len(chunk_refs):
+            # starting the second pass
+            if lines_so_far == 0:
+                raise ValueError(
+                    f"Worker {worker_id} read no lines from its shards of {path} in a whole pass "
+                    f"(e.g., with more partitions than lines, {num_partitions})"
+                )
+            if epoch_lines is None:
+                epoch_lines = lines_so_far
+        chunks_so_far += 1
+        chunks_read.value += 1
+        limit = line_limit()
+        # the processor reads the lines of the part, as UTF8File does given its path, before processing
+        # them, so that the lines of a shard are divided between partitions whatever the processor does
+        chunk_path = ShardPartPath(part) if part.num_parts > 1 else part.path
+        lines = iter(processChunk(chunk_path))
+        for line in lines:
+            if limit is not None and lines_so_far >= limit:
+                return
+            if chunk_path is not part.path and not chunk_path.selected:
+                raise ValueError(
+                    f"{processChunk} did not read {part.path} with UTF8File, so the shard cannot be divided "
+                    f"between {num_partitions} partitions: use more shards than partitions"
+                )
+            lines_so_far += 1
+            lines_read.value += 1
+            yield line
+
+    def line_limit():
+        """The lines to read (and deliver) before the source ends, if limited and known yet."""
+        return max_epochs * epoch_lines if max_epochs and epoch_lines is not None else None
+
+    def deliver(line):
+        nonlocal delivered_so_far
+        limit = line_limit()
+        if limit is not None and delivered_so_far >= limit:
+            logger.info(f"Worker {worker_id} has delivered {max_epochs} epochs of {path}")
+            raise StopIteration
+        delivered_so_far += 1
+        lines_delivered.value += 1
+        return line
+
+    if indexed_shards:
+        # shuffled by permuting the lines of each shard, without a shuffle buffer
+        def read_line(line):
+            lines_read.value += 1
+            return deliver(Line(line))
+
+        ds = IndexedShardIterator(chunk_refs, seed=seed, shuffle=shuffle)
+        return MapIterator(ds, read_line)
+
+    packed = packed or buffer_bytes > 0
+    if prefetch > 0 or packed or growing or max_epochs:
+        # the same as chunked_dataset_iterator(), with the chunks read ahead, a packed shuffle buffer,
+        # shards that are still being split, or a limited number of epochs
+        if growing:
+            chunks = GrowingShardIterator(
+                path, partition, num_partitions, seed=seed, shuffle=shuffle, ext=ext
+            )
+        else:
+            chunks = create_source_iterator(chunk_refs, seed=seed, shuffle=shuffle)
+        if max_epochs:
+            # the epochs are counted as the lines are read, so that the shuffle buffer holds the lines of
+            # max_epochs passes exactly, and delivers them all before the source ends
+            chunks = ChunkLimitIterator(
+                chunks, lambda: line_limit() is not None and lines_so_far >= line_limit()
+            )
+        if prefetch > 0:
+            ds = SelectManyIterator(ChunkPrefetchIterator(chunks, read_chunk, prefetch))
+        else:
+            ds = SelectManyIterator(chunks, read_chunk)
+        if shuffle and packed:
+            block_size = 0 if buffer_bytes > 0 else buffer_size
+            ds = shuffler = PackedShuffleIterator(ds, block_size, buffer_bytes, bump_seed(seed, 1))
+            metrics.gauge(
+                "sotastream_shuffle_buffer_bytes",
+                lambda: shuffler.block.nbytes if shuffler.block is not None else 0,
+                source=path,
+            )
+        elif shuffle:
+            ds = BlockwiseShuffleIterator(ds, buffer_size, bump_seed(seed, 1))
+    else:
+        ds = chunked_dataset_iterator(
+            chunk_refs=chunk_refs,
+            read_chunk_fn=read_chunk,
+            shuffle=shuffle,
+            buffer_size=buffer_size,
+            seed=seed,
+            use_windowed=False,
+        )
+
+    return MapIterator(ds, deliver)
 
 
+@stage(inputs="streams")
 class Mixer:
-    def __init__(self, iterators, probs):
+    def __init__(self, iterators, probs, name="mixer"):
+        """
+        Draws each item from one of the iterators, chosen at random with the given probabilities.
+
+        :param iterators: The iterators to mix
+        :param probs: Their probabilities
+        :param name: Identifies the mixer in the metrics, where draws are counted per source (iterator index)
+        """
         self.iterators = iterators
         self.probs = probs
+        self.draws = [
+            metrics.counter("sotastream_mixer_draws_total", mixer=name, source=i)
+            for i in range(len(iterators))
+        ]
 
     def __iter__(self):
         return self
@@ -114,22 +518,60 @@ class Mixer:
         for i, prob in enumerate(self.probs):
             prob_sum += prob
             if draw <= prob_sum:
+                self.draws[i].value += 1
                 return next(self.iterators[i])
 
+        self.draws[0].value += 1
         return next(self.iterators[0])  # default
 
 
+@stage
 def Identity(lines):
     for line in lines:
         yield line
 
 
+@stage
 def Append(lines, functor):
     for line in lines:
         line[len(line)] = functor(line)
         yield line
 
 
+def Batched(lines: Iterable, batch_size: int = Defaults.STAGE_BATCH_SIZE) -> Iterator[List]:
+    """
+    Groups a stream of lines into batches (lists) of batch_size lines; the last one may be shorter.
+    Batch stages (such as BatchToUpper) take and produce streams of batches, which saves them
+    resuming a generator for every line.
+    """
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def Unbatched(batches: Iterable[List]) -> Iterator:
+    """Turns a stream of batches back into a stream of lines."""
+    return chain.from_iterable(batches)
+
+
+def PerLine(
+    batches: Iterable[List], function: Callable, *args, batch_size: int = Defaults.STAGE_BATCH_SIZE, **kwargs
+):
+    """
+    Runs a per-line stage on a stream of batches, e.g. PerLine(batches, Multiply, n=3).
+    The stage sees a single stream of lines, so any state it keeps carries over from batch to batch.
+    Its output is batched again into batches of batch_size lines.
+
+    :param batches: The stream of batches
+    :param function: The per-line stage
+    :param args, kwargs: Further arguments of the stage
+    """
+    return Batched(function(Unbatched(batches), *args, **kwargs), batch_size)
+
+
 def canBeUppercased(inputString):
     """Check if the input string can be plausibly uppercased (is the uppercased version different from the non-uppercased one).
     We randomly sample 10 chars (with repetition if needed) which should be good enough. Note, this is rather meant as a quick
@@ -152,6 +594,7 @@ def canBeLowercased(inputString):
     return randChars.lower() != randChars
 
 
+@stage
 def ToUpper(lines, fields=[0, 1], check=None):
     """Uppercases all specified fields. If check is set to a field id it conditions the uppercasing
     of the entire set on the fact if the checked field can be plausibly uppercased. This is used for
@@ -163,6 +606,7 @@ def ToUpper(lines, fields=[0, 1], check=None):
         yield line
 
 
+@stage
 def ToLower(lines, fields=[0, 1], check=None):
     """Lowercases all specified fields. If check is set to a field id it conditions the lowercasing
     of the entire set on the fact if the checked field can be plausibly lowercased."""
@@ -173,6 +617,7 @@ def ToLower(lines, fields=[0, 1], check=None):
         yield line
 
 
+@stage
 def ToTitle(lines, fields=[0, 1], check=None):
     """Titlecases all specified fields. If check is set to a field id it conditions the titlecasing
     of the entire set on the fact if the checked field can be plausibly uppercased."""
@@ -183,6 +628,7 @@ def ToTitle(lines, fields=[0, 1], check=None):
         yield line
 
 
+@stage
 def Tagger(lines, tag="", fields=[0]):
     for line in lines:
         for field in fields:
@@ -190,17 +636,20 @@ def Tagger(lines, tag="", fields=[0]):
         yield line
 
 
+@stage
 def Copy(lines, from_field=1, to_field=0):
     for line in lines:
         line[to_field] = line[from_field]
         yield line
 
 
+@stage
 def CopySource(lines):
     """Copy source field to target."""
     return Copy(lines, 0, 1)
 
 
+@stage
 def Multiply(lines, n=2):
     """Makes n copies of the underlying object."""
     for line in lines:
@@ -209,12 +658,14 @@ def Multiply(lines, n=2):
         yield line
 
 
+@stage
 def JustSourceTarget(lines):
     """Removes all but fields 0 and 1"""
     for line in lines:
-        yield Line(str(line))
+        yield Line(str(line)).project(2)
 
 
+@stage
 def SPMEncoder(lines, spm_model):
     """Runs the SPM encoder on fields 0 and 1"""
     for line in lines:
@@ -222,8 +673,191 @@ def SPMEncoder(lines, spm_model):
         yield line
 
 
+@stage
 def SPMDecoder(lines, spm_model):
     """SPM decodes fields 0 and 1"""
     for line in lines:
         line[0:2] = spm_model.decode(list(map(str.split, line[0:2])))
         yield line
+
+
+def _map_columns(batch: Columns, fields: List[int], function: Callable, mask=None, joinable=False):
+    """
+    Applies a string function to the given fields of a columnar batch, or only to the lines where
+    mask is true. A joinable function (such as str.upper) maps a whole column joined by newlines at once.
+    """
+    for field in fields:
+        column = batch.fields[field]
+        if mask is not None:
+            column = [function(text) if keep else text for text, keep in zip(column, mask)]
+        elif joinable and column:
+            column = function("\n".join(column)).split("\n")
+        else:
+            column = [function(text) for text in column]
+        batch.set_field(field, column)
+
+
+@stage(inputs="batches")
+def BatchToUpper(batches, fields=[0, 1], check=None):
+    """Batch version of ToUpper, for lists of lines or Columns"""
+    for batch in batches:
+        if isinstance(batch, Columns):
+            mask = None if check is None else [canBeUppercased(text) for text in batch.fields[check]]
+            _map_columns(batch, fields, str.upper, mask, joinable=True)
+            yield batch
+            continue
+        for line in batch:
+            if check is None or canBeUppercased(line[check]):
+                for field in fields:
+                    line[field] = line[field].upper()
+        yield batch
+
+
+@stage(inputs="batches")
+def BatchToLower(batches, fields=[0, 1], check=None):
+    """Batch version of ToLower, for lists of lines or Columns"""
+    for batch in batches:
+        if isinstance(batch, Columns):
+            mask = None if check is None else [canBeLowercased(text) for text in batch.fields[check]]
+            _map_columns(batch, fields, str.lower, mask, joinable=True)
+            yield batch
+            continue
+        for line in batch:
+            if check is None or canBeLowercased(line[check]):
+                for field in fields:
+                    line[field] = line[field].lower()
+        yield batch
+
+
+@stage(inputs="batches")
+def BatchToTitle(batches, fields=[0, 1], check=None):
+    """Batch version of ToTitle, for lists of lines or Columns"""
+    for batch in batches:
+        if isinstance(batch, Columns):
+            mask = None if check is None else [canBeUppercased(text) for text in batch.fields[check]]
+            _map_columns(batch, fields, titlecase.titlecase, mask)
+            yield batch
+            continue
+        for line in batch:
+            if check is None or canBeUppercased(line[check]):
+                for field in fields:
+                    line[field] = titlecase.titlecase(line[field])
+        yield batch
+
+
+@stage(inputs="batches")
+def BatchTagger(batches, tag="", fields=[0]):
+    """Batch version of Tagger, for lists of lines or Columns"""
+    for batch in batches:
+        if isinstance(batch, Columns):
+            for field in fields:
+                batch.set_field(field, [tag + text for text in batch.fields[field]])
+            yield batch
+            continue
+        for line in batch:
+            for field in fields:
+                line[field] = tag + line[field]
+        yield batch
+
+
+@stage(inputs="batches")
+def BatchCopy(batches, from_field=1, to_field=0):
+    """Batch version of Copy, for lists of lines or Columns"""
+    for batch in batches:
+        if isinstance(batch, Columns):
+            batch.set_field(to_field, list(batch.fields[from_field]))
+            yield batch
+            continue
+        for line in batch:
+            line[to_field] = line[from_field]
+        yield batch
+
+
+@stage(inputs="batches")
+def BatchJustSourceTarget(batches):
+    """Batch version of JustSourceTarget, for lists of lines or Columns"""
+    for batch in batches:
+        if isinstance(batch, Columns):
+            yield batch.project(2)
+        else:
+            yield [Line(str(line)).project(2) for line in batch]
+
+
+@stage(inputs="batches")
+def ToColumns(batches):
+    """Turns a stream of batches (lists of lines) into a stream of Columns batches."""
+    for batch in batches:
+        yield Columns.from_lines(batch)
+
+
+@stage(inputs="batches")
+def ToRows(batches):
+    """Turns a stream of Columns batches back into a stream of batches of Line objects."""
+    for batch in batches:
+        yield batch.to_lines() if isinstance(batch, Columns) else batch
+
+
+@stage(inputs="batch_streams")
+def BatchMixer(batch_streams, probs, batch_size=Defaults.STAGE_BATCH_SIZE, name="mixer"):
+    """
+    Batch version of Mixer: draws a source for each of the batch_size lines of a batch according
+    to probs, and takes the lines from the batches of the sources in that order. The sources
+    produce either lists of lines or Columns (all of the same kind), and so does the mixer;
+    Columns are mixed column by column. It ends when a source does.
+
+    :param batch_streams: The streams of batches to mix
+    :param probs: The probability of each stream
+    :param batch_size: The number of lines per output batch
+    :param name: The name of the mixer in the metrics
+    """
+    iterators = [iter(stream) for stream in batch_streams]
+    num_sources = len(iterators)
+    draws = [
+        metrics.counter("sotastream_mixer_draws_total", mixer=name, source=str(i)) for i in range(num_sources)
+    ]
+    # the lines of each source not mixed yet: its current batch, and the position in it
+    pending = [None] * num_sources
+    positions = [0] * num_sources
+
+    def take(source, count):
+        parts = []
+        while count > 0:
+            batch = pending[source]
+            if batch is None or positions[source] >= len(batch):
+                pending[source] = batch = next(iterators[source], None)
+                positions[source] = 0
+                if batch is None:
+                    return None
+                continue
+            start = positions[source]
+            stop = min(start + count, len(batch))
+            parts.append(batch.rows(start, stop) if isinstance(batch, Columns) else batch[start:stop])
+            positions[source] = stop
+            count -= stop - start
+        return parts
+
+    sources = range(num_sources)
+    while True:
+        choices = random.choices(sources, weights=probs, k=batch_size)
+        counts = [0] * num_sources
+        for source in choices:
+            counts[source] += 1
+        # all lines of source 0 come first in parts, then those of source 1, and so on
+        parts = []
+        starts = []
+        for source, count in enumerate(counts):
+            source_parts = take(source, count)
+            if source_parts is None:
+                return
+            starts.append(sum(counts[:source]))
+            parts.extend(source_parts)
+            draws[source].value += count
+        index = []
+        for source in choices:
+            index.append(starts[source])
+            starts[source] += 1
+        if isinstance(parts[0], Columns):
+            yield Columns.concat(parts).take(index)
+        else:
+            pool = [line for part in parts for line in part]
+            yield [pool[i] for i in index]
@@ -0,0 +1,313 @@
+"""
+Benchmarks sotastream on synthetic data: `sotastream bench [options] [-- sotastream options]`.
+
+Generates synthetic parallel TSV corpora (pre-split into compressed shards), then runs a pipeline
+over them once for every combination of the swept settings (--num-processes, --buffer-size,
+--queue-buffer-size), each time as a separate `python -m sotastream` process whose output
+is read and discarded. For each run, it reports lines/sec, MB/sec, the time to the first
+line, and the peak memory (RSS) of each worker, as JSON.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import shlex
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Dict, List
+
+from . import Defaults
+from .pipelines import PIPELINES
+from .utils import compression, indexed, metrics
+
+logger = logging.getLogger(f"sotastream")
+
+LENGTH_DISTRIBUTIONS = ["fixed", "uniform", "normal", "lognormal"]
+
+
+class SyntheticCorpus:
+    """
+    Random parallel text: each line has num_fields tab-separated fields of pseudo-words,
+    with the number of words per field drawn from the given distribution.
+    """
+
+    def __init__(
+        self,
+        num_fields: int = 2,
+        mean_length: float = 20,
+        max_length: int = 250,
+        distribution: str = "lognormal",
+        vocab_size: int = 10000,
+        seed: int = 1234,
+    ):
+        assert distribution in LENGTH_DISTRIBUTIONS, f"Unknown length distribution {distribution}"
+        self.num_fields = num_fields
+        self.mean_length = mean_length
+        self.max_length = max_length
+        self.distribution = distribution
+        self.random = random.Random(seed)
+        # word lengths roughly like in European languages
+        self.vocab = [
+            "".join(self.random.choices(string.ascii_lowercase, k=self.random.randint(1, 12)))
+            for _ in range(vocab_size)
+        ]
+
+    def length(self) -> int:
+        mean = self.mean_length
+        if self.distribution == "fixed":
+            length = mean
+        elif self.distribution == "uniform":
+            length = self.random.uniform(1, 2 * mean - 1)
+        elif self.distribution == "normal":
+            length = self.random.gauss(mean, mean / 3)
+        else:
+            # heavy-tailed, with the given mean
+            sigma = 0.8
+            length = self.random.lognormvariate(math.log(mean) - sigma**2 / 2, sigma)
+        return max(1, min(self.max_length, round(length)))
+
+    def line(self) -> str:
+        return "\t".join(
+            " ".join(self.random.choices(self.vocab, k=self.length())) for _ in range(self.num_fields)
+        )
+
+    def write(self, destdir: Path, num_lines: int, shard_size: int = 50_000, codec: str = "gz"):
+        """
+        Writes num_lines lines to destdir as part.NNNNN.gz (or .zst, .lz4, or indexed .sidx) shards
+        of shard_size lines, like sotastream's own splitting does.
+        """
+        destdir.mkdir(parents=True, exist_ok=True)
+        for shardno, start in enumerate(range(0, num_lines, shard_size)):
+            lines = [self.line() for _ in range(min(shard_size, num_lines - start))]
+            if codec == indexed.CODEC:
+                indexed.write_indexed(destdir / f"part.{shardno:05d}{indexed.EXTENSION}", lines)
+                continue
+            shard_path = destdir / f"part.{shardno:05d}{compression.EXTENSIONS[codec]}"
+            with compression.open_compressed(shard_path, "wb", compresslevel=1) as outfh:
+                outfh.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+
+def count_data_sources(pipeline: str) -> int:
+    """The number of paths to pass to a pipeline (two for those that take any number)."""
+    count = 0
+    for arg_spec in PIPELINES[pipeline].get_data_sources_for_argparse():
+        nargs = arg_spec[2] if len(arg_spec) > 2 else None
+        count += 2 if nargs in ("+", "*") else 1
+    return count
+
+
+def run_once(command: List[str], num_lines: int, metrics_file: Path, log_file: Path, timeout: float) -> Dict:
+    """
+    Runs one sotastream command, reading (and discarding) its output until num_lines lines
+    have been produced, then stops it and collects its metrics.
+    """
+    start = time.perf_counter()
+    first_line_time = None
+    lines = num_bytes = 0
+    with open(log_file, "w") as logfh:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=logfh)
+        fd = process.stdout.fileno()
+        try:
+            while lines < num_lines:
+                data = os.read(fd, 1 << 20)
+                if not data:
+                    break
+                if first_line_time is None and b"\n" in data:
+                    first_line_time = time.perf_counter() - start
+                lines += data.count(b"\n")
+                num_bytes += len(data)
+                if time.perf_counter() - start > timeout:
+                    logger.warning(f"Run timed out after {timeout} seconds")
+                    break
+        finally:
+            elapsed = time.perf_counter() - start
+            # closing the pipe makes sotastream wind down and write its final metrics
+            process.stdout.close()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    if lines == 0:
+        raise RuntimeError(f"sotastream produced no output; see {log_file}")
+
+    peak_rss = {}
+    if metrics_file.exists():
+        for name, labels, value in metrics.parse_prometheus(metrics_file.read_text()):
+            if name == "sotastream_worker_max_rss_bytes" and labels.get("worker") != "all":
+                peak_rss[int(labels["worker"])] = int(value)
+
+    steady_time = max(elapsed - (first_line_time or 0.0), 1e-6)
+    return {
+        "lines": lines,
+        "bytes": num_bytes,
+        "seconds": round(elapsed, 3),
+        "time_to_first_line": round(first_line_time, 3) if first_line_time is not None else None,
+        "lines_per_second": round(lines / elapsed, 1),
+        "mb_per_second": round(num_bytes / elapsed / 2**20, 2),
+        # throughput once the first line is out
+        "steady_lines_per_second": round(lines / steady_time, 1),
+        "peak_rss_mb_per_worker": [round(peak_rss[i] / 2**20, 1) for i in sorted(peak_rss)],
+    }
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='sotastream bench',
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        '--pipeline',
+        default='default',
+        choices=sorted(PIPELINES.keys()),
+        help='The pipeline to run (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--pipeline-args',
+        default='',
+        help='Extra arguments for the pipeline, as a single string (e.g., "--spm model.spm")',
+    )
+    group = parser.add_argument_group('Synthetic corpus')
+    group.add_argument(
+        '--corpus-lines', type=int, default=500_000, help='Lines per corpus (default: %(default)s)'
+    )
+    group.add_argument('--fields', type=int, default=2, help='Fields per line (default: %(default)s)')
+    group.add_argument(
+        '--length-distribution',
+        choices=LENGTH_DISTRIBUTIONS,
+        default='lognormal',
+        help='Distribution of the number of words per field (default: %(default)s)',
+    )
+    group.add_argument(
+        '--mean-length', type=float, default=20, help='Mean words per field (default: %(default)s)'
+    )
+    group.add_argument(
+        '--max-length', type=int, default=250, help='Maximum words per field (default: %(default)s)'
+    )
+    group.add_argument(
+        '--shard-lines', type=int, default=50_000, help='Lines per shard (default: %(default)s)'
+    )
+    group.add_argument(
+        '--codec',
+        choices=sorted(compression.EXTENSIONS.keys()) + [indexed.CODEC],
+        default='gz',
+        help='Compression of the shards, or indexed shards (default: %(default)s)',
+    )
+    group.add_argument('--seed', type=int, default=1234, help='Random seed (default: %(default)s)')
+    group.add_argument(
+        '--workdir',
+        help='Directory for the corpora, logs and metrics (default: a temporary directory, removed afterwards)',
+    )
+
+    group = parser.add_argument_group('Sweep', 'Every combination of the given values is run')
+    group.add_argument(
+        '--num-processes', '-n', type=int, nargs='+', default=[1, 2, 4], help='(default: %(default)s)'
+    )
+    group.add_argument(
+        '--buffer-size',
+        '-b',
+        type=int,
+        nargs='+',
+        default=[Defaults.BUFFER_SIZE],
+        help='(default: %(default)s)',
+    )
+    group.add_argument(
+        '--queue-buffer-size',
+        '-q',
+        type=int,
+        nargs='+',
+        default=[Defaults.QUEUE_BUFFER_SIZE],
+        help='(default: %(default)s)',
+    )
+    group.add_argument(
+        '--lines', type=int, default=1_000_000, help='Lines to read from each run (default: %(default)s)'
+    )
+    group.add_argument(
+        '--timeout', type=float, default=600, help='Maximum seconds per run (default: %(default)s)'
+    )
+    parser.add_argument('--output', '-o', help='Where to write the JSON report (default: stdout)')
+    return parser
+
+
+def main(argv: List[str] = None):
+    """
+    Runs the benchmark. Arguments after `--` are passed on to sotastream (before the pipeline name).
+    """
+    argv = sys.argv[2:] if argv is None else argv
+    sotastream_args = []
+    if "--" in argv:
+        sotastream_args = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    args = create_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory(prefix="sotastream-bench.") as tmpdir:
+        workdir = Path(args.workdir or tmpdir)
+        corpora = []
+        for i in range(count_data_sources(args.pipeline)):
+            corpus_dir = workdir / f"corpus.{i}.{args.codec}"
+            if not corpus_dir.exists():
+                logger.info(f"Generating synthetic corpus of {args.corpus_lines:,} lines in {corpus_dir}")
+                corpus = SyntheticCorpus(
+                    num_fields=args.fields,
+                    mean_length=args.mean_length,
+                    max_length=args.max_length,
+                    distribution=args.length_distribution,
+                    seed=args.seed + i,
+                )
+                corpus.write(corpus_dir, args.corpus_lines, args.shard_lines, codec=args.codec)
+            corpora.append(str(corpus_dir))
+
+        results = []
+        sweep = itertools.product(args.num_processes, args.buffer_size, args.queue_buffer_size)
+        for runno, (num_processes, buffer_size, queue_buffer_size) in enumerate(sweep):
+            metrics_file = workdir / f"run.{runno}.prom"
+            command = [sys.executable, "-m", "sotastream"]
+            command += ["-n", str(num_processes), "-b", str(buffer_size), "-q", str(queue_buffer_size)]
+            command += ["--metrics-file", str(metrics_file), "--metrics-interval", "1"]
+            command += sotastream_args + [args.pipeline] + corpora + shlex.split(args.pipeline_args)
+            logger.info(f"Run {runno}: {' '.join(command)}")
+            result = {
+                "pipeline": args.pipeline,
+                "num_processes": num_processes,
+                "buffer_size": buffer_size,
+                "queue_buffer_size": queue_buffer_size,
+            }
+            result.update(
+                run_once(command, args.lines, metrics_file, workdir / f"run.{runno}.log", args.timeout)
+            )
+            logger.info(
+                f"Run {runno}: {result['lines_per_second']:,.0f} lines/sec, {result['mb_per_second']} MB/sec"
+            )
+            results.append(result)
+
+    report = {
+        "corpus": {
+            "lines": args.corpus_lines,
+            "fields": args.fields,
+            "length_distribution": args.length_distribution,
+            "mean_length": args.mean_length,
+            "max_length": args.max_length,
+            "shard_lines": args.shard_lines,
+            "codec": args.codec,
+        },
+        "sotastream_args": sotastream_args,
+        "results": results,
+    }
+    report = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as outfh:
+            print(report, file=outfh)
+    else:
+        print(report)
@@ -9,14 +9,31 @@ import argparse
 import logging
 import json
 import os
+import queue
+import signal
+import threading
 import time
 
 from collections import defaultdict
-from multiprocessing import Pipe, Process
-from typing import Type
-
-from . import __version__, Defaults
-from .utils.split import split_file_into_chunks
+from itertools import chain
+from multiprocessing import Process
+from multiprocessing.connection import wait
+from typing import Optional, Tuple, Type
+
+from . import __version__, Defaults, bench
+from .transport import (
+    METRICS,
+    TRANSPORTS,
+    AdaptiveBatchSize,
+    FixedBatchSize,
+    create_transport,
+    decode_frame,
+    encode_batch,
+    encode_metrics,
+)
+from .utils import cache, indexed, manifest, metrics, profiling
+from .utils.compression import EXTENSIONS
+from .utils.split import CACHE_KEYS, split_file_into_chunks, stop_background_splits
 from .pipelines import Pipeline, PIPELINES
 
 # Use seed in logger for when multiple are running
@@ -25,10 +42,11 @@ logger = logging.getLogger(f"sotastream")
 USER = os.environ.get('USER', os.environ.get('USERNAME', 'nouser'))
 
 
-def adjustSeed(seed, local_num_instances, local_instance_rank):
+def adjustSeed(seed, local_num_instances, local_instance_rank, restart=0):
     """
     Adjust seed for infinibatch such that each instance gets a different one based on process number and MPI
-    coordinates.
+    coordinates. Restarted workers (restart > 0) get yet another seed, so that they don't replay the data
+    their predecessor has already produced.
     """
     if seed == 0:
         seed = round(time.time() * 1000)  # the current time in milliseconds
@@ -42,19 +60,25 @@ def adjustSeed(seed, local_num_instances, local_instance_rank):
         mpi_instance_rank = int(os.environ["OMPI_COMM_WORLD_RANK"])
 
     # hash-combine seed with local process number and rank and MPI process number and rank
-    hashed_seed = hash((seed, local_num_instances, local_instance_rank, mpi_num_instances, mpi_instance_rank))
+    instance_info = (local_num_instances, local_instance_rank, mpi_num_instances, mpi_instance_rank)
+    if restart > 0:
+        instance_info += (restart,)
+    hashed_seed = hash((seed,) + instance_info)
 
     logger.info(
-        f"Computed seed {hashed_seed} from original seed {seed} and instance info: ({local_num_instances}, {local_instance_rank}, {mpi_num_instances}, {mpi_instance_rank})"
+        f"Computed seed {hashed_seed} from original seed {seed} and instance info: ({', '.join(map(str, instance_info))})"
     )
     return hashed_seed
 
 
-def run_pipeline_process(conn, args, seed, worker_id, num_workers):
+def run_pipeline_process(transport, args, seed, worker_id, num_workers):
     """
-    Runs a pipeline in a single subprocess. Each subprocess writes to
-    the pipe (conn) after it has seen the specified number (args.queue_buffer_size)
-    of lines.
+    Runs a pipeline in a single subprocess. Each subprocess writes a frame
+    (see sotastream.transport.encode_batch) to its transport after it has seen
+    the specified number (args.queue_buffer_size) of lines, or a number chosen
+    on the fly with --adaptive-batches. Every args.metrics_interval seconds, it
+    also sends a snapshot of its metrics, and after its next batch when the parent
+    asks for one with SIGUSR1 (see WorkerPool.collect_metrics()).
     """
 
     kwargs = {k: v for k, v in vars(args).items() if not (k in ["pipeline", "seed"])}
@@ -62,19 +86,445 @@ def run_pipeline_process(conn, args, seed, worker_id, num_workers):
     # These environment variables are used in the subprocesses to determine which worker they are
     os.environ["SOTASTREAM_WORKER_ID"] = str(worker_id)
     os.environ["SOTASTREAM_WORKER_COUNT"] = str(num_workers)
-    pipeline = Pipeline.create(args.pipeline, seed=seed, **kwargs)
+
+    # metrics dumps are the main process's business, which asks for a last snapshot before stopping us
+    next_metrics = time.time() + args.metrics_interval
+
+    def metrics_requested(signum, stack):
+        nonlocal next_metrics
+        next_metrics = 0
+
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, metrics_requested)
+    metrics.reset()
+    metrics.gauge("sotastream_worker_max_rss_bytes", max_rss)
+    if args.profile_stages:
+        profiling.enable()
+
+    def send_metrics():
+        transport.send(encode_metrics(metrics.encode_snapshot(metrics.snapshot())))
+
+    if args.adaptive_batches:
+        batch_size = AdaptiveBatchSize(args.batch_bytes, args.batch_latency, max_size=args.buffer_size)
+    else:
+        batch_size = FixedBatchSize(min(args.queue_buffer_size, args.buffer_size))
 
     try:
-        lines = []
-        for line in pipeline:
-            lines.append(str(line))
-            if len(lines) >= min(args.queue_buffer_size, args.buffer_size):
-                conn.send(lines)
-                lines = []
-        if lines:
-            conn.send(lines)
+        pipeline = Pipeline.create(args.pipeline, seed=seed, **kwargs)
+        next_metrics = min(next_metrics, time.time() + args.metrics_interval)
+        while True:
+            if time.time() >= next_metrics:
+                send_metrics()
+                next_metrics = time.time() + args.metrics_interval
+            batch_start = time.perf_counter()
+            lines = pipeline.next_batch(batch_size.size)
+            if not lines:
+                break
+            frame = encode_batch([str(line) for line in lines])
+            batch_size.update(len(lines), len(frame), time.perf_counter() - batch_start)
+            transport.send(frame)
+        send_metrics()
+    except Exception:
+        logger.exception(f"Worker {worker_id} failed")
+        raise
     finally:
-        conn.close()
+        transport.close_writer()
+
+
+def parse_size(text: str) -> int:
+    """
+    Parses a size in bytes with an optional K, M, G, or T suffix (powers of 1024), e.g. 512M.
+    """
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    text = text.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r} (expected e.g. 512M)")
+
+
+def parse_max_epochs(text: str) -> Tuple[Optional[str], float]:
+    """
+    Parses a --max-epochs value, [SOURCE=]EPOCHS, where SOURCE names a data source of the pipeline
+    (e.g., parallel). Without it, the limit applies to every data source.
+    """
+    name, _, epochs = text.rpartition("=")
+    try:
+        epochs = float(epochs)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid epochs: {text!r} (expected e.g. 3 or parallel=3)")
+    if epochs <= 0:
+        raise argparse.ArgumentTypeError(f"epochs must be positive: {text!r}")
+    return name or None, epochs
+
+
+def max_rss():
+    """
+    Returns the peak resident set size of this process in bytes (0 where unavailable).
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def describe_exit(exitcode):
+    """
+    Describes the exit code of a worker process for the logs.
+    """
+    if exitcode is None:
+        return "closed its output but is still running"
+    if exitcode < 0:
+        name = signal.Signals(-exitcode).name if -exitcode in signal.valid_signals() else -exitcode
+        if -exitcode == signal.SIGKILL:
+            return f"killed by signal {name} (possibly by the out-of-memory killer)"
+        return f"killed by signal {name}"
+    return f"exited with code {exitcode} (see the worker's traceback above)"
+
+
+class WorkerPool:
+    """
+    Starts the pipeline worker processes and supervises them.
+
+    A worker that dies (e.g., from an out-of-memory kill or an exception) or that has produced
+    nothing for worker_timeout seconds is logged and replaced by a new process with the same
+    worker ID and a fresh seed, up to max_restarts times per worker. The other workers keep
+    running in the meantime. Workers that finish their stream (exit code 0) are not replaced.
+    """
+
+    # how often to check for hung workers while waiting for output
+    CHECK_INTERVAL = 1.0
+
+    # how long to wait for the workers' last metrics before stopping them, in seconds
+    METRICS_TIMEOUT = 2.0
+
+    def __init__(
+        self,
+        args,
+        num_workers: int,
+        worker_timeout: float = Defaults.WORKER_TIMEOUT,
+        max_restarts: int = Defaults.MAX_RESTARTS,
+    ):
+        self.args = args
+        self.num_workers = num_workers
+        self.worker_timeout = worker_timeout
+        self.max_restarts = max_restarts
+        self.transports = [None] * num_workers
+        self.processes = [None] * num_workers
+        self.restarts = [0] * num_workers
+        self.last_output = [0.0] * num_workers
+        # workers that were restarted and have not produced anything yet
+        self.restarting = set()
+        # workers that are given up on after too many restarts
+        self.failed = set()
+        self.active = list(range(num_workers))
+        for i in range(num_workers):
+            self.start(i)
+
+    @property
+    def check_interval(self):
+        """How long to block on workers before checking for hung ones (None: block indefinitely)"""
+        return self.CHECK_INTERVAL if self.worker_timeout > 0 else None
+
+    def start(self, i: int):
+        """Starts (or restarts) worker i."""
+        args = self.args
+        transport = create_transport(args.transport, size=args.shm_size * 2**20)
+        seed = adjustSeed(args.seed, self.num_workers, i, restart=self.restarts[i])
+        process = Process(target=run_pipeline_process, args=(transport, args, seed, i, self.num_workers))
+        process.start()
+        # only the worker writes; closing our copy lets us see the end of its stream
+        transport.writer.close()
+        self.transports[i] = transport
+        self.processes[i] = process
+        self.last_output[i] = time.time()
+
+    def recv(self, i: int):
+        """
+        Receives the next frame from worker i, blocking until there is one.
+
+        :return: The frame, or None if the worker ended, died, or hung (and was dealt with).
+        """
+        transport = self.transports[i]
+        while self.check_interval and not transport.reader.poll(self.check_interval):
+            if self.check_hung(i):
+                return None
+        try:
+            frame = transport.recv()
+        except EOFError:
+            self.handle_exit(i)
+            return None
+        self.last_output[i] = time.time()
+        self.restarting.discard(i)
+        return frame
+
+    def release(self, i: int):
+        self.transports[i].release()
+
+    def check_hung(self, i: int) -> bool:
+        """Restarts worker i if it has not produced anything for too long."""
+        silence = time.time() - self.last_output[i]
+        # output that is ready by now means we (not the worker) were busy
+        if (
+            self.worker_timeout > 0
+            and silence > self.worker_timeout
+            and not self.transports[i].reader.poll(0)
+        ):
+            logger.error(f"Worker {i} (pid {self.processes[i].pid}) produced nothing for {silence:.0f}s")
+            self.restart(i)
+            return True
+        return False
+
+    def handle_exit(self, i: int):
+        """Deals with worker i after it closed its output."""
+        process = self.processes[i]
+        process.join(timeout=5)
+        if process.exitcode == 0:
+            logger.info(f"Worker {i} finished its stream")
+            self.active.remove(i)
+            self.transports[i].close()
+        else:
+            logger.error(f"Worker {i} (pid {process.pid}) {describe_exit(process.exitcode)}")
+            self.restart(i)
+
+    def restart(self, i: int):
+        """Replaces worker i by a new process, unless it was restarted too often already."""
+        self.stop(i)
+        if self.restarts[i] >= self.max_restarts:
+            logger.error(f"Worker {i} was restarted {self.restarts[i]} times already; giving up on it")
+            self.active.remove(i)
+            self.failed.add(i)
+            return
+        self.restarts[i] += 1
+        logger.warning(f"Restarting worker {i} (restart {self.restarts[i]} of at most {self.max_restarts})")
+        self.start(i)
+        self.restarting.add(i)
+
+    def stop(self, i: int):
+        """Stops worker i and closes its transport."""
+        process = self.processes[i]
+        if process.is_alive():
+            process.terminate()
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.transports[i].close()
+
+    def collect_metrics(self, timeout: float = METRICS_TIMEOUT):
+        """
+        Asks the active workers for a snapshot of their metrics (with SIGUSR1), and receives their
+        frames until each has sent one, or until timeout seconds have passed, dropping the others.
+
+        :return: a generator over (worker index, metrics frame) pairs. Each frame is only valid until
+            the next one is requested.
+        """
+        pending = set()
+        for i in self.active:
+            try:
+                os.kill(self.processes[i].pid, signal.SIGUSR1)
+                pending.add(i)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            readers = {self.transports[i].reader: i for i in pending}
+            for reader in wait(list(readers), timeout=deadline - time.time()):
+                i = readers[reader]
+                try:
+                    frame = self.transports[i].recv()
+                except EOFError:
+                    pending.discard(i)
+                    continue
+                if frame[0] == METRICS:
+                    pending.discard(i)
+                    yield i, frame
+                self.release(i)
+
+    def terminate(self):
+        for i in self.active:
+            self.processes[i].terminate()
+        for i in self.active:
+            self.transports[i].close()
+
+
+def receive_round_robin(pool: WorkerPool, stall_time):
+    """
+    Receives batches from the workers in strict round-robin order, which makes the
+    output order deterministic for a given seed. A slow worker holds up all others,
+    except for restarted workers, which are skipped until they have output ready.
+
+    :param pool: The worker pool
+    :param stall_time: Per-worker list, incremented by the time spent blocked on that worker
+    :return: a generator over (worker index, frame) pairs, ending once all workers are done.
+        Each frame is only valid until the next one is requested.
+    """
+    while pool.active:
+        for i in list(pool.active):
+            if i not in pool.active or (i in pool.restarting and not pool.transports[i].reader.poll(0)):
+                continue
+            while True:
+                start = time.perf_counter()
+                frame = pool.recv(i)
+                stall_time[i] += time.perf_counter() - start
+                if frame is None:
+                    break
+                kind = frame[0]
+                yield i, frame
+                pool.release(i)
+                # metrics frames are sent on a timer, so they must not use up the worker's turn
+                if kind != METRICS:
+                    break
+
+
+def receive_when_ready(pool: WorkerPool, stall_time):
+    """
+    Receives batches from whichever workers have one ready, draining each ready worker
+    once per round so that no worker is starved. The output order depends on timing.
+
+    :param pool: The worker pool
+    :param stall_time: Per-worker list, incremented by the time spent blocked while that worker had nothing ready
+    :return: a generator over (worker index, frame) pairs, ending once all workers are done.
+        Each frame is only valid until the next one is requested.
+    """
+    while pool.active:
+        readers = {pool.transports[i].reader: i for i in pool.active}
+        start = time.perf_counter()
+        ready = set(wait(list(readers), timeout=pool.check_interval))
+        waited = time.perf_counter() - start
+        for reader, i in readers.items():
+            if reader not in ready:
+                stall_time[i] += waited
+                pool.check_hung(i)
+                continue
+            frame = pool.recv(i)
+            if frame is None:
+                continue
+            yield i, frame
+            pool.release(i)
+
+
+def log_samples(payload, first_lineno, args):
+    """
+    Logs the lines of a batch that are selected by --log-first and --log-rate.
+
+    :param payload: The newline-terminated UTF-8 lines of the batch
+    :param first_lineno: The (1-based) output line number of the first line in the batch
+    :param args: CLI args object from argparse
+    """
+    lines = str(payload, "utf-8").split("\n")[:-1]
+    for lineno, line in enumerate(lines, first_lineno):
+        if (args.log_rate > 0 and lineno % args.log_rate == 0) or lineno <= args.log_first:
+            if args.sample_file:
+                print(line, file=args.sample_file)
+            else:
+                logger.info(f"SAMPLE {lineno}: {line}")
+
+
+class OutputWriter:
+    """
+    Writes the output from a dedicated thread, so that receiving from the workers overlaps
+    with blocking writes to stdout (e.g., when the consumer's pipe is full).
+
+    Payloads are copied into buffers that are handed to the writer thread through a bounded
+    queue. A buffer is handed over once it reaches buffer_size bytes, or right away if the
+    writer thread is idle. When the queue is full, write() blocks, which in turn stops
+    receiving from the workers. With queue_size=0, payloads are written from the calling thread.
+    """
+
+    def __init__(
+        self,
+        output,
+        queue_size: int = Defaults.WRITE_QUEUE_SIZE,
+        buffer_size: int = Defaults.WRITE_BUFFER_SIZE,
+    ):
+        self.output = output
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.error = None
+        # most buffers and bytes that were waiting to be written at the same time
+        self.high_water_mark = 0
+        self.high_water_bytes = 0
+        self._queued_bytes = 0
+        self._lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self._run, name="sotastream-writer", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            buffer = self.queue.get()
+            if buffer is None:
+                break
+            try:
+                self.output.write(buffer)
+            except Exception as ex:
+                self.error = ex
+                break
+            finally:
+                with self._lock:
+                    self._queued_bytes -= len(buffer)
+        try:
+            self.output.flush()
+        except Exception as ex:
+            self.error = self.error or ex
+
+    def _put(self, item):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, payload):
+        """
+        Writes (or queues) a payload. It is copied, so the caller may reuse the memory afterwards.
+        Errors raised by the writer thread (e.g., BrokenPipeError) are re-raised here.
+        """
+        if self.thread is None:
+            self.output.write(payload)
+            return
+
+        self.buffer += payload
+        # don't keep the payload alive in the traceback of a re-raised error
+        del payload
+        if len(self.buffer) >= self.buffer_size or self.queue.empty():
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self.buffer:
+            buffer, self.buffer = self.buffer, bytearray()
+            with self._lock:
+                self._queued_bytes += len(buffer)
+                self.high_water_bytes = max(self.high_water_bytes, self._queued_bytes)
+            self._put(buffer)
+            self.high_water_mark = max(self.high_water_mark, self.queue.qsize())
+
+    def close(self):
+        """
+        Writes out everything that is pending and waits for the writer thread to finish.
+        """
+        if self.thread is None:
+            self.output.flush()
+            return
+        self._flush_buffer()
+        self._put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
 
 
 def add_global_args(parser: argparse.ArgumentParser):
@@ -103,6 +553,37 @@ def add_global_args(parser: argparse.ArgumentParser):
         type=int,
         default=Defaults.BUFFER_SIZE,
     )
+    parser.add_argument(
+        '--buffer-bytes',
+        type=parse_size,
+        default=Defaults.BUFFER_BYTES,
+        metavar='SIZE',
+        help='Limit the shuffle buffer of each data source by memory instead of lines (--buffer-size), '
+        'e.g. 512M or 2G. Implies --packed-buffer.',
+    )
+    parser.add_argument(
+        '--max-epochs',
+        type=parse_max_epochs,
+        action='append',
+        metavar='[SOURCE=]EPOCHS',
+        help='End the stream once a data source has delivered this many passes over its data (e.g., 2.5). '
+        'SOURCE is the name of one of the pipeline\'s data sources (e.g., parallel); without it, the limit '
+        'applies to all of them. Can be repeated.',
+    )
+    parser.add_argument(
+        '--packed-buffer',
+        action='store_true',
+        help='Keep the lines in the shuffle buffers packed as bytes, and create Line objects only when they '
+        'are delivered. Takes less memory, at some cost in speed, and shuffles the same way.',
+    )
+    parser.add_argument(
+        '--prefetch-chunks',
+        type=int,
+        default=Defaults.PREFETCH_CHUNKS,
+        metavar='N',
+        help='Read up to N chunks ahead in a background thread of each worker, so that the pipeline does not '
+        'wait for chunks to be read and decompressed (default: %(default)s)',
+    )
     parser.add_argument(
         '--queue-buffer-size',
         '-q',
@@ -124,19 +605,162 @@ def add_global_args(parser: argparse.ArgumentParser):
         type=int,
         default=Defaults.NUM_PROCESSES,
     )
+    parser.add_argument(
+        '--transport',
+        choices=sorted(TRANSPORTS.keys()),
+        default=Defaults.TRANSPORT,
+        help='How workers send lines to the main process: "pipe" sends each batch as one UTF-8 frame '
+        'over a pipe, "shm" writes the frames to a per-worker shared memory ring buffer '
+        '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--shm-size',
+        type=int,
+        default=Defaults.SHM_SIZE // 2**20,
+        metavar='MB',
+        help='Size of each worker\'s shared memory ring buffer in MiB, for --transport shm (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--write-queue-size',
+        type=int,
+        default=Defaults.WRITE_QUEUE_SIZE,
+        metavar='N',
+        help='Number of output buffers that may be queued for the writer thread; '
+        '0 writes from the main thread (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--adaptive-batches',
+        action='store_true',
+        help='Let workers choose the number of lines per batch they send (instead of --queue-buffer-size), '
+        'aiming at --batch-bytes per batch within --batch-latency',
+    )
+    parser.add_argument(
+        '--batch-bytes',
+        type=int,
+        default=Defaults.BATCH_BYTES,
+        metavar='BYTES',
+        help='Target size of a batch, for --adaptive-batches (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--batch-latency',
+        type=float,
+        default=Defaults.BATCH_LATENCY,
+        metavar='SECONDS',
+        help='Longest time a worker may spend filling a batch, for --adaptive-batches (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        metavar='PATH',
+        help='Periodically (see --metrics-interval) rewrite this file with metrics of the stream, '
+        'in the Prometheus text format. The metrics are also logged on SIGUSR1.',
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=Defaults.METRICS_INTERVAL,
+        metavar='SECONDS',
+        help='How often workers report their metrics, and the metrics file is rewritten (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--profile-stages',
+        action='store_true',
+        help='Count the items going in and out of each augmentor and filter, and time a sample of them. '
+        'The per-stage results, as of the last metrics reported by the workers (see --metrics-interval), '
+        'are added to the summary.',
+    )
+    parser.add_argument(
+        '--worker-timeout',
+        type=float,
+        default=Defaults.WORKER_TIMEOUT,
+        metavar='SECONDS',
+        help='Restart workers that produce no output for this long, including at start-up (0=off, the default)',
+    )
+    parser.add_argument(
+        '--max-restarts',
+        type=int,
+        default=Defaults.MAX_RESTARTS,
+        metavar='N',
+        help='Give up on a worker that died or hung after restarting it N times (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--round-robin',
+        action='store_true',
+        help='Read from the workers in strict round-robin order, making the output order deterministic '
+        'for a given seed. By default, batches are taken from whichever workers have them ready.',
+    )
     parser.add_argument('--version', '-V', action='version', version='sotastream {}'.format(__version__))
     parser.add_argument(
         "--split-tmpdir",
         default=f"/tmp/sotastream-{USER}",
         help="Base temporary directory to use when splitting data files",
     )
+    parser.add_argument(
+        "--split-processes",
+        type=int,
+        default=Defaults.SPLIT_PROCESSES,
+        metavar="N",
+        help="Split data files in Python with N processes, instead of with pigz, sed, and split in a subshell. "
+        "Uncompressed files are split in N byte ranges at once; compressed ones are decompressed in one "
+        "process while N compress the shards. 0 splits in a subshell, or where the shell tools are missing "
+        "or with --stream-while-splitting, in Python with one process per CPU, up to 8 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--split-cache-key",
+        choices=CACHE_KEYS,
+        default=Defaults.SPLIT_CACHE_KEY,
+        help="What identifies a data file in the split cache: a fingerprint of its size, modification time, "
+        "inode, and sampled blocks, which takes milliseconds, or the MD5 checksum of all of it "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--split-cache-size",
+        type=parse_size,
+        default=Defaults.SPLIT_CACHE_SIZE,
+        metavar="SIZE",
+        help="Keep the split cache (--split-tmpdir) within SIZE (e.g., 200G) by removing the least recently "
+        "used split files that no running sotastream is using, after each new split. See `sotastream "
+        "cache` (default: %(default)s, unlimited)",
+    )
+    parser.add_argument(
+        "--verify-md5",
+        action="store_true",
+        help="Compute the MD5 checksums of the data files in the background while streaming, and log an "
+        "error if one differs from that of the file its cached split came from",
+    )
+    parser.add_argument(
+        "--stream-while-splitting",
+        action="store_true",
+        help="Start streaming as soon as the first shard of a data file is split, rather than once all of "
+        "it is. The rest is split in the background (in Python, see --split-processes), and the workers "
+        "read the new shards as they appear. If the stream ends first, the split is stopped and marked "
+        "as abandoned, and the next run splits the file again from the start, without the shards "
+        "written so far.",
+    )
+    parser.add_argument(
+        "--shard-codec",
+        choices=sorted(EXTENSIONS.keys()) + [indexed.CODEC],
+        default=Defaults.SHARD_CODEC,
+        help="Compression of the shards written when splitting data files. zst and lz4 decompress "
+        "several times faster than gz. indexed writes uncompressed shards that are read through mmap "
+        "and shuffled by permuting line numbers, without a shuffle buffer (default: %(default)s)",
+    )
     parser.add_argument("--quiet", action="store_true", help="Suppress logging output")
 
 
+def check_max_epochs(args) -> Optional[str]:
+    """Returns an error message if --max-epochs names a data source that the pipeline does not have."""
+    names = [x[0] for x in PIPELINES[args.pipeline].get_data_sources_for_argparse()]
+    for name, _ in getattr(args, 'max_epochs', None) or []:
+        if name is not None and name not in names:
+            return f"--max-epochs: unknown data source {name}; the pipeline has {', '.join(names)}"
+    return None
+
+
 def maybe_split_files(args):
     """Split data files into smaller files in a temporary directory
 
-    This function updates args inplace: it replaces .gz paths (if any) with split dirs.
+    This function updates args inplace: it replaces file paths (compressed with gzip, Zstandard, or LZ4,
+    or not) with split dirs.
 
     Args:
         args: CLI args object from argparse
@@ -148,27 +772,55 @@ def maybe_split_files(args):
     # Use the name to get the path from the runtime args object
     data_sources = [(x[0], args_dict[x[0]]) for x in data_source_params]
     for name, path in data_sources:
-        # For any path that is a .gz file, split it into chunks.
+        # For any path that is a file (compressed or not), split it into chunks.
         # Directories that were pre-split are left as-is.
         if not isinstance(path, str):
             logger.warning(f"Skipping {name}={path} because it is {type(path)}, but str expected")
             continue
-        if not os.path.isdir(path) and path.endswith(".gz"):
-            splitdir = split_file_into_chunks(path, tmpdir=args.split_tmpdir, split_size=args.buffer_size)
+        if os.path.isfile(path):
+            splitdir = split_file_into_chunks(
+                path,
+                tmpdir=args.split_tmpdir,
+                split_size=args.buffer_size,
+                codec=args.shard_codec,
+                processes=getattr(args, 'split_processes', Defaults.SPLIT_PROCESSES),
+                cache_key=getattr(args, 'split_cache_key', Defaults.SPLIT_CACHE_KEY),
+                verify=getattr(args, 'verify_md5', False),
+                stream=getattr(args, 'stream_while_splitting', False),
+                cache_size=getattr(args, 'split_cache_size', Defaults.SPLIT_CACHE_SIZE),
+            )
             setattr(args, name, splitdir)
     # Inject a keyword argument 'data_sources' that contains all data sources
     setattr(args, 'data_sources', [path for name, path in data_sources])
 
-
-def main():
-    stats = defaultdict(int)
-    stats['start_time'] = time.time()
+    # Resolve --max-epochs to the paths the data sources are read from
+    error = check_max_epochs(args)
+    if error:
+        raise ValueError(error)
+    max_epochs = dict(getattr(args, 'max_epochs', None) or [])
+    names = [name for name, _ in data_sources]
+    source_max_epochs = {}
+    for name in names:
+        epochs = max_epochs.get(name, max_epochs.get(None))
+        paths = getattr(args, name)
+        for path in paths if isinstance(paths, list) else [paths]:
+            if epochs:
+                source_max_epochs[str(path)] = epochs
+    setattr(args, 'source_max_epochs', source_max_epochs)
+
+
+def create_parser() -> argparse.ArgumentParser:
+    """
+    Creates the command line parser, with one subcommand per pipeline.
+    """
     # Get the list of available pipelines
     parser = argparse.ArgumentParser(
         prog='sotastream',
         description='Command line wrapper for augmentation pipelines',
         formatter_class=argparse.RawTextHelpFormatter,
-        epilog='''\n\nTo load additional pipelines create (or symlink) *_pipeline.py files from current directory.''',
+        epilog='''\n\nTo load additional pipelines create (or symlink) *_pipeline.py files from current directory.'''
+        '''\n\nOther commands (see `sotastream <command> --help`):\n'''
+        + '\n'.join(f'  {name:<10} {description}' for name, (_, description) in COMMANDS.items()),
     )
     add_global_args(parser)
 
@@ -186,44 +838,87 @@ def main():
         )
         pipeline_class.add_cli_args(sub_parser)
 
+    return parser
+
+
+# Commands other than running a pipeline: name -> (function taking the remaining arguments, description)
+COMMANDS = {
+    "bench": (bench.main, "Benchmark a pipeline on synthetic data"),
+    "manifest": (manifest.main, "Write shard manifests for pre-split data directories"),
+    "cache": (cache.main, "List, prune, or verify the split cache"),
+}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        command, _ = COMMANDS[sys.argv[1]]
+        return command(sys.argv[2:])
+
+    stats = defaultdict(int)
+    stats['start_time'] = time.time()
+    parser = create_parser()
     args = parser.parse_args()
     logLevel = logging.CRITICAL if args.quiet else logging.INFO
     logging.basicConfig(level=logLevel)
 
+    error = check_max_epochs(args)
+    if error:
+        parser.error(error)
+
     maybe_split_files(args)
 
     N = args.num_processes
 
-    pipes = [Pipe() for i in range(N)]
-    processes = [
-        Process(target=run_pipeline_process, args=(pipes[i][1], args, adjustSeed(args.seed, N, i), i, N))
-        for i in range(N)
-    ]
-    for p in processes:
-        p.start()
+    pool = WorkerPool(args, N, worker_timeout=args.worker_timeout, max_restarts=args.max_restarts)
 
     overhead_time = time.time()
 
     lineno = 0
+    num_bytes = 0
+    num_tokens = 0
     num_fields = defaultdict(int)
+    stall_time = [0.0] * N
+    # number of batches, and lines and bytes in the last batch, per worker
+    num_batches = [0] * N
+    last_batch = [(0, 0)] * N
+    receive = receive_round_robin if args.round_robin else receive_when_ready
+    output = OutputWriter(sys.stdout.buffer, queue_size=args.write_queue_size)
+    frames = receive(pool, stall_time)
+    frame = payload = None
+
+    stream_metrics = metrics.StreamMetrics(N, stall_time=stall_time, restarts=pool.restarts)
+    if args.metrics_file:
+        # on schedule, even while the workers stall
+        stream_metrics.start_writing(args.metrics_file, args.metrics_interval)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, stack: stream_metrics.log())
+
     try:
-        # round-robin across the pipes forever
-        while True:
-            for pipe in pipes:
-                # To avoid pickling (and the associated timing costs), lines
-                # are transmitted as strings, not Line objects.
-                lines = pipe[0].recv()
-                for line in lines:
-                    fields = line.split("\t")
-                    num_fields[len(fields)] += 1
-                    print(line)
-                    lineno += 1
-
-                    if (args.log_rate > 0 and lineno % args.log_rate == 0) or lineno <= args.log_first:
-                        if args.sample_file:
-                            print(line, file=args.sample_file)
-                        else:
-                            logger.info(f"SAMPLE {lineno}: {line}")
+        # Workers send ready-to-write UTF-8 blocks of lines, with the field counts
+        # already tallied, so that the work done here per line is minimal.
+        for worker_id, frame in frames:
+            kind, num_lines, frame_num_tokens, frame_num_fields, payload = decode_frame(frame)
+            if kind == METRICS:
+                stream_metrics.set_worker_snapshot(worker_id, metrics.decode_snapshot(payload))
+                continue
+
+            output.write(payload)
+
+            # only decode the batch if a line in it is to be logged
+            if lineno < args.log_first or (
+                args.log_rate > 0 and (lineno + num_lines) // args.log_rate > lineno // args.log_rate
+            ):
+                log_samples(payload, lineno + 1, args)
+
+            lineno += num_lines
+            num_bytes += len(payload)
+            num_tokens += frame_num_tokens
+            num_batches[worker_id] += 1
+            last_batch[worker_id] = (num_lines, len(payload))
+            for n, count in frame_num_fields.items():
+                num_fields[n] += count
+            stream_metrics.add_batch(worker_id, num_lines, len(payload), frame_num_tokens)
+        output.close()
     except BrokenPipeError:  # this is not really an error, just means that the receiving process has ended
         # Python flushes standard streams on exit; redirect remaining output
         # to devnull to avoid another BrokenPipeError at shutdown
@@ -231,19 +926,52 @@ def main():
         os.dup2(devnull, sys.stdout.fileno())
     finally:
         # Looks like the process that we are piping to is done, let's wrap things up
-        for p in processes:
-            p.terminate()
+        # drop all views of received frames before closing the transports
+        frames.close()
+        frame = payload = None
+        # the workers' metrics since their last snapshot, for the summary (unless interrupted)
+        if hasattr(signal, "SIGUSR1") and not isinstance(sys.exc_info()[1], KeyboardInterrupt):
+            for worker_id, frame in pool.collect_metrics():
+                payload = decode_frame(frame)[-1]
+                stream_metrics.set_worker_snapshot(worker_id, metrics.decode_snapshot(payload))
+            frame = payload = None
+        pool.terminate()
+        stop_background_splits()
 
         stats['end_time'] = time.time()
+        stats['transport'] = args.transport
         stats['lines_produced'] = f'{lineno:,}'
+        stats['bytes_produced'] = f'{num_bytes:,}'
+        stats['tokens_produced'] = f'{num_tokens:,}'
         stats['num_fields'] = num_fields
+        stats['merge'] = 'round-robin' if args.round_robin else 'ready'
+        stats['worker_stall_time'] = [round(t, 3) for t in stall_time]
+        stats['worker_restarts'] = pool.restarts
+        stats['batches'] = f'{sum(num_batches):,}'
+        stats['mean_batch_lines'] = round(lineno / max(sum(num_batches), 1), 1)
+        stats['mean_batch_bytes'] = round(num_bytes / max(sum(num_batches), 1))
+        stats['last_batch_lines'] = [lines for lines, _ in last_batch]
+        stats['last_batch_bytes'] = [size for _, size in last_batch]
+        stats['failed_workers'] = sorted(pool.failed)
+        stats['sources'] = stream_metrics.sources()
+        if args.profile_stages:
+            stats['stages'] = profiling.summarize(chain.from_iterable(stream_metrics.worker_samples))
+        stats['write_queue_high_water_mark'] = output.high_water_mark
+        stats['write_queue_high_water_bytes'] = f'{output.high_water_bytes:,}'
         total_time = stats['end_time'] - stats['start_time']
         stats['overhead_time'] = overhead_time - stats['start_time']
         stats['total_time'] = f"{total_time:,.3f} sec"
         stats['yield_rate'] = f"{lineno / total_time:,.2f} lines/sec"
         stats['yield_rate_sans_overhead'] = f"{lineno / (stats['end_time'] - overhead_time):,.2f} lines/sec"
         logger.info('Summary: ' + json.dumps(stats, indent=2))
+        if args.metrics_file:
+            stream_metrics.stop_writing()
+            stream_metrics.write(args.metrics_file)
+
+    if pool.failed:
+        logger.error(f"Gave up on workers {sorted(pool.failed)} after repeated failures")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,6 +1,20 @@
 from . import Defaults
 
-from typing import List, Optional
+from array import array
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+try:
+    import numpy
+except ImportError:  # optional (pip install sotastream[columnar]); Columns falls back to lists
+    numpy = None
+
+
+def _is_clean(rawLine: str) -> bool:
+    """
+    Whether splitting rawLine into fields and stripping them leaves it unchanged,
+    i.e., no field ends in a space, carriage return, or newline.
+    """
+    return not (rawLine.endswith((" ", "\r", "\n")) or " \t" in rawLine or "\r" in rawLine or "\n" in rawLine)
 
 
 class Line:
@@ -8,13 +22,18 @@ class Line:
     A Line object represents a line containined fields. The string representation
     is typically delimited by tabs, and internally we use fields. The fields can
     represent any parallel corpus. Typically, they are source, target, and metadata.
+
+    A Line created from a raw line keeps the raw string and only splits it into fields
+    when they are first accessed, so lines that merely pass through a pipeline are never
+    split and re-joined: str() returns the raw string as is.
     """
 
     # Define slots for efficiency. This avoids the use of a dict
     # for each instance, which is a big memory savings.
     # https://docs.python.org/3/reference/datamodel.html#slots
     # https://stackoverflow.com/questions/472000/usage-of-slots
-    __slots__ = "fields"
+    # Exactly one of them is set: the raw line (not split yet), or the list of fields.
+    __slots__ = ("_raw", "_fields")
 
     def __init__(self, rawLine=None, fields=[]) -> None:
         """
@@ -33,11 +52,47 @@ class Line:
         :param fields: A list of fields directly.
         """
         if rawLine is not None:
-            self.fields = [field.rstrip("\r\n ") for field in rawLine.split("\t")]
-        elif fields is None:
-            self.fields = []
+            if _is_clean(rawLine):
+                self._raw = rawLine
+                self._fields = None
+            else:
+                self._raw = None
+                self._fields = [field.rstrip("\r\n ") for field in rawLine.split("\t")]
         else:
-            self.fields = [field for field in fields]
+            self._raw = None
+            self._fields = [] if fields is None else [field for field in fields]
+
+    @property
+    def fields(self) -> List[str]:
+        """The list of fields. Accessing it splits the raw line, if that has not happened yet."""
+        if self._fields is None:
+            self._fields = self._raw.split("\t")
+            self._raw = None
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields: List[str]):
+        self._raw = None
+        self._fields = fields
+
+    def project(self, end_range: int) -> "Line":
+        """
+        Keeps only the fields up to end_range (exclusive), in place. A line that has
+        not been split yet is cut at the end_range-th tab instead.
+
+        :param end_range: One higher than the last 0-index field number to keep.
+        :return: the line itself.
+        """
+        if self._fields is not None or end_range <= 0:
+            del self.fields[max(end_range, 0) :]
+            return self
+        pos = -1
+        for _ in range(end_range):
+            pos = self._raw.find("\t", pos + 1)
+            if pos < 0:
+                return self
+        self._raw = self._raw[:pos]
+        return self
 
     def __str__(self):
         """
@@ -46,11 +101,15 @@ class Line:
         If you want to print metadata or have other semantics for these
         fields, you'll have to roll it yourself.
         """
-        return "\t".join(self.fields)
+        if self._fields is None:
+            return self._raw
+        return "\t".join(self._fields)
 
     def __len__(self):
         """The length is the number of non-None fields."""
-        return len(self.fields)
+        if self._fields is None:
+            return self._raw.count("\t") + 1
+        return len(self._fields)
 
     def __getitem__(self, i):
         """Return the ith field."""
@@ -65,14 +124,20 @@ class Line:
         self.fields[i] = value
 
     def __eq__(self, other):
-        return isinstance(other, Line) and self.fields == other.fields
+        if not isinstance(other, Line):
+            return False
+        if self._fields is None and other._fields is None:
+            return self._raw == other._raw
+        return self.fields == other.fields
 
     def __hash__(self):
         """Makes the object hashable."""
         return hash(tuple(self.fields))
 
     def __copy__(self):
-        return Line(fields=self.fields)
+        if self._fields is None:
+            return Line(self._raw)
+        return Line(fields=self._fields)
 
     @staticmethod
     def join(lines: List["Line"], separator=Defaults.DOC_SEPARATOR, end_range=2):
@@ -118,3 +183,192 @@ class Line:
                 self[i] = other[i]
             else:
                 self[i] += separator + other[i]
+
+
+class Columns:
+    """
+    A batch of lines stored column by column: fields[i] is the list of the i-th fields of all
+    lines, i.e., one contiguous array of strings per field. Stages that work on whole columns
+    (see the Batch* augmentors and filters) handle a batch without creating an object per line.
+
+    Lines with fewer fields than the others are padded with empty fields; widths then records
+    the number of fields of each line, so that to_strings() gives the lines back as they were.
+
+    Example usage:
+
+    batch = Columns.from_lines([Line("a b\tc"), Line("d\te f")])
+    batch.fields[0]
+    -> ['a b', 'd']
+    batch.lengths(1)
+    -> array([1, 2])
+    """
+
+    __slots__ = ("fields", "widths")
+
+    def __init__(self, fields: List[List[str]], widths: Optional[List[int]] = None) -> None:
+        """
+        :param fields: The columns, all of the same length
+        :param widths: The number of fields of each line, or None if all lines have all fields
+        """
+        self.fields = fields
+        self.widths = widths
+
+    @classmethod
+    def from_lines(cls, lines: Iterable) -> "Columns":
+        """Creates a batch from Line objects (or raw tab-separated strings)."""
+        rows = [(line if isinstance(line, Line) else Line(line)).fields for line in lines]
+        if not rows:
+            return cls([])
+        widths = [len(row) for row in rows]
+        num_fields = max(widths)
+        if min(widths) == num_fields:
+            return cls([list(column) for column in zip(*rows)])
+        rows = [row + [""] * (num_fields - len(row)) for row in rows]
+        return cls([list(column) for column in zip(*rows)], widths)
+
+    @classmethod
+    def concat(cls, batches: Sequence["Columns"]) -> "Columns":
+        """Concatenates batches, one after the other."""
+        batches = [batch for batch in batches if len(batch)]
+        if len(batches) == 1:
+            return batches[0]
+        if not batches:
+            return cls([])
+        num_fields = max(len(batch.fields) for batch in batches)
+        ragged = any(batch.widths is not None or len(batch.fields) < num_fields for batch in batches)
+        fields = [[] for _ in range(num_fields)]
+        widths = [] if ragged else None
+        for batch in batches:
+            for fieldno in range(num_fields):
+                if fieldno < len(batch.fields):
+                    fields[fieldno].extend(batch.fields[fieldno])
+                else:
+                    fields[fieldno].extend([""] * len(batch))
+            if ragged:
+                widths.extend(batch.widths or [len(batch.fields)] * len(batch))
+        return cls(fields, widths)
+
+    def __len__(self):
+        """The number of lines."""
+        return len(self.fields[0]) if self.fields else 0
+
+    def set_field(self, i: int, column: List[str]):
+        """Sets the ith field of all lines, adding empty fields as needed (like Line.__setitem__)."""
+        while i >= len(self.fields):
+            self.fields.append([""] * len(self))
+        self.fields[i] = column
+        if self.widths is not None:
+            self.widths = [max(width, i + 1) for width in self.widths]
+
+    def rows(self, start: int, stop: int) -> "Columns":
+        """Returns the lines start to stop (exclusive) as a new batch."""
+        widths = self.widths[start:stop] if self.widths is not None else None
+        return Columns([column[start:stop] for column in self.fields], widths)
+
+    def take(self, index: Sequence[int]) -> "Columns":
+        """Returns the lines at the given positions (a list or NumPy array of ints) as a new batch."""
+        if numpy is not None and isinstance(index, numpy.ndarray):
+            fields = [numpy.array(column, dtype=object)[index].tolist() for column in self.fields]
+        else:
+            fields = [[column[i] for i in index] for column in self.fields]
+        widths = [self.widths[i] for i in index] if self.widths is not None else None
+        return Columns(fields, widths)
+
+    def select(self, mask: Sequence[bool]) -> "Columns":
+        """Returns the lines for which mask (a list or NumPy array of bools) is true as a new batch."""
+        if numpy is not None and isinstance(mask, numpy.ndarray):
+            return self.take(numpy.flatnonzero(mask))
+        return self.take([i for i, keep in enumerate(mask) if keep])
+
+    def project(self, end_range: int) -> "Columns":
+        """Keeps only the fields up to end_range (exclusive), in place, like Line.project()."""
+        del self.fields[max(end_range, 0) :]
+        if self.widths is not None:
+            self.widths = [min(width, end_range) for width in self.widths]
+            if min(self.widths, default=end_range) == len(self.fields):
+                self.widths = None
+        return self
+
+    def lengths(self, i: int, unit: str = "tokens"):
+        """
+        Returns the lengths of the ith field of all lines, as a NumPy array (a list without NumPy):
+        in space-separated tokens (0 for an empty field), or in characters (unit="chars").
+        """
+        assert unit in ("tokens", "chars"), f"Unknown length unit {unit}"
+        column = self.fields[i]
+        if unit == "chars":
+            if numpy is None:
+                return [len(text) for text in column]
+            return numpy.fromiter(map(len, column), dtype=numpy.int64, count=len(column))
+        if numpy is None:
+            return [text.count(" ") + 1 if text else 0 for text in column]
+        if not column:
+            return numpy.zeros(0, dtype=numpy.int64)
+        # count the spaces of each line in the UTF-8 buffer of the whole column (fields have no newlines)
+        data = numpy.frombuffer("\n".join(column).encode("utf-8"), dtype=numpy.uint8)
+        ends = numpy.append(numpy.flatnonzero(data == 10), len(data))
+        spaces = numpy.concatenate(([0], numpy.cumsum(data == 32)))[ends]
+        tokens = numpy.diff(spaces, prepend=0) + 1
+        tokens[numpy.diff(ends, prepend=-1) == 1] = 0
+        return tokens
+
+    def to_strings(self) -> List[str]:
+        """The lines as tab-separated strings."""
+        if self.widths is None:
+            return ["\t".join(row) for row in zip(*self.fields)]
+        return ["\t".join(row[:width]) for row, width in zip(zip(*self.fields), self.widths)]
+
+    def to_lines(self) -> List[Line]:
+        """The lines as Line objects (with their fields exactly as they are in the batch)."""
+        return [
+            Line(text) if _is_clean(text) else Line(fields=text.split("\t")) for text in self.to_strings()
+        ]
+
+
+class PackedLines:
+    """
+    Lines packed into a single bytearray (UTF-8, one after the other) plus an array of offsets,
+    which takes a few bytes of overhead per line instead of the hundred or more of a Line object
+    and its strings. Line objects are created on access; iterating goes in the order given by
+    order if set (a permutation of the line numbers), else in the order the lines were added.
+    """
+
+    __slots__ = ("data", "offsets", "split", "order")
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.offsets = array("Q", [0])
+        # 1 for the lines that had been split into fields, which are recreated from their fields
+        self.split = bytearray()
+        self.order = None
+
+    def append(self, line) -> None:
+        """Adds a line (a Line or string)."""
+        if not isinstance(line, Line):
+            line = Line(line)
+        self.data += str(line).encode("utf-8")
+        self.offsets.append(len(self.data))
+        self.split.append(line._fields is not None)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """The memory taken by the lines and their offsets."""
+        return len(self.data) + self.offsets.itemsize * len(self.offsets) + len(self.split)
+
+    def __getitem__(self, i: int) -> Line:
+        """Returns the ith line added, as a Line."""
+        text = self.data[self.offsets[i] : self.offsets[i + 1]].decode("utf-8")
+        if self.split[i]:
+            return Line(fields=text.split("\t"))
+        # known to be clean: skip the checks of Line()
+        line = Line.__new__(Line)
+        line._raw = text
+        line._fields = None
+        return line
+
+    def __iter__(self) -> Iterator[Line]:
+        for i in range(len(self)) if self.order is None else self.order:
+            yield self[i]
@@ -2,9 +2,15 @@ import sys
 import re
 import logging
 
+from sotastream import Defaults
+from sotastream.data import Columns, numpy
+from sotastream.utils import metrics
+from sotastream.utils.profiling import stage
+
 logger = logging.getLogger(f"sotastream")
 
 
+@stage
 def SkipBlanks(lines, fields=[0, 1]):
     """
     Skips lines that are blank in any of the requested fields.
@@ -15,11 +21,13 @@ def SkipBlanks(lines, fields=[0, 1]):
     :param lines: The data stream
     :param fields: fields to check for blankness
     """
+    dropped = metrics.counter("sotastream_filter_dropped_total", filter="SkipBlanks")
     skipped_prev = False
     for line in lines:
         for fieldno in fields:
             if fieldno >= len(line) or line[fieldno] is None or line[fieldno] == "":
                 skipped_prev = True
+                dropped.value += 1
                 break
         else:
             # If we skipped the previous line, we invalidate the current document ID
@@ -30,6 +38,7 @@ def SkipBlanks(lines, fields=[0, 1]):
             yield line
 
 
+@stage
 def BitextFilter(lines, end_range=2):
     """
     Removes all fields up to end_range.
@@ -38,14 +47,59 @@ def BitextFilter(lines, end_range=2):
     :param end_range: One higher than the last 0-index field number that should be included.
     """
     for line in lines:
-        line.fields = line.fields[0:end_range]
-        yield line
+        yield line.project(end_range)
+
+
+def _length(text: str, unit: str) -> int:
+    if unit == "chars":
+        return len(text)
+    return text.count(" ") + 1 if text else 0
+
+
+def _lengths_ok(lengths, min_length, max_length, max_ratio) -> bool:
+    shortest, longest = min(lengths), max(lengths)
+    return (
+        shortest >= min_length
+        and longest <= max_length
+        and (max_ratio is None or longest <= max_ratio * max(shortest, 1))
+    )
+
+
+@stage
+def LengthFilter(
+    lines, min_length=1, max_length=Defaults.MAX_TOKENS, fields=[0, 1], unit="tokens", max_ratio=None
+):
+    """
+    Removes a line if one of the fields is shorter than min_length or longer than max_length,
+    or, if max_ratio is given, if the longest of the fields is more than max_ratio times as long as
+    the shortest.
+
+    :param lines: the stream of input lines
+    :param min_length: the minimum length of each field
+    :param max_length: the maximum length of each field
+    :param fields: the fields to check
+    :param unit: "tokens" (space-separated) or "chars"
+    :param max_ratio: the maximum ratio between the lengths of the fields (None: no limit)
+    """
+    dropped = metrics.counter("sotastream_filter_dropped_total", filter="LengthFilter")
+    for line in lines:
+        if len(line) <= max(fields):
+            logger.debug(f"LengthFilter: bad line: {line}")
+            dropped.value += 1
+            continue
+        if _lengths_ok([_length(line[field], unit) for field in fields], min_length, max_length, max_ratio):
+            yield line
+        else:
+            dropped.value += 1
 
 
+@stage
 def MatchFilter(lines, pattern=r'[\=\+\#\@\^\~\<\>]', fields=[0, 1], invert=False):
+    dropped = metrics.counter("sotastream_filter_dropped_total", filter="MatchFilter")
     for line in lines:
         if len(line) < 2:
             logger.debug(f"MatchFilter: bad line: {line}")
+            dropped.value += 1
             continue
 
         if len(fields) != 2:
@@ -57,18 +111,120 @@ def MatchFilter(lines, pattern=r'[\=\+\#\@\^\~\<\>]', fields=[0, 1], invert=Fals
         criterion = sorted(re.findall(pattern, f1)) == sorted(re.findall(pattern, f2))
         if (not invert and criterion) or (invert and not criterion):
             yield line
+        else:
+            dropped.value += 1
 
 
+@stage
 def RegexFilter(lines, pattern, fields=[0, 1], invert=False):
     """
     Removes a line if the pattern is found in one or more fields.
     """
     regex = re.compile(pattern)
+    dropped = metrics.counter("sotastream_filter_dropped_total", filter="RegexFilter")
     for line in lines:
         if len(line) < len(fields):
             logger.debug(f"RegexFilter: bad line: {line}")
+            dropped.value += 1
             continue
 
         founds = [regex.search(line[field]) for field in fields]
         if (not invert and not any(founds)) or (invert and all(founds)):
             yield line
+        else:
+            dropped.value += 1
+
+
+@stage(inputs="batches")
+def BatchSkipBlanks(batches, fields=[0, 1]):
+    """
+    Batch version of SkipBlanks: skips lines that are blank in any of the requested fields.
+    Unlike SkipBlanks, it checks the requested fields only (and leaves the fields argument as it is).
+
+    :param batches: The stream of batches
+    :param fields: fields to check for blankness
+    """
+    dropped = metrics.counter("sotastream_filter_dropped_total", filter="SkipBlanks")
+    fields = list(fields)
+    for batch in batches:
+        kept = []
+        for line in batch:
+            for fieldno in fields:
+                if fieldno >= len(line) or line[fieldno] is None or line[fieldno] == "":
+                    break
+            else:
+                kept.append(line)
+        dropped.value += len(batch) - len(kept)
+        yield kept
+
+
+@stage(inputs="batches")
+def BatchBitextFilter(batches, end_range=2):
+    """
+    Batch version of BitextFilter, for lists of lines or Columns: removes all fields from end_range on.
+    """
+    for batch in batches:
+        if isinstance(batch, Columns):
+            yield batch.project(end_range)
+            continue
+        for line in batch:
+            line.project(end_range)
+        yield batch
+
+
+@stage(inputs="batches")
+def BatchLengthFilter(
+    batches, min_length=1, max_length=Defaults.MAX_TOKENS, fields=[0, 1], unit="tokens", max_ratio=None
+):
+    """
+    Batch version of LengthFilter, for lists of lines or Columns. On Columns, the lengths of each
+    field are computed for the whole batch at once, and compared as NumPy arrays if NumPy is installed.
+    """
+    dropped = metrics.counter("sotastream_filter_dropped_total", filter="LengthFilter")
+    for batch in batches:
+        if not isinstance(batch, Columns):
+            kept = [
+                line
+                for line in batch
+                if len(line) > max(fields)
+                and _lengths_ok(
+                    [_length(line[field], unit) for field in fields], min_length, max_length, max_ratio
+                )
+            ]
+        elif numpy is not None:
+            lengths = numpy.stack([batch.lengths(field, unit) for field in fields])
+            if batch.widths is not None:
+                lengths[:, numpy.array(batch.widths) <= max(fields)] = -1  # bad lines
+            shortest, longest = lengths.min(axis=0), lengths.max(axis=0)
+            mask = (shortest >= min_length) & (longest <= max_length)
+            if max_ratio is not None:
+                mask &= longest <= max_ratio * numpy.maximum(shortest, 1)
+            kept = batch.select(mask)
+        else:
+            lengths = zip(*[batch.lengths(field, unit) for field in fields])
+            if batch.widths is not None:
+                lengths = [row if width > max(fields) else (-1,) for row, width in zip(lengths, batch.widths)]
+            kept = batch.select([_lengths_ok(row, min_length, max_length, max_ratio) for row in lengths])
+        dropped.value += len(batch) - len(kept)
+        yield kept
+
+
+@stage(inputs="batches")
+def BatchRegexFilter(batches, pattern, fields=[0, 1], invert=False):
+    """
+    Batch version of RegexFilter: removes a line if the pattern is found in one or more fields.
+    """
+    regex = re.compile(pattern)
+    dropped = metrics.counter("sotastream_filter_dropped_total", filter="RegexFilter")
+    num_fields = len(fields)
+    for batch in batches:
+        kept = []
+        for line in batch:
+            if len(line) < num_fields:
+                logger.debug(f"RegexFilter: bad line: {line}")
+                continue
+            founds = [regex.search(line[field]) for field in fields]
+            if (not invert and not any(founds)) or (invert and all(founds)):
+                kept.append(line)
+        dropped.value += len(batch) - len(kept)
+        yield kept
@@ -6,12 +6,17 @@ import os
 
 from sotastream import Defaults
 from sotastream.augmentors import DataSource, UTF8File
+from sotastream.data import Columns
 from sentencepiece import SentencePieceProcessor
-from typing import List, Tuple, Callable
+from typing import List, Tuple, Callable, Union
 
 logger = logging.getLogger(f"sotastream")
 
 
+def _as_lines(batch: Union[List, Columns]) -> List:
+    return batch.to_lines() if isinstance(batch, Columns) else batch
+
+
 class Pipeline(ABC):
     """Pipeline base class
 
@@ -23,6 +28,9 @@ class Pipeline(ABC):
         * Don't forget the @classmethod decorator and cls as first argument.
         * The filename should match the pattern {name}_pipeline.py, where {name} is the name used in the decorator.
     * All CLI arguments are passed as arguments to constrctor.
+    * The constructor sets either self.stream, a stream of lines, or self.batches, a stream of batches
+      (lists of lines, or sotastream.data.Columns) for pipelines built from batch stages. Either way,
+      the pipeline can be iterated line by line, or read with next_batch().
     * Refer to default.py or t1_pipeline.py for example pipelines.
     """
 
@@ -39,6 +47,11 @@ class Pipeline(ABC):
         self.sample_file = kwargs.get("sample_file")
         self.buffer_size = kwargs.get("buffer_size", Defaults.BUFFER_SIZE)
         self.queue_buffer_size = kwargs.get("queue_buffer_size", Defaults.QUEUE_BUFFER_SIZE)
+        self.prefetch_chunks = kwargs.get("prefetch_chunks", Defaults.PREFETCH_CHUNKS)
+        self.buffer_bytes = kwargs.get("buffer_bytes", Defaults.BUFFER_BYTES)
+        self.packed_buffer = kwargs.get("packed_buffer", Defaults.PACKED_BUFFER)
+        # data source path -> the passes over it after which it ends (see DataSource's max_epochs)
+        self.source_max_epochs = kwargs.get("source_max_epochs") or {}
         self.is_quiet = kwargs.get("quiet", Defaults.QUIET)
         self.seed = kwargs.get("seed", Defaults.SEED)
         self.max_tokens = kwargs.get("max_tokens", Defaults.MAX_TOKENS)
@@ -78,7 +91,12 @@ class Pipeline(ABC):
         )
         logger.info(mix_weight_message)
 
-        self.stream = None  # to be initialized in subclass
+        # To be initialized in subclass: either a stream of lines (self.stream), or a stream of
+        # batches, i.e. lists of lines (self.batches; see sotastream.augmentors.Batched)
+        self.stream = None
+        self.batches = None
+        self._pending = []  # lines of the current batch not yet returned
+        self._pending_pos = 0
 
     @classmethod
     def add_cli_args(cls, parser):
@@ -137,7 +155,11 @@ class Pipeline(ABC):
         )
 
     def create_data_stream(
-        self, data_path, processor: Callable = UTF8File, buffer_size: int = None, ext: str = ".gz"
+        self,
+        data_path,
+        processor: Callable = UTF8File,
+        buffer_size: int = None,
+        ext: Union[str, Tuple[str, ...]] = Defaults.SHARD_EXTENSIONS,
     ):
         """
         Wrapper around data source creation to allow for easy overriding in subclasses.
@@ -148,7 +170,7 @@ class Pipeline(ABC):
         :param data_path: Path to data source
         :param processor: Augmentor processor function to apply to each chunk
         :param buffer_size: The buffer size to use
-        :param ext: The extension of the data source
+        :param ext: The extension (or a tuple of extensions) of the data source's shards
         """
         return DataSource(
             data_path,
@@ -158,6 +180,10 @@ class Pipeline(ABC):
             seed=self.seed,
             worker_id=self.worker_id,
             num_workers=self.num_workers,
+            prefetch=self.prefetch_chunks,
+            buffer_bytes=self.buffer_bytes,
+            packed=self.packed_buffer,
+            max_epochs=self.source_max_epochs.get(str(data_path), 0),
         )
 
     @classmethod
@@ -192,7 +218,36 @@ class Pipeline(ABC):
         return self
 
     def __next__(self):
-        return next(self.stream)
+        if self.batches is None:
+            return next(self.stream)
+        while self._pending_pos >= len(self._pending):
+            self._pending = _as_lines(next(self.batches))
+            self._pending_pos = 0
+        self._pending_pos += 1
+        return self._pending[self._pending_pos - 1]
+
+    def next_batch(self, n: int) -> List:
+        """
+        Returns the next n lines as a list, or fewer at the end of the stream (an empty list once it is over).
+        Pipelines that produce batches hand them on without taking them apart line by line.
+
+        :param n: The number of lines
+        """
+        if self.batches is None:
+            return list(itertools.islice(self.stream, n))
+
+        # a new list, since the stages may still hold on to the batches they yielded
+        lines = self._pending[self._pending_pos :]
+        while len(lines) < n:
+            batch = next(self.batches, None)
+            if batch is None:
+                break
+            lines.extend(_as_lines(batch))
+        if len(lines) <= n:
+            self._pending, self._pending_pos = [], 0
+            return lines
+        self._pending, self._pending_pos = lines, n
+        return lines[:n]
 
     @staticmethod
     def create(name: str, *args, **kwargs):
@@ -4,7 +4,7 @@ from functools import partial
 
 from sotastream.augmentors import *
 from sotastream import Defaults
-from sotastream.filters import BitextFilter
+from sotastream.filters import BatchBitextFilter
 
 from . import DocumentPipeline, pipeline
 
@@ -22,7 +22,7 @@ class ExamplePipeline(DocumentPipeline):
         backtrans = self.create_data_stream(backtrans_data, processor=partial(ReadAndAugment, tag="<FR>"))
 
         stream = Mixer([parallel, backtrans], self.mix_weights)
-        self.stream = BitextFilter(stream)  # removes all but fields 0 and 1
+        self.batches = BatchBitextFilter(Batched(stream))  # removes all but fields 0 and 1
 
     @classmethod
     def get_data_sources_for_argparse(cls):
@@ -69,6 +69,7 @@ def ReadAndAugment(path: str, tag: str = None):
             TitleCase(stream),
         ],
         [0.95, 0.04, 0.01],
+        name="casing",
     )
 
     if tag is not None:
@@ -41,9 +41,20 @@ class MultiStreamPipeline(Pipeline):
         assert len(paths) == len(self.mix_weights)
         assert abs(1 - sum(self.mix_weights)) <= 1e-6, f'{self.mix_weights} = {sum(self.mix_weights)} != 1.0'
 
-        TsvChunkReader = functools.partial(DataSource, ext=ext, buffer_size=self.buffer_size, seed=self.seed)
+        TsvChunkReader = functools.partial(
+            DataSource,
+            ext=ext,
+            buffer_size=self.buffer_size,
+            seed=self.seed,
+            prefetch=self.prefetch_chunks,
+            buffer_bytes=self.buffer_bytes,
+            packed=self.packed_buffer,
+        )
         logger.info('Mixing data from paths:\n * ' + '\n * '.join([str(path) for path in paths]))
-        streams = [TsvChunkReader(path, processChunk=UTF8File) for path in paths]
+        streams = [
+            TsvChunkReader(path, processChunk=UTF8File, max_epochs=self.source_max_epochs.get(str(path), 0))
+            for path in paths
+        ]
         if len(paths) == 1:
             pipeline = streams[0]
         else:
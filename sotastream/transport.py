@@ -0,0 +1,262 @@
+"""
+Transports used to move batches of lines from the pipeline worker processes
+to the parent process (see sotastream.cli).
+
+Batches travel as frames (see encode_batch()): a small header followed by the
+newline-terminated UTF-8 lines, ready to be written to the output as is. Workers
+also send their metrics as frames from time to time (see encode_metrics()).
+
+Each worker owns one transport. The worker (producer) side calls send() and close_writer(),
+and the parent (consumer) side calls recv(), which raises EOFError once the worker
+has closed its end, and release() once it is done with the received frame.
+"""
+
+import logging
+import struct
+import time
+
+from collections import Counter, namedtuple
+from multiprocessing import Pipe
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Union
+
+from . import Defaults
+
+logger = logging.getLogger(f"sotastream")
+
+# frame kinds: a batch of lines, or a snapshot of the worker's metrics (see sotastream.utils.metrics)
+BATCH, METRICS = 0, 1
+# frame kind, number of lines, number of tokens, number of field-count histogram entries
+FRAME_HEADER = struct.Struct("<BIII")
+# number of fields, number of lines with that many fields
+FRAME_HISTOGRAM_ENTRY = struct.Struct("<II")
+
+Frame = namedtuple("Frame", ["kind", "num_lines", "num_tokens", "num_fields", "payload"])
+
+
+def encode_batch(lines: List[str]) -> bytes:
+    """
+    Encodes a batch of lines as a single frame. The payload is the newline-terminated
+    lines, encoded as UTF-8 in one go; the header carries the number of lines, the
+    (approximate) number of whitespace-separated tokens, and a histogram of the number
+    of (tab-separated) fields per line.
+
+    :param lines: The lines (without trailing newlines)
+    :return: The frame
+    """
+    num_fields = Counter(line.count("\t") + 1 for line in lines)
+    payload = ("\n".join(lines) + "\n").encode("utf-8")
+    num_tokens = payload.count(b" ") + payload.count(b"\t") + len(lines) - lines.count("")
+    header = [FRAME_HEADER.pack(BATCH, len(lines), num_tokens, len(num_fields))]
+    header.extend(FRAME_HISTOGRAM_ENTRY.pack(n, count) for n, count in num_fields.items())
+    return b"".join(header) + payload
+
+
+def encode_metrics(data: bytes) -> bytes:
+    """
+    Encodes a metrics snapshot (see sotastream.utils.metrics.encode_snapshot) as a frame.
+    """
+    return FRAME_HEADER.pack(METRICS, 0, 0, 0) + data
+
+
+def decode_frame(frame: Union[bytes, memoryview]) -> Frame:
+    """
+    Splits a frame created by encode_batch() or encode_metrics() without copying the payload.
+
+    :param frame: The frame
+    :return: The kind of frame, the number of lines and tokens, the field-count histogram, and the payload
+    """
+    frame = memoryview(frame)
+    kind, num_lines, num_tokens, num_entries = FRAME_HEADER.unpack_from(frame)
+    payload_start = FRAME_HEADER.size + num_entries * FRAME_HISTOGRAM_ENTRY.size
+    num_fields = dict(FRAME_HISTOGRAM_ENTRY.iter_unpack(frame[FRAME_HEADER.size : payload_start]))
+    return Frame(kind, num_lines, num_tokens, num_fields, frame[payload_start:])
+
+
+class FixedBatchSize:
+    """
+    Sends batches of a fixed number of lines.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def update(self, num_lines: int, num_bytes: int, elapsed: float):
+        pass
+
+
+class AdaptiveBatchSize:
+    """
+    Chooses the number of lines per batch such that a frame is about target_bytes long,
+    but filling it takes no longer than max_latency seconds. It starts with small batches,
+    for a quick first line, and at most doubles from one batch to the next, while it shrinks
+    right away when lines get longer or slower to produce.
+    """
+
+    INITIAL_SIZE = 16
+
+    def __init__(
+        self,
+        target_bytes: int = Defaults.BATCH_BYTES,
+        max_latency: float = Defaults.BATCH_LATENCY,
+        max_size: int = Defaults.BUFFER_SIZE,
+    ):
+        self.target_bytes = target_bytes
+        self.max_latency = max_latency
+        self.max_size = max_size
+        self.size = min(self.INITIAL_SIZE, max_size)
+
+    def update(self, num_lines: int, num_bytes: int, elapsed: float):
+        """
+        Updates the size from the last batch.
+
+        :param num_lines: The number of lines in the last batch
+        :param num_bytes: The size of its frame
+        :param elapsed: The time it took to produce its lines
+        """
+        limit = min(self.max_size, self.target_bytes * num_lines / max(num_bytes, 1))
+        if elapsed > 0:
+            limit = min(limit, self.max_latency * num_lines / elapsed)
+        self.size = max(1, min(int(limit), self.size * 2))
+
+
+class PipeTransport:
+    """
+    Sends frames over a multiprocessing.Pipe.
+    """
+
+    name = "pipe"
+
+    def __init__(self, **kwargs):
+        self.reader, self.writer = Pipe(duplex=False)
+
+    def send(self, frame: bytes):
+        self.writer.send_bytes(frame)
+
+    def recv(self) -> bytes:
+        return self.reader.recv_bytes()
+
+    def release(self):
+        """Called by the parent when it is done with the last received frame."""
+        pass
+
+    def close_writer(self):
+        """Called by the worker when it is done producing."""
+        self.writer.close()
+
+    def close(self):
+        """Called by the parent when it is done consuming."""
+        self.reader.close()
+
+
+class SharedMemoryTransport:
+    """
+    A single-producer, single-consumer ring buffer in a multiprocessing.shared_memory block.
+
+    The worker copies each frame into the ring, and the parent reads it in place, straight
+    out of the shared memory. Only a small fixed-size notice (position and length of the frame)
+    travels over a pipe, which is also what the parent blocks on while waiting for data.
+
+    The first bytes of the shared memory hold two monotonically increasing byte counters: how far
+    the worker has written and how far the parent has consumed. A frame never wraps around the end
+    of the ring; if it does not fit, the writer skips ahead to the start of the ring. Frames larger
+    than the whole ring are sent inline over the pipe instead.
+    """
+
+    name = "shm"
+
+    # write position, read position
+    HEADER = struct.Struct("<QQ")
+    HEADER_SIZE = 64
+    # absolute start position and length of a frame
+    NOTICE = struct.Struct("<QQ")
+    # start position value that marks a frame sent inline over the pipe
+    INLINE = 2**64 - 1
+
+    def __init__(self, size: int = Defaults.SHM_SIZE, **kwargs):
+        self.capacity = size
+        self.shm = SharedMemory(create=True, size=self.HEADER_SIZE + size)
+        self.HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        self.reader, self.writer = Pipe(duplex=False)
+        self._block = None
+        self._release_pos = None
+
+    def _positions(self):
+        return self.HEADER.unpack_from(self.shm.buf, 0)
+
+    def send(self, frame: bytes):
+        length = len(frame)
+        if length > self.capacity:
+            logger.debug(f"Frame of {length:,} bytes exceeds the shared memory ring; sending over the pipe")
+            self.writer.send_bytes(self.NOTICE.pack(self.INLINE, length) + frame)
+            return
+
+        write_pos, read_pos = self._positions()
+        offset = write_pos % self.capacity
+        start = write_pos if offset + length <= self.capacity else write_pos + self.capacity - offset
+        end = start + length
+
+        # Wait until the parent has consumed enough of the ring (or all of it, since
+        # the padding skipped at the end of the ring never needs to be consumed)
+        delay = 0.0005
+        while end - read_pos > self.capacity and read_pos != write_pos:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+            _, read_pos = self._positions()
+
+        offset = self.HEADER_SIZE + start % self.capacity
+        self.shm.buf[offset : offset + length] = frame
+        struct.pack_into("<Q", self.shm.buf, 0, end)
+        self.writer.send_bytes(self.NOTICE.pack(start, length))
+
+    def recv(self) -> memoryview:
+        """
+        Returns a view of the next frame. It stays valid until release() is called.
+        """
+        notice = self.reader.recv_bytes()
+        start, length = self.NOTICE.unpack_from(notice)
+        if start == self.INLINE:
+            return memoryview(notice)[self.NOTICE.size :]
+
+        offset = self.HEADER_SIZE + start % self.capacity
+        self._block = self.shm.buf[offset : offset + length]
+        self._release_pos = start + length
+        return self._block
+
+    def release(self):
+        """Hands the space of the last received frame back to the worker."""
+        if self._block is not None:
+            self._block.release()
+            self._block = None
+            struct.pack_into("<Q", self.shm.buf, 8, self._release_pos)
+
+    def close_writer(self):
+        self.writer.close()
+        self.shm.close()
+
+    def close(self):
+        self.reader.close()
+        self.release()
+        try:
+            self.shm.close()
+        except BufferError:
+            # views of the last frame are still referenced; the mapping goes away with them
+            pass
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+TRANSPORTS = {
+    PipeTransport.name: PipeTransport,
+    SharedMemoryTransport.name: SharedMemoryTransport,
+}
+
+
+def create_transport(name: str, **kwargs):
+    """
+    Create the parent/worker transport with the given name (see TRANSPORTS).
+    """
+    assert name in TRANSPORTS, f"No transport with name {name} found"
+    return TRANSPORTS[name](**kwargs)
@@ -0,0 +1,301 @@
+"""
+Management of the split cache: the directories under --split-tmpdir that data files are split
+into (see sotastream.utils.split.split_file_into_chunks()).
+
+Each directory records when it was last used, and is held (with a shared lock on it) by the
+processes streaming from it until they exit. With a size budget (--split-cache-size), the least
+recently used directories that are not in use are removed once a new split takes the cache over
+it. `sotastream cache list|prune|verify` lists, removes, and checks them.
+
+Next to each directory is the lock file that processes splitting into it hold (see lock()),
+which is never removed, since a process may be about to take it. Other files and directories
+under --split-tmpdir are left alone.
+"""
+
+import argparse
+import datetime
+import fcntl
+import logging
+import os
+import re
+import shutil
+import time
+
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Union
+
+from sotastream.utils import indexed, manifest
+from sotastream.utils.compression import EXTENSIONS
+
+logger = logging.getLogger(f"sotastream")
+
+# Next to each split directory: the lock held while splitting into it, and the temporary directories
+# it is split into
+LOCK_SUFFIX = ".lock"
+TMP_SUFFIX = ".tmp."
+
+# The names of split directories (see sotastream.utils.split.split_file_into_chunks()): the
+# fingerprint or MD5 checksum of the file, the codec of the chunks unless gzip, and the suffix of a
+# temporary directory
+ENTRY_NAME = re.compile(
+    r"(fp-)?[0-9a-f]{32}"
+    + rf"(\.({'|'.join(list(EXTENSIONS) + [indexed.CODEC])}))?"
+    + rf"({re.escape(TMP_SUFFIX)}\d+(\.\w+)?)?"
+)
+
+# The file in a split directory whose modification time is its last use
+LAST_USED_FILE = ".last_used"
+
+# The directories held by this process (see hold())
+HELD = []
+
+
+class CacheEntry(NamedTuple):
+    path: Path
+    bytes: int
+    last_used: float
+    # e.g., an interrupted split, or one still in its temporary directory
+    unfinished: bool
+
+
+def lock(path: Union[str, Path], blocking: bool = True, shared: bool = False) -> Optional[int]:
+    """
+    Takes a lock on a file or directory (creating a file if need be), exclusive unless shared, and
+    returns its file descriptor, which holds the lock until it is closed, or None if not blocking
+    and the lock is held elsewhere. Processes forked while it is open hold the lock too.
+    """
+    if os.path.isdir(path):
+        fd = os.open(path, os.O_RDONLY)
+    else:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    try:
+        fcntl.flock(fd, operation if blocking else operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def touch(dirpath: Union[str, Path]):
+    """Records that a split directory is used now."""
+    Path(dirpath, LAST_USED_FILE).touch()
+
+
+def hold(dirpath: Union[str, Path]) -> bool:
+    """
+    Marks a split directory as in use by this process (and the processes forked from it) until it
+    exits, so that it is not removed from the cache, and records its use. Returns False if it has
+    been removed.
+    """
+    try:
+        fd = lock(dirpath, shared=True)
+    except FileNotFoundError:
+        return False
+    # removed (and maybe split again) while waiting for the lock
+    try:
+        removed = os.stat(dirpath).st_ino != os.fstat(fd).st_ino
+    except FileNotFoundError:
+        removed = True
+    if removed:
+        os.close(fd)
+        return False
+    HELD.append(fd)
+    touch(dirpath)
+    return True
+
+
+def release():
+    """Releases the directories held by this process (see hold())."""
+    while HELD:
+        os.close(HELD.pop())
+
+
+def entries(cache_dir: Union[str, Path]) -> List[CacheEntry]:
+    """The split directories in the cache (see ENTRY_NAME), least recently used first."""
+    result = []
+    if not os.path.isdir(cache_dir):
+        return result
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir() or not ENTRY_NAME.fullmatch(entry.name):
+            continue
+        path = Path(entry.path)
+        last_used = path / LAST_USED_FILE
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(path) if f.is_file())
+            last_used = (last_used if last_used.exists() else path).stat().st_mtime
+        except FileNotFoundError:
+            # just removed
+            continue
+        unfinished = TMP_SUFFIX in path.name or not (path / ".done").exists()
+        result.append(CacheEntry(path, size, last_used, unfinished))
+    return sorted(result, key=lambda entry: entry.last_used)
+
+
+def _split_lock_path(dirpath: Path) -> Path:
+    return dirpath.parent / f"{dirpath.name.split(TMP_SUFFIX)[0]}{LOCK_SUFFIX}"
+
+
+def is_splitting(dirpath: Path) -> bool:
+    """Whether a process is splitting into a directory of the cache."""
+    fd = lock(_split_lock_path(dirpath), blocking=False)
+    if fd is None:
+        return True
+    os.close(fd)
+    return False
+
+
+def remove_unused(dirpath: Union[str, Path]) -> bool:
+    """
+    Removes a split directory unless it is in use (see hold()), for a process that holds the lock of
+    its split. Returns whether it did.
+    """
+    use_lock = lock(dirpath, blocking=False)
+    if use_lock is None:
+        return False
+    try:
+        shutil.rmtree(dirpath)
+    finally:
+        os.close(use_lock)
+    return True
+
+
+def remove(entry: CacheEntry) -> bool:
+    """Removes a directory from the cache, unless it is in use or being split. Returns whether it did."""
+    split_lock = lock(_split_lock_path(entry.path), blocking=False)
+    if split_lock is None:
+        return False
+    try:
+        return remove_unused(entry.path)
+    finally:
+        os.close(split_lock)
+
+
+def evict(cache_dir: Union[str, Path], max_bytes: int) -> List[CacheEntry]:
+    """
+    Removes the least recently used directories that are not in use from the cache until it takes
+    at most max_bytes (if it can), and returns them.
+    """
+    cached = entries(cache_dir)
+    total = sum(entry.bytes for entry in cached)
+    removed = []
+    for entry in cached:
+        if total <= max_bytes:
+            break
+        if remove(entry):
+            logger.info(f"Removed {entry.path} ({entry.bytes:,} bytes) from the split cache")
+            total -= entry.bytes
+            removed.append(entry)
+    if total > max_bytes:
+        logger.warning(
+            f"The split cache {cache_dir} still takes {total:,} bytes, over its budget of {max_bytes:,}, "
+            "since the rest is in use"
+        )
+    return removed
+
+
+def verify(dirpath: Union[str, Path]) -> List[str]:
+    """Checks the shards of a split directory against its manifest, and returns the problems found."""
+    shards = manifest.read_manifest(str(dirpath))
+    if shards is None:
+        return ["no manifest"]
+    problems = []
+    for shard in shards:
+        path = os.path.join(dirpath, shard.name)
+        if not os.path.exists(path):
+            problems.append(f"{shard.name} is missing")
+        elif os.path.getsize(path) != shard.bytes:
+            problems.append(f"{shard.name} has {os.path.getsize(path):,} bytes, not {shard.bytes:,}")
+        elif manifest.shard_md5(path) != shard.md5:
+            problems.append(f"{shard.name} has a different checksum")
+    return problems
+
+
+def main(argv: List[str] = None):
+    """Manages the split cache: `sotastream cache {list,prune,verify}`."""
+    # imported here, since the CLI imports this module
+    from sotastream.cli import USER, parse_size
+    from sotastream.utils.split import MD5_FILE, verify_split
+
+    parser = argparse.ArgumentParser(prog="sotastream cache", description="Manages the split cache")
+    parser.add_argument(
+        "--split-tmpdir",
+        default=f"/tmp/sotastream-{USER}",
+        help="The split cache directory (default: %(default)s)",
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    commands.add_parser("list", help="List the split directories, least recently used first")
+    prune = commands.add_parser(
+        "prune", help="Remove unfinished split directories, and others as requested, unless in use"
+    )
+    prune.add_argument(
+        "--max-size", type=parse_size, metavar="SIZE", help="Remove the least recently used until within SIZE"
+    )
+    prune.add_argument("--older-than", type=float, metavar="DAYS", help="Remove those unused for DAYS days")
+    prune.add_argument("--all", action="store_true", help="Remove all")
+    check = commands.add_parser(
+        "verify", help="Check the shards of split directories against their manifests"
+    )
+    check.add_argument("names", nargs="*", help="The directories to check (default: all)")
+    check.add_argument(
+        "--source",
+        action="store_true",
+        help="Also check the MD5 checksums of the files they were split from, where recorded",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    cached = entries(args.split_tmpdir)
+    if args.command == "list":
+        print(f"{'last used':<19}  {'size':>15}  {'lines':>15}  {'status':<10}  directory (source)")
+        for entry in cached:
+            shards = manifest.read_manifest(str(entry.path)) if not entry.unfinished else None
+            lines = f"{sum(shard.lines for shard in shards):,}" if shards is not None else "-"
+            if is_splitting(entry.path):
+                status = "splitting"
+            elif not entry.unfinished:
+                status = "ready"
+            else:
+                status = "unfinished"
+            last_used = datetime.datetime.fromtimestamp(entry.last_used).strftime("%Y-%m-%d %H:%M:%S")
+            source = manifest.source_of(str(entry.path))
+            print(
+                f"{last_used:<19}  {entry.bytes:>15,}  {lines:>15}  {status:<10}  {entry.path.name}"
+                + (f" ({source})" if source else "")
+            )
+        print(f"{len(cached)} directories, {sum(entry.bytes for entry in cached):,} bytes")
+
+    elif args.command == "prune":
+        min_last_used = time.time() - args.older_than * 86400 if args.older_than is not None else None
+        for entry in cached:
+            if (
+                args.all
+                or entry.unfinished
+                or (min_last_used is not None and entry.last_used < min_last_used)
+            ):
+                if remove(entry):
+                    logger.info(f"Removed {entry.path} ({entry.bytes:,} bytes)")
+                else:
+                    logger.info(f"Kept {entry.path}, which is in use")
+        if args.max_size is not None:
+            evict(args.split_tmpdir, args.max_size)
+
+    elif args.command == "verify":
+        failed = 0
+        for entry in cached:
+            if args.names and entry.path.name not in args.names:
+                continue
+            problems = verify(entry.path) if not entry.unfinished else ["unfinished"]
+            source = manifest.source_of(str(entry.path))
+            if not problems and args.source and source and (entry.path / MD5_FILE).exists():
+                if not os.path.exists(source):
+                    logger.info(f"{entry.path}: the source {source} no longer exists")
+                elif not verify_split(source, entry.path):
+                    problems.append(f"split from a file other than {source}")
+            for problem in problems:
+                logger.error(f"{entry.path}: {problem}")
+            if not problems:
+                logger.info(f"{entry.path}: OK")
+            failed += bool(problems)
+        return 1 if failed else 0
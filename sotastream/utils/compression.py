@@ -0,0 +1,138 @@
+"""
+Reading and writing compressed files: gzip (.gz), Zstandard (.zst), and LZ4 (.lz4).
+
+Gzip uses the standard library. Zstandard and LZ4 use the `zstandard` and `lz4` Python
+packages if they are installed, and otherwise the `zstd` and `lz4` command line tools.
+"""
+
+import gzip
+import io
+import shutil
+import subprocess
+
+from pathlib import Path
+from typing import Union
+
+# codec name -> file extension
+EXTENSIONS = {
+    "gz": ".gz",
+    "zst": ".zst",
+    "lz4": ".lz4",
+}
+
+# codec name -> (decompression command, compression command), for use in shell pipelines
+COMMANDS = {
+    "gz": ("pigz -cd", "pigz"),
+    "zst": ("zstd -qcd", "zstd -q"),
+    "lz4": ("lz4 -qcd", "lz4 -q"),
+}
+
+
+def codec_of(path: Union[str, Path]) -> str:
+    """Returns the name of the codec of a file, from its extension, or None if it is not compressed."""
+    path = str(path)
+    for codec, ext in EXTENSIONS.items():
+        if path.endswith(ext):
+            return codec
+    return None
+
+
+def is_compressed(path: Union[str, Path]) -> bool:
+    return codec_of(path) is not None
+
+
+class _CommandFile(io.RawIOBase):
+    """
+    A binary file read from the output of, or written to the input of, a (de)compression command.
+    """
+
+    def __init__(self, command, path, mode):
+        super().__init__()
+        self.mode = mode
+        if mode == "rb":
+            self.process = subprocess.Popen(command + ["-c", str(path)], stdout=subprocess.PIPE)
+            self.pipe = self.process.stdout
+        else:
+            self.outfh = open(path, "wb")
+            self.process = subprocess.Popen(command + ["-c"], stdin=subprocess.PIPE, stdout=self.outfh)
+            self.pipe = self.process.stdin
+
+    def readable(self):
+        return self.mode == "rb"
+
+    def writable(self):
+        return self.mode == "wb"
+
+    def readinto(self, buffer):
+        return self.pipe.readinto(buffer)
+
+    def write(self, data):
+        return self.pipe.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        reading = self.mode == "rb"
+        # when reading, the command may still be writing; stop it rather than waiting for it
+        if reading and self.process.poll() is None:
+            self.process.kill()
+        self.pipe.close()
+        returncode = self.process.wait()
+        if not reading:
+            self.outfh.close()
+        super().close()
+        if returncode != 0 and not (reading and returncode < 0):
+            raise IOError(f"{self.process.args[0]} failed with exit code {returncode}")
+
+
+def _open_zst(path, mode):
+    try:
+        import zstandard
+    except ImportError:
+        return _open_command("zstd", path, mode)
+    return zstandard.open(path, mode)
+
+
+def _open_lz4(path, mode):
+    try:
+        import lz4.frame
+    except ImportError:
+        return _open_command("lz4", path, mode)
+    return lz4.frame.open(path, mode)
+
+
+def _open_command(tool, path, mode):
+    if shutil.which(tool) is None:
+        raise RuntimeError(
+            f"Reading or writing {path} requires the {tool} Python package or command line tool"
+        )
+    command = [tool, "-q"] + (["-d"] if mode == "rb" else [])
+    if mode == "rb":
+        return io.BufferedReader(_CommandFile(command, path, mode))
+    return io.BufferedWriter(_CommandFile(command, path, mode))
+
+
+_OPENERS = {
+    "gz": gzip.open,
+    "zst": _open_zst,
+    "lz4": _open_lz4,
+}
+
+
+def open_compressed(path: Union[str, Path], mode: str = "rb", compresslevel: int = None):
+    """
+    Opens a file in binary mode ("rb" or "wb"), (de)compressing it according to its extension.
+    Files with other extensions are opened as they are.
+
+    :param path: The file path
+    :param mode: "rb" or "wb"
+    :param compresslevel: The gzip compression level when writing (default: gzip's default)
+    :return: a binary file object
+    """
+    assert mode in ("rb", "wb"), f"Unsupported mode {mode}"
+    codec = codec_of(path)
+    if codec is None:
+        return open(path, mode)
+    if codec == "gz" and compresslevel is not None:
+        return gzip.open(path, mode, compresslevel=compresslevel)
+    return _OPENERS[codec](path, mode)
@@ -0,0 +1,220 @@
+"""
+Indexed shards: an uncompressed shard format with random access to its lines.
+
+A shard (part.NNNNN.sidx) holds the UTF-8 encoded lines one after the other, each followed by
+a newline, and then an index of where each line starts. It is read through mmap, so a line
+is only decoded when it is needed, and all processes reading a shard share the OS page cache.
+This lets a data source shuffle a shard by permuting line numbers instead of holding a
+shuffle buffer full of lines (see IndexedShardIterator).
+
+Layout (integers are unsigned 64-bit little-endian):
+
+    MAGIC
+    line 0 \\n line 1 \\n ... line N-1 \\n
+    offsets of lines 0 to N-1, plus the offset of the index itself (N + 1 integers)
+    N, the offset of the index, MAGIC
+"""
+
+import mmap
+import os
+import random
+import struct
+import sys
+
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from infinibatch.iterators import CheckpointableIterator
+
+from .sharding import ShardPart
+
+# the name of the format where shard codecs are chosen (e.g., sotastream --shard-codec)
+CODEC = "indexed"
+EXTENSION = ".sidx"
+MAGIC = b"SSIDX001"
+TRAILER = struct.Struct("<QQ8s")
+
+
+def is_indexed(path: Union[str, Path]) -> bool:
+    return str(path).endswith(EXTENSION)
+
+
+class IndexedShardWriter:
+    """
+    Writes an indexed shard, line by line. The shard is written to a temporary file,
+    which is renamed to path when it is closed, so a shard that exists is complete.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = str(path)
+        self.tmp_path = f"{self.path}.tmp"
+        self.outfh = open(self.tmp_path, "wb")
+        self.outfh.write(MAGIC)
+        self.offsets = array("Q", [len(MAGIC)])
+
+    def write(self, line: str):
+        data = line.encode("utf-8") + b"\n"
+        self.outfh.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self):
+        if self.outfh.closed:
+            return
+        num_lines = len(self.offsets) - 1
+        index_pos = self.offsets[-1]
+        if sys.byteorder == "big":
+            self.offsets.byteswap()
+        self.outfh.write(self.offsets.tobytes())
+        self.outfh.write(TRAILER.pack(num_lines, index_pos, MAGIC))
+        self.outfh.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_indexed(path: Union[str, Path], lines: Iterable[str]) -> int:
+    """Writes lines to an indexed shard and returns their number."""
+    with IndexedShardWriter(path) as writer:
+        for line in lines:
+            writer.write(line)
+    return len(writer.offsets) - 1
+
+
+class IndexedShard:
+    """
+    A memory-mapped indexed shard: shard[i] decodes and returns the ith line.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = str(path)
+        with open(self.path, "rb") as infh:
+            self.mm = mmap.mmap(infh.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.mm)
+        if size < len(MAGIC) + TRAILER.size or self.mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not an indexed shard")
+        self.num_lines, index_pos, magic = TRAILER.unpack_from(self.mm, size - TRAILER.size)
+        if magic != MAGIC or index_pos + 8 * (self.num_lines + 1) + TRAILER.size != size:
+            raise ValueError(f"{self.path} is truncated or corrupt")
+        index = memoryview(self.mm)[index_pos : index_pos + 8 * (self.num_lines + 1)]
+        if sys.byteorder == "little":
+            # not copied: the index stays in the page cache, like the lines
+            self.offsets = index.cast("Q")
+        else:
+            self.offsets = array("Q", index)
+            self.offsets.byteswap()
+            index.release()
+
+    def __len__(self):
+        return self.num_lines
+
+    def __getitem__(self, i: int) -> str:
+        # without the newline
+        return str(self.mm[self.offsets[i] : self.offsets[i + 1] - 1], "utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self.num_lines):
+            yield self[i]
+
+    def close(self):
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        self.mm.close()
+
+
+class IndexedShardIterator(CheckpointableIterator):
+    """
+    Reads the lines of indexed shards, pass after pass (an infinite iterator). With shuffling,
+    each pass reads the shards in a random order, and the lines of each shard in a random
+    permutation, so that no shuffle buffer is needed. The random orders depend on the seed,
+    the pass, and the shard's file name only, so they are reproducible and can be checkpointed
+    as (pass, shard, line) positions. A part of a shard (see sotastream.utils.sharding) is read as
+    a permutation of its line range.
+    """
+
+    def __init__(
+        self,
+        paths: List[Union[str, ShardPart]],
+        seed: int = 0,
+        shuffle: bool = True,
+        num_instances: int = 1,
+        instance_rank: int = 0,
+    ):
+        """
+        :param paths: The shards, or parts of shards
+        :param seed: The random seed
+        :param shuffle: Whether to shuffle shards and lines (otherwise both are read in order)
+        :param num_instances: The number of instances (e.g., MPI ranks) reading the shards
+        :param instance_rank: The instance this is; it reads every num_instances-th shard
+        """
+        parts = sorted(path if isinstance(path, ShardPart) else ShardPart(path) for path in paths)
+        if len(parts) >= num_instances:
+            parts = parts[instance_rank::num_instances]
+        self._parts = parts
+        self._seed = seed
+        self._shuffle = shuffle
+        self._shard = None
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        return {"epoch": self._epoch, "shard": self._shard_pos, "line": self._line_pos}
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        self._close_shard()
+        checkpoint = checkpoint or {"epoch": 0, "shard": 0, "line": 0}
+        self._epoch = checkpoint["epoch"]
+        self._shard_pos = checkpoint["shard"]
+        self._line_pos = checkpoint["line"]
+        self._shard_order = None
+        # whether the current pass has found any lines so far (to end if all shards are empty)
+        self._found_lines = self._shard_pos > 0 or self._line_pos > 0
+
+    def _open_shard(self):
+        if self._shard_order is None:
+            self._shard_order = list(self._parts)
+            if self._shuffle:
+                random.Random(f"{self._seed}.{self._epoch}").shuffle(self._shard_order)
+        part = self._shard_order[self._shard_pos]
+        self._shard = IndexedShard(part.path)
+        line_range = part.line_range(len(self._shard))
+        self._found_lines = self._found_lines or len(line_range) > 0
+        self._permutation = array("I" if len(self._shard) < 2**32 else "Q", line_range)
+        if self._shuffle:
+            name = os.path.basename(part.path)
+            if part.num_parts > 1:
+                name = f"{name}.{part.part}"
+            random.Random(f"{self._seed}.{self._epoch}.{name}").shuffle(self._permutation)
+
+    def _close_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+            self._permutation = None
+
+    def __next__(self) -> str:
+        if not self._parts:
+            raise StopIteration
+        while True:
+            if self._shard is None:
+                self._open_shard()
+            if self._line_pos < len(self._permutation):
+                line = self._shard[self._permutation[self._line_pos]]
+                self._line_pos += 1
+                return line
+            self._close_shard()
+            self._line_pos = 0
+            self._shard_pos += 1
+            if self._shard_pos == len(self._parts):
+                if not self._found_lines:
+                    raise StopIteration
+                self._epoch += 1
+                self._shard_pos = 0
+                self._shard_order = None
+                self._found_lines = False
+
+    def close(self):
+        self._close_shard()
@@ -0,0 +1,181 @@
+"""
+Shard manifests: a manifest.json next to the shards of a data directory, listing each shard's
+name, line count, size in bytes, MD5 checksum, and codec.
+
+Splitting writes one (see sotastream.utils.split), and `sotastream manifest DIR...` writes one
+for directories that were split otherwise. A data source with a manifest does not need to
+list its directory, which is slow with tens of thousands of shards, and knows how many lines
+each shard has, for assigning shards to workers (see sotastream.utils.sharding) and for
+reporting progress through the data. A manifest describes the directory as it was when it
+was written: rewrite it after adding or removing shards.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from sotastream import Defaults
+from sotastream.utils import indexed
+from sotastream.utils.compression import codec_of
+
+logger = logging.getLogger(f"sotastream")
+
+NAME = "manifest.json"
+VERSION = 1
+
+# The block size to read shards in when computing their checksums
+READ_BLOCK_SIZE = 1 << 20
+
+
+class ShardInfo(NamedTuple):
+    name: str
+    lines: int
+    bytes: int
+    md5: str
+    codec: str
+
+
+def shard_codec(path: str) -> str:
+    """The codec of a shard: a compression (e.g., gz), indexed, or plain."""
+    if indexed.is_indexed(path):
+        return indexed.CODEC
+    return codec_of(path) or "plain"
+
+
+def shard_md5(path: str) -> str:
+    """The MD5 checksum of a shard (of the file, as compressed)."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as infh:
+        while block := infh.read(READ_BLOCK_SIZE):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def shard_info(path: str) -> ShardInfo:
+    """Reads a shard to count its lines and compute its checksum."""
+    # imported here, since the augmentors import this module
+    from sotastream.augmentors import UTF8File
+
+    if indexed.is_indexed(path):
+        shard = indexed.IndexedShard(path)
+        num_lines = len(shard)
+        shard.close()
+    else:
+        # the lines as data sources read them
+        num_lines = sum(1 for _ in UTF8File(path))
+    return ShardInfo(
+        os.path.basename(path), num_lines, os.path.getsize(path), shard_md5(path), shard_codec(path)
+    )
+
+
+def list_shards(dirpath: str, ext: Union[str, Tuple[str, ...]] = Defaults.SHARD_EXTENSIONS) -> List[str]:
+    """The shards in a directory, sorted by name."""
+    return sorted(entry.path for entry in os.scandir(dirpath) if entry.is_file() and entry.name.endswith(ext))
+
+
+def write_manifest(
+    dirpath: str,
+    shards: Optional[Iterable[ShardInfo]] = None,
+    source: str = None,
+    complete: bool = True,
+    abandoned: bool = False,
+    processes: int = 1,
+) -> List[ShardInfo]:
+    """
+    Writes the manifest of a directory, and returns its shards.
+
+    :param dirpath: The directory
+    :param shards: The shards, if already known (default: read every shard in the directory)
+    :param source: The file the shards were split from, if any
+    :param complete: False for the progress manifest of a directory that is still being split,
+        which lists the shards written so far (see is_complete())
+    :param abandoned: True (with complete False) for a directory whose split was stopped before the
+        end, so that it will never be complete (see is_abandoned())
+    :param processes: The number of processes to read the shards with, if not known
+    """
+    if shards is None:
+        paths = list_shards(dirpath)
+        if processes > 1 and len(paths) > 1:
+            with ProcessPoolExecutor(max_workers=min(processes, len(paths))) as pool:
+                shards = list(pool.map(shard_info, paths))
+        else:
+            shards = [shard_info(path) for path in paths]
+    shards = sorted(shards)
+    manifest = {
+        "version": VERSION,
+        "source": source,
+        "complete": complete,
+        "abandoned": abandoned,
+        "lines": sum(shard.lines for shard in shards),
+        "bytes": sum(shard.bytes for shard in shards),
+        "shards": [shard._asdict() for shard in shards],
+    }
+    path = os.path.join(dirpath, NAME)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as outfh:
+        json.dump(manifest, outfh, indent=1)
+    os.replace(tmp_path, path)
+    return shards
+
+
+def _load(dirpath: str) -> Optional[Dict]:
+    path = os.path.join(dirpath, NAME)
+    try:
+        with open(path) as infh:
+            manifest = json.load(infh)
+    except FileNotFoundError:
+        return None
+    if manifest.get("version") != VERSION:
+        raise ValueError(f"{path} has unsupported version {manifest.get('version')}")
+    return manifest
+
+
+def read_manifest(dirpath: str) -> Optional[List[ShardInfo]]:
+    """The shards listed in the manifest of a directory, or None if it has none."""
+    manifest = _load(dirpath)
+    if manifest is None:
+        return None
+    return [ShardInfo(**shard) for shard in manifest["shards"]]
+
+
+def source_of(dirpath: str) -> Optional[str]:
+    """The file a directory was split from, if it has a manifest that records it."""
+    manifest = _load(dirpath)
+    return manifest.get("source") if manifest is not None else None
+
+
+def is_complete(dirpath: str) -> bool:
+    """
+    Whether the manifest of a directory lists all of its shards, rather than those split so far
+    (see sotastream.utils.split.split_file_into_chunks(stream=True)).
+    """
+    manifest = _load(dirpath)
+    return manifest is None or manifest.get("complete", True)
+
+
+def is_abandoned(dirpath: str) -> bool:
+    """Whether the split of a directory was stopped before the end, leaving its manifest incomplete."""
+    manifest = _load(dirpath)
+    return manifest is not None and manifest.get("abandoned", False)
+
+
+def main(argv: List[str] = None):
+    """Writes manifests for pre-split data directories: `sotastream manifest DIR...`."""
+    parser = argparse.ArgumentParser(
+        prog="sotastream manifest",
+        description="Writes a shard manifest (manifest.json) for each of the given data directories",
+    )
+    parser.add_argument("dirs", nargs="+", help="Directories of shards")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    for dirpath in args.dirs:
+        shards = write_manifest(dirpath)
+        logger.info(
+            f"Wrote {os.path.join(dirpath, NAME)}: {len(shards)} shards, {sum(shard.lines for shard in shards):,} lines"
+        )
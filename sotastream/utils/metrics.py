@@ -0,0 +1,291 @@
+"""
+Lightweight metrics for long-running streams.
+
+Worker processes record counters (e.g., draws per Mixer source, lines dropped per filter)
+and gauges (e.g., shuffle buffer fill) in a process-wide registry. Incrementing a counter
+is a single attribute update, and gauges are only evaluated when a snapshot is taken, so
+the metrics can stay on in production. Workers periodically send snapshots to the main
+process, which aggregates them and renders them in the Prometheus text format.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(f"sotastream")
+
+
+class Counter:
+    """A monotonically increasing value. Use `counter.value += n` on hot paths."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+# (name, sorted label items) -> Counter
+_COUNTERS = {}
+# (name, sorted label items) -> function returning the current value
+_GAUGES = {}
+
+
+def _key(name: str, labels: Dict) -> Tuple:
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def counter(name: str, **labels) -> Counter:
+    """
+    Returns the counter with the given name and labels, creating it if needed.
+    Counters are shared: asking twice for the same name and labels returns the same object.
+    """
+    key = _key(name, labels)
+    if key not in _COUNTERS:
+        _COUNTERS[key] = Counter()
+    return _COUNTERS[key]
+
+
+def gauge(name: str, function: Callable[[], float], **labels):
+    """
+    Registers a gauge, whose value is computed by calling function() when a snapshot is taken.
+    A later registration with the same name and labels replaces the earlier one.
+    """
+    _GAUGES[_key(name, labels)] = function
+
+
+def snapshot() -> List[Tuple[str, Dict, float]]:
+    """
+    Returns the current values of all metrics of this process, as (name, labels, value) triples.
+    """
+    samples = [(name, dict(labels), c.value) for (name, labels), c in _COUNTERS.items()]
+    for (name, labels), function in _GAUGES.items():
+        try:
+            samples.append((name, dict(labels), function()))
+        except Exception as ex:
+            logger.debug(f"Could not compute gauge {name}: {ex}")
+    return samples
+
+
+def reset():
+    """Forgets all metrics (e.g., in a freshly started worker process)."""
+    _COUNTERS.clear()
+    _GAUGES.clear()
+
+
+def encode_snapshot(samples: Iterable[Tuple[str, Dict, float]]) -> bytes:
+    return json.dumps(list(samples)).encode("utf-8")
+
+
+def decode_snapshot(data) -> List[Tuple[str, Dict, float]]:
+    return [tuple(sample) for sample in json.loads(str(data, "utf-8"))]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_prometheus(samples: Iterable[Tuple[str, Dict, float]]) -> str:
+    """
+    Renders (name, labels, value) triples in the Prometheus text exposition format.
+    Metrics whose name ends in _total are declared as counters, all others as gauges.
+    """
+    by_name = defaultdict(list)
+    for name, labels, value in samples:
+        by_name[name].append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+        for labels, value in by_name[name]:
+            label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def parse_prometheus(text: str) -> List[Tuple[str, Dict, float]]:
+    """
+    Parses what format_prometheus() writes back into (name, labels, value) triples.
+    """
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        labels = {}
+        if series.endswith("}"):
+            series, label_str = series[:-1].split("{", 1)
+            for match in re.finditer(r'(\w+)="((?:[^"\\]|\\.)*)"', label_str):
+                labels[match.group(1)] = re.sub(
+                    r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), match.group(2)
+                )
+        samples.append((series, labels, float(value)))
+    return samples
+
+
+class StreamMetrics:
+    """
+    Aggregates the metrics of a running stream in the main process: per-worker line, byte,
+    and token counts from the received batches, plus the latest snapshot sent by each worker.
+    Rates are computed over the time since the previous report (metrics file write) and since
+    the start.
+    """
+
+    def __init__(self, num_workers: int, stall_time: List[float] = None, restarts: List[int] = None):
+        """
+        :param num_workers: The number of workers
+        :param stall_time: Per-worker stall times, updated by the caller
+        :param restarts: Per-worker restart counts, updated by the caller
+        """
+        self.start_time = time.time()
+        self.num_workers = num_workers
+        self.stall_time = stall_time
+        self.restarts = restarts
+        self.lines = [0] * num_workers
+        self.bytes = [0] * num_workers
+        self.tokens = [0] * num_workers
+        self.worker_samples = [[] for _ in range(num_workers)]
+        self._last_report = (self.start_time, [0] * num_workers, [0] * num_workers, [0] * num_workers)
+        self._writer = None
+        self._stop_writer = threading.Event()
+
+    def add_batch(self, worker_id: int, num_lines: int, num_bytes: int, num_tokens: int):
+        self.lines[worker_id] += num_lines
+        self.bytes[worker_id] += num_bytes
+        self.tokens[worker_id] += num_tokens
+
+    def set_worker_snapshot(self, worker_id: int, samples):
+        self.worker_samples[worker_id] = samples
+
+    def samples(self, report: bool = True) -> List[Tuple[str, Dict, float]]:
+        """
+        Returns all metrics of the stream, with worker metrics labeled by worker and also
+        summed over workers.
+
+        :param report: Whether this is a report, which the next one's recent rates are computed from
+        """
+        now = time.time()
+        last_time, last_lines, last_bytes, last_tokens = self._last_report
+        interval = max(now - last_time, 1e-6)
+        uptime = max(now - self.start_time, 1e-6)
+        samples = [("sotastream_uptime_seconds", {}, round(uptime, 3))]
+        for unit, values, last_values in [
+            ("lines", self.lines, last_lines),
+            ("bytes", self.bytes, last_bytes),
+            ("tokens", self.tokens, last_tokens),
+        ]:
+            samples.append((f"sotastream_{unit}_total", {}, sum(values)))
+            samples.append((f"sotastream_{unit}_per_second", {}, round(sum(values) / uptime, 2)))
+            samples.append(
+                (
+                    f"sotastream_recent_{unit}_per_second",
+                    {},
+                    round((sum(values) - sum(last_values)) / interval, 2),
+                )
+            )
+            for i in range(self.num_workers):
+                samples.append((f"sotastream_worker_{unit}_total", {"worker": i}, values[i]))
+                samples.append(
+                    (
+                        f"sotastream_worker_recent_{unit}_per_second",
+                        {"worker": i},
+                        round((values[i] - last_values[i]) / interval, 2),
+                    )
+                )
+        if report:
+            self._last_report = (now, list(self.lines), list(self.bytes), list(self.tokens))
+        for i in range(self.num_workers):
+            if self.stall_time is not None:
+                samples.append(
+                    ("sotastream_worker_stall_seconds_total", {"worker": i}, round(self.stall_time[i], 3))
+                )
+            if self.restarts is not None:
+                samples.append(("sotastream_worker_restarts_total", {"worker": i}, self.restarts[i]))
+
+        totals = defaultdict(int)
+        for i, worker_samples in enumerate(self.worker_samples):
+            for name, labels, value in worker_samples:
+                samples.append((name, dict(labels, worker=i), value))
+                totals[_key(name, labels)] += value
+        for (name, labels), value in totals.items():
+            samples.append((name, dict(labels, worker="all"), value))
+        for source, progress in self.sources().items():
+            for i, epochs in enumerate(progress["worker_epochs"]):
+                if epochs is not None:
+                    samples.append(("sotastream_source_epochs", {"source": source, "worker": i}, epochs))
+            if progress["epochs"] is not None:
+                samples.append(
+                    ("sotastream_source_epochs", {"source": source, "worker": "all"}, progress["epochs"])
+                )
+        return samples
+
+    def sources(self) -> Dict[str, Dict]:
+        """
+        Returns the progress through each data source: the lines delivered, and the passes over
+        the source (epochs) they amount to, per worker and overall, once the size of the source is
+        known (from its manifest, or after a worker has read all of its shards). Full passes are
+        those completed by every worker.
+        """
+        lines = defaultdict(lambda: [0] * self.num_workers)
+        epoch_lines = defaultdict(lambda: [0] * self.num_workers)
+        for i, worker_samples in enumerate(self.worker_samples):
+            for name, labels, value in worker_samples:
+                if name == "sotastream_source_lines_total":
+                    lines[labels["source"]][i] = value
+                elif name == "sotastream_source_epoch_lines":
+                    epoch_lines[labels["source"]][i] = value
+
+        report = {}
+        for source in sorted(lines):
+            worker_epochs = [
+                round(n / size, 4) if size else None for n, size in zip(lines[source], epoch_lines[source])
+            ]
+            # whether every worker knows how many lines it reads per pass
+            known = all(epoch_lines[source])
+            report[source] = {
+                "lines": sum(lines[source]),
+                "epoch_lines": sum(epoch_lines[source]) if known else None,
+                "epochs": round(sum(lines[source]) / sum(epoch_lines[source]), 4) if known else None,
+                "full_epochs": min(int(epochs) for epochs in worker_epochs) if known else None,
+                "worker_epochs": worker_epochs,
+            }
+        return report
+
+    def write(self, path: str):
+        """Atomically (re)writes the metrics file."""
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "w") as outfh:
+            outfh.write(format_prometheus(self.samples()))
+        os.replace(tmp_path, path)
+
+    def log(self):
+        """Logs the metrics, without affecting the recent rates of the metrics file."""
+        logger.info("Metrics:\n" + format_prometheus(self.samples(report=False)))
+
+    def start_writing(self, path: str, interval: float):
+        """Rewrites the metrics file every interval seconds, from a background thread, until stop_writing()."""
+
+        def write_periodically():
+            while not self._stop_writer.wait(interval):
+                try:
+                    self.write(path)
+                except OSError as e:
+                    logger.warning(f"Could not write the metrics file {path}: {e}")
+
+        self._stop_writer.clear()
+        self._writer = threading.Thread(target=write_periodically, name="metrics-writer", daemon=True)
+        self._writer.start()
+
+    def stop_writing(self):
+        if self._writer is not None:
+            self._stop_writer.set()
+            self._writer.join()
+            self._writer = None
@@ -0,0 +1,301 @@
+"""
+Per-stage timing of generator pipelines.
+
+The augmentors and filters in sotastream.augmentors and sotastream.filters are decorated
+with @stage. Normally the decorator just calls the stage. Once enable() has been called
+(sotastream --profile-stages does so in each worker), every stage created afterwards
+counts the items going in and out, and times one in every `sample_every` items it produces.
+Function stages return their iterator wrapped (still checkpointable, if it was). Class
+stages (iterators themselves) keep their type: their methods are instrumented in place
+while profiling is enabled, and left alone otherwise. The counts and times are kept as
+metrics (see sotastream.utils.metrics), labeled by stage name, plus the name the stage was
+given, if any (e.g., "Mixer[casing]" for Mixer(..., name="casing")), so they reach the main
+process along with the other metrics of the workers, where summarize() turns them into a
+per-stage report.
+
+Times are exclusive: the time a stage spends waiting for its input stream(s) is subtracted.
+Source stages (which read files rather than consume a stream) report inclusive times.
+Batch stages (inputs="batches") count the lines in the batches, and time every batch.
+"""
+
+import functools
+import inspect
+import time
+
+from typing import Callable, Dict, Iterable, Iterator, Tuple
+
+from infinibatch.iterators import CheckpointableIterator
+
+from . import metrics
+
+# time one in this many items produced by a stage
+SAMPLE_EVERY = 64
+
+_enabled = False
+_sample_every = SAMPLE_EVERY
+
+# the class stages, with their inputs and original __init__ and __next__ (see _stage_class())
+_STAGE_CLASSES = {}
+
+
+def enable(sample_every: int = SAMPLE_EVERY):
+    """Turns on the instrumentation of stages created from now on (in this process)."""
+    global _enabled, _sample_every
+    _enabled = True
+    _sample_every = max(1, sample_every)
+    for cls in _STAGE_CLASSES:
+        _instrument_class(cls)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    for cls, (_, init, next_item) in _STAGE_CLASSES.items():
+        cls.__init__ = init
+        cls.__next__ = next_item
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class StageStats:
+    """
+    The counters of a stage (shared by the instances with the same label in a process),
+    plus the upstream time of the item being timed by this instance.
+    """
+
+    __slots__ = ("items_in", "items_out", "sampled_items", "sampled_seconds", "upstream_seconds", "sampling")
+
+    def __init__(self, name: str):
+        self.items_in = metrics.counter("sotastream_stage_items_in_total", stage=name)
+        self.items_out = metrics.counter("sotastream_stage_items_out_total", stage=name)
+        self.sampled_items = metrics.counter("sotastream_stage_sampled_items_total", stage=name)
+        self.sampled_seconds = metrics.counter("sotastream_stage_sampled_seconds_total", stage=name)
+        self.upstream_seconds = 0.0
+        self.sampling = False
+
+
+class _Input:
+    """Wraps the input stream of a stage, counting its items and timing it while the stage is sampled."""
+
+    __slots__ = ("iterator", "stats", "batched")
+
+    def __init__(self, stream: Iterable, stats: StageStats, batched: bool = False):
+        self.iterator = iter(stream)
+        self.stats = stats
+        self.batched = batched
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        stats = self.stats
+        if stats.sampling:
+            start = time.perf_counter()
+            try:
+                item = next(self.iterator)
+            finally:
+                stats.upstream_seconds += time.perf_counter() - start
+        else:
+            item = next(self.iterator)
+        stats.items_in.value += len(item) if self.batched else 1
+        return item
+
+
+class _Output:
+    """
+    Counts the items produced by a stage, and times every sample_every-th one.
+    If batched, the items are batches, and the lines in them are counted instead.
+    """
+
+    __slots__ = ("stats", "sample_every", "batched", "countdown")
+
+    def __init__(self, stats: StageStats, sample_every: int, batched: bool = False):
+        self.stats = stats
+        self.sample_every = sample_every
+        self.batched = batched
+        self.countdown = sample_every
+
+    def next(self, produce: Callable):
+        """Returns produce(), the stage's next item."""
+        stats = self.stats
+        self.countdown -= 1
+        if self.countdown:
+            item = produce()
+        else:
+            self.countdown = self.sample_every
+            stats.upstream_seconds = 0.0
+            stats.sampling = True
+            start = time.perf_counter()
+            try:
+                item = produce()
+            finally:
+                stats.sampling = False
+            stats.sampled_seconds.value += time.perf_counter() - start - stats.upstream_seconds
+            stats.sampled_items.value += len(item) if self.batched else 1
+        stats.items_out.value += len(item) if self.batched else 1
+        return item
+
+
+class _Instrumented:
+    """The iterator returned by a function stage, instrumented."""
+
+    def __init__(self, iterator: Iterator, output: _Output):
+        self.iterator = iterator
+        self.output = output
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.output.next(self.iterator.__next__)
+
+
+class _InstrumentedCheckpointable(_Instrumented, CheckpointableIterator):
+    """The checkpointable iterator returned by a function stage (e.g., DataSource), instrumented."""
+
+    def getstate(self):
+        return self.iterator.getstate()
+
+    def setstate(self, checkpoint):
+        self.iterator.setstate(checkpoint)
+
+    def close(self):
+        self.iterator.close()
+
+
+def _instrument_inputs(args: Tuple, stats: StageStats, inputs: str) -> Tuple:
+    """Wraps the input stream(s) of a stage, its first argument."""
+    batched = inputs in ("batches", "batch_streams")
+    if inputs in ("lines", "batches") and args:
+        return (_Input(args[0], stats, batched),) + args[1:]
+    if inputs in ("streams", "batch_streams") and args:
+        return ([_Input(stream, stats, batched) for stream in args[0]],) + args[1:]
+    return args
+
+
+def _sample_every_for(inputs: str) -> int:
+    # a batch is worth timing every time
+    return 1 if inputs in ("batches", "batch_streams") else _sample_every
+
+
+_signature = functools.lru_cache(maxsize=None)(inspect.signature)
+
+
+def _stage_label(name: str, function: Callable, args: Tuple, kwargs: Dict) -> str:
+    """The label of a stage's metrics: its name, and the name it was given (a `name` argument), if any."""
+    given = kwargs.get("name")
+    if given is None:
+        try:
+            given = _signature(function).bind_partial(*args, **kwargs).arguments.get("name")
+        except (TypeError, ValueError):
+            pass
+    return f"{name}[{given}]" if given else name
+
+
+def _stage_class(cls: type, inputs: str) -> type:
+    """Registers a class stage (an iterator), to be instrumented while profiling is enabled."""
+    _STAGE_CLASSES[cls] = (inputs, cls.__init__, cls.__next__)
+    if _enabled:
+        _instrument_class(cls)
+    return cls
+
+
+def _instrument_class(cls: type):
+    """Instruments a class stage in place: its __init__ and __next__ (see _stage_class())."""
+    inputs, init, next_item = _STAGE_CLASSES[cls]
+
+    @functools.wraps(init)
+    def __init__(self, *args, **kwargs):
+        stats = StageStats(_stage_label(cls.__name__, init, (self,) + args, kwargs))
+        self._stage_output = _Output(stats, _sample_every_for(inputs), inputs in ("batches", "batch_streams"))
+        init(self, *_instrument_inputs(args, stats, inputs), **kwargs)
+
+    @functools.wraps(next_item)
+    def __next__(self):
+        # None for the instances created before profiling was enabled
+        output = getattr(self, "_stage_output", None)
+        if output is None:
+            return next_item(self)
+        return output.next(functools.partial(next_item, self))
+
+    cls.__init__ = __init__
+    cls.__next__ = __next__
+
+
+def stage(function=None, *, inputs: str = "lines"):
+    """
+    Marks an augmentor or filter as a pipeline stage, to be profiled when enabled.
+
+    :param function: The stage: a generator function (or function) that returns an iterator, or an
+        iterator class
+    :param inputs: What its first argument is: "lines" (a stream), "batches" (a stream of batches,
+        see sotastream.augmentors.Batched), "streams" (a list of streams), "batch_streams" (a list of
+        streams of batches), or None for source stages
+    """
+    if function is None:
+        return functools.partial(stage, inputs=inputs)
+    if isinstance(function, type):
+        return _stage_class(function, inputs)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+
+        stats = StageStats(_stage_label(function.__name__, function, args, kwargs))
+        iterator = function(*_instrument_inputs(args, stats, inputs), **kwargs)
+        output = _Output(stats, _sample_every_for(inputs), inputs in ("batches", "batch_streams"))
+        if isinstance(iterator, CheckpointableIterator):
+            return _InstrumentedCheckpointable(iterator, output)
+        return _Instrumented(iter(iterator), output)
+
+    return wrapper
+
+
+def summarize(samples: Iterable[Tuple[str, Dict, float]]) -> Dict[str, Dict]:
+    """
+    Builds a per-stage report from (name, labels, value) metric samples, as collected from all workers
+    (see sotastream.utils.metrics.StreamMetrics): items in and out, the drop ratio, the estimated
+    total time (extrapolated from the sampled items), and each stage's share of the total time.
+    Samples summed over workers (worker="all") are ignored, so it can be given any mix of samples.
+    """
+    stages = {}
+    fields = {
+        "sotastream_stage_items_in_total": "items_in",
+        "sotastream_stage_items_out_total": "items_out",
+        "sotastream_stage_sampled_items_total": "sampled_items",
+        "sotastream_stage_sampled_seconds_total": "sampled_seconds",
+    }
+    for name, labels, value in samples:
+        if name not in fields or labels.get("worker") == "all":
+            continue
+        totals = stages.setdefault(labels["stage"], dict.fromkeys(fields.values(), 0))
+        totals[fields[name]] += value
+
+    est_seconds = {
+        name: (
+            totals["sampled_seconds"] / totals["sampled_items"] * totals["items_out"]
+            if totals["sampled_items"]
+            else 0.0
+        )
+        for name, totals in stages.items()
+    }
+    total_seconds = sum(est_seconds.values())
+    report = {}
+    for name in sorted(stages, key=lambda name: -est_seconds[name]):
+        totals = stages[name]
+        report[name] = {
+            "items_in": totals["items_in"],
+            "items_out": totals["items_out"],
+            "drop_ratio": (
+                round(1 - totals["items_out"] / totals["items_in"], 4) if totals["items_in"] else None
+            ),
+            "est_seconds": round(est_seconds[name], 3),
+            "us_per_item": (
+                round(est_seconds[name] / totals["items_out"] * 1e6, 3) if totals["items_out"] else None
+            ),
+            "time_share": round(est_seconds[name] / total_seconds, 4) if total_seconds else None,
+        }
+    return report
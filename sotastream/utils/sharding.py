@@ -0,0 +1,257 @@
+"""
+Assignment of the shards of a data source to the workers reading it.
+
+All workers of all instances (MPI ranks) form one global partition: worker w of instance r
+is partition r * num_workers + w of num_instances * num_workers. With at least as many shards
+as partitions, whole shards are assigned so that each partition gets about the same amount of
+data (by line count if known, else by file size). With fewer shards than partitions, shards are
+divided into parts, in proportion to their sizes, so that no two partitions read the same lines.
+"""
+
+import heapq
+import logging
+import os
+import random
+import time
+
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from infinibatch.iterators import CheckpointableIterator
+
+from sotastream import Defaults
+from sotastream.utils import manifest
+
+logger = logging.getLogger(f"sotastream")
+
+# How often a partition without shards checks for new ones, in seconds
+POLL_INTERVAL = 0.5
+
+
+class ShardPart(NamedTuple):
+    """
+    Part `part` of `num_parts` of a shard: its lines [num_lines * part // num_parts, num_lines * (part + 1) // num_parts)
+    if its number of lines is known, or else every num_parts-th line, starting at line `part`.
+    """
+
+    path: str
+    part: int = 0
+    num_parts: int = 1
+    num_lines: Optional[int] = None
+
+    def line_range(self, num_lines: Optional[int] = None) -> Optional[range]:
+        """The line numbers of the part, or None if the number of lines of the shard is unknown."""
+        num_lines = self.num_lines if num_lines is None else num_lines
+        if num_lines is None:
+            return None
+        return range(num_lines * self.part // self.num_parts, num_lines * (self.part + 1) // self.num_parts)
+
+    def select(self, lines: Iterable) -> Iterator:
+        """Returns the lines of the part, from the lines of the whole shard."""
+        if self.num_parts == 1:
+            return iter(lines)
+        line_range = self.line_range()
+        if line_range is None:
+            return islice(lines, self.part, None, self.num_parts)
+        return islice(lines, line_range.start, line_range.stop)
+
+
+class ShardPartPath(str):
+    """
+    The path of a shard, for reading a part of it: UTF8File returns only the lines of the part (and
+    marks it as selected), so that processors that read the shard with it see the lines of the part
+    before processing them.
+    """
+
+    def __new__(cls, part: ShardPart):
+        path = super().__new__(cls, part.path)
+        path.part = part
+        path.selected = False
+        return path
+
+
+def global_partition(worker_id: int = 0, num_workers: int = 1) -> Tuple[int, int]:
+    """
+    Returns (partition, num_partitions) for a worker of this instance, taking MPI ranks
+    (from the OMPI_COMM_WORLD_* environment variables) into account.
+    """
+    num_instances = int(os.environ.get("OMPI_COMM_WORLD_SIZE", "1"))
+    instance_rank = int(os.environ.get("OMPI_COMM_WORLD_RANK", "0"))
+    return instance_rank * num_workers + worker_id, num_instances * num_workers
+
+
+def shard_sizes(paths: Sequence[str], num_lines: Optional[Dict[str, int]] = None) -> List[int]:
+    """The sizes of shards to balance by: their line counts if all known, else their sizes in bytes."""
+    if num_lines and all(path in num_lines for path in paths):
+        return [num_lines[path] for path in paths]
+    return [os.path.getsize(path) for path in paths]
+
+
+def assign_shards(
+    paths: Sequence[str],
+    partition: int,
+    num_partitions: int,
+    sizes: Optional[Sequence[int]] = None,
+    num_lines: Optional[Dict[str, int]] = None,
+) -> List[ShardPart]:
+    """
+    Returns the shards, or parts of shards, that one partition reads.
+
+    :param paths: The shards
+    :param partition: The partition (e.g., from global_partition())
+    :param num_partitions: The number of partitions
+    :param sizes: The sizes of the shards to balance by (default: see shard_sizes())
+    :param num_lines: The line counts of the shards, where known (to divide shards into line ranges)
+    """
+    if not paths:
+        return []
+    # independent of the order of the paths
+    order = sorted(range(len(paths)), key=lambda i: paths[i])
+    sizes = [sizes[i] for i in order] if sizes is not None else None
+    paths = [paths[i] for i in order]
+    if sizes is None:
+        sizes = shard_sizes(paths, num_lines)
+    num_lines = num_lines or {}
+
+    if len(paths) >= num_partitions:
+        # largest shards first, each to the partition with the least data so far
+        loads = [(0, p) for p in range(num_partitions)]
+        assigned = []
+        for i in sorted(range(len(paths)), key=lambda i: (-sizes[i], i)):
+            load, p = heapq.heappop(loads)
+            if p == partition:
+                assigned.append(ShardPart(paths[i], num_lines=num_lines.get(paths[i])))
+            heapq.heappush(loads, (load + sizes[i], p))
+        return sorted(assigned)
+
+    # divide the partitions among the shards in proportion to their sizes (at least one each)
+    num_parts = _apportion(sizes, num_partitions)
+    p = 0
+    for path, parts in zip(paths, num_parts):
+        if partition < p + parts:
+            return [ShardPart(path, partition - p, parts, num_lines.get(path))]
+        p += parts
+    raise AssertionError("unreachable")
+
+
+def _apportion(sizes: Sequence[int], total: int) -> List[int]:
+    """Splits total (at least len(sizes)) into one positive integer per size, in proportion to the sizes."""
+    size_sum = sum(sizes) or 1
+    shares = [total * size / size_sum for size in sizes]
+    parts = [max(1, int(share)) for share in shares]
+    # then the furthest below (above) their shares get one more (less)
+    while sum(parts) < total:
+        parts[max(range(len(parts)), key=lambda i: (shares[i] - parts[i], -i))] += 1
+    while sum(parts) > total:
+        parts[
+            max((i for i in range(len(parts)) if parts[i] > 1), key=lambda i: (parts[i] - shares[i], -i))
+        ] -= 1
+    return parts
+
+
+class GrowingShardIterator(CheckpointableIterator):
+    """
+    The shards of a directory that is still being split (see
+    sotastream.utils.split.split_file_into_chunks(stream=True)), as an infinite sequence of chunk
+    references, pass after pass, like infinibatch's create_source_iterator().
+
+    The shards are those in the directory's manifest, which is read again before each chunk until
+    it is complete. While it is not, partition p reads shards p, p + num_partitions, and so on,
+    which does not change as shards are added, and new shards join the current pass at random
+    positions. A partition without any shards yet waits for them. Once the manifest is complete,
+    the shards are assigned as by assign_shards() from the next pass on. If the split is abandoned
+    instead (see sotastream.utils.manifest.is_abandoned()), it raises a RuntimeError rather than
+    read the shards split so far forever.
+    """
+
+    def __init__(
+        self,
+        dirpath: str,
+        partition: int = 0,
+        num_partitions: int = 1,
+        seed: int = 0,
+        shuffle: bool = True,
+        ext: Union[str, Tuple[str, ...]] = Defaults.SHARD_EXTENSIONS,
+    ):
+        self._dirpath = dirpath
+        self._partition = partition
+        self._num_partitions = num_partitions
+        self._seed = seed
+        self._shuffle = shuffle
+        self._ext = ext
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        return {
+            "random_state": self._random.getstate(),
+            "num_known": self._num_known,
+            "shards": list(self._shards),
+            "pending": list(self._pending),
+            "final": self._final,
+        }
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        self._random = random.Random(self._seed)
+        # the number of shards in the manifest so far, the shards of this partition,
+        # those left in the current pass (in reverse order), and the assignment once complete
+        self._num_known = 0
+        self._shards = []
+        self._pending = []
+        self._final = None
+        if checkpoint is not None:
+            self._random.setstate(checkpoint["random_state"])
+            self._num_known = checkpoint["num_known"]
+            self._shards = list(checkpoint["shards"])
+            self._pending = list(checkpoint["pending"])
+            self._final = checkpoint["final"]
+
+    def _refresh(self):
+        shards = manifest.read_manifest(self._dirpath) or []
+        complete = manifest.is_complete(self._dirpath)
+        if not complete and manifest.is_abandoned(self._dirpath):
+            raise RuntimeError(
+                f"The split of {self._dirpath} was stopped before the end, after {len(shards)} shards: "
+                "restart to split it again"
+            )
+        paths = [
+            os.path.join(self._dirpath, shard.name)
+            for shard in shards
+            if self._ext is None or shard.name.endswith(self._ext)
+        ]
+        # shards split since the last check join the current pass (unless the split is complete and
+        # this partition has none yet, when it starts with its final shards)
+        first_new = len(paths) if complete and not self._shards else self._num_known
+        for i in range(first_new, len(paths)):
+            if i % self._num_partitions == self._partition:
+                part = ShardPart(paths[i])
+                self._shards.append(part)
+                position = self._random.randint(0, len(self._pending)) if self._shuffle else 0
+                self._pending.insert(position, part)
+        self._num_known = len(paths)
+        if complete:
+            num_lines = {os.path.join(self._dirpath, shard.name): shard.lines for shard in shards}
+            self._final = assign_shards(paths, self._partition, self._num_partitions, num_lines=num_lines)
+            logger.info(f"All {len(paths)} shards of {self._dirpath} are split")
+
+    def _next_pass(self):
+        if self._final is not None:
+            self._shards = self._final
+        self._pending = list(reversed(self._shards))
+        if self._shuffle:
+            self._random.shuffle(self._pending)
+
+    def __next__(self) -> ShardPart:
+        if self._final is None:
+            self._refresh()
+        while not self._pending:
+            if self._shards or self._final is not None:
+                self._next_pass()
+                if not self._pending:
+                    raise StopIteration
+            else:
+                time.sleep(POLL_INTERVAL)
+                self._refresh()
+        return self._pending.pop()
+
+    def close(self):
+        pass
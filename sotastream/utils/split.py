@@ -1,25 +1,72 @@
 #!/usr/bin/env python3
 
 import datetime
-import gzip
+import functools
 import hashlib
+import io
 import logging
 import os
+import re
 import shutil
+import multiprocessing
+import signal
 import subprocess
+import tempfile
+import threading
 import time
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Type
+from typing import Callable, List, Optional, Tuple, Type
 
+from sotastream.augmentors import UTF8File
 from sotastream.pipelines import PIPELINES
-
+from sotastream.utils import cache, indexed, manifest
+from sotastream.utils.cache import LOCK_SUFFIX, TMP_SUFFIX
+from sotastream.utils.compression import COMMANDS, EXTENSIONS, codec_of, is_compressed, open_compressed
 
 logger = logging.getLogger(f"sotastream")
 
 
 # The block size to use when compute MD5 hashes
-MD5_BLOCK_SIZE = 8192
+MD5_BLOCK_SIZE = 1024 * 1024
+
+# The names of split directories named by the MD5 checksum of the file (without the codec)
+MD5_NAME = re.compile(r"[0-9a-f]{32}")
+
+# The file in a split directory that records the MD5 checksum of the file it was split from
+MD5_FILE = ".md5"
+
+# Cache keys: a fingerprint of the file's size, modification time, inode, and sampled blocks
+# (see compute_fingerprint()), or the MD5 checksum of its whole content
+CACHE_KEYS = ("fingerprint", "md5")
+
+# The number and size of the blocks that a fingerprint hashes
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+# The processes splitting files in the background
+BACKGROUND_SPLITS = []
+
+# How often to check whether a split in the background has written its first chunk, in seconds
+POLL_INTERVAL = 0.1
+
+# How much split_parallel() reads at a time
+SPLIT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# The smallest byte range of an uncompressed file that split_parallel() gives a process
+MIN_RANGE_SIZE = 64 * 1024 * 1024
+
+# The most data (of chunks read but not written yet) that split_parallel() holds for its processes
+MAX_PENDING_BYTES = 1024 * 1024 * 1024
+
+# The most processes to split with unless asked for more (with --split-processes)
+MAX_DEFAULT_PROCESSES = 8
+
+
+def default_processes() -> int:
+    """The number of processes to split with in Python by default: one per CPU, up to MAX_DEFAULT_PROCESSES."""
+    return min(MAX_DEFAULT_PROCESSES, os.cpu_count() or 1)
 
 
 def split_file_into_chunks(
@@ -28,50 +75,278 @@ def split_file_into_chunks(
     split_size: int = 10000,
     native: bool = False,
     overwrite: bool = False,
+    codec: str = "gz",
+    processes: int = 0,
+    cache_key: str = "fingerprint",
+    verify: bool = False,
+    stream: bool = False,
+    cache_size: int = 0,
 ) -> Path:
     """
-    Splits a file into compressed chunks under a directory.
-    The location will be in a directory named by the file's checksum, within the
+    Splits a file into compressed chunks under a directory, with a manifest of the chunks
+    (see sotastream.utils.manifest). The directory is marked as in use by this process, so that it
+    is not removed from the cache while it runs (see sotastream.utils.cache.hold()).
+    The location will be in a directory named by the file's fingerprint or checksum, within the
     provided temporary directory. Results are cached, providing for quick restarting.
 
-    :param filepath: The input file path
+    :param filepath: The input file path (compressed with gzip, Zstandard, or LZ4)
     :param tmpdir: The top-level temporary directory to write to
     :param split_size: The size of each chunk in lines
     :param native: If True, use Python to split, instead of a subshell
+    :param codec: The compression of the chunks (see sotastream.utils.compression.EXTENSIONS),
+        or "indexed" for indexed shards (see sotastream.utils.indexed)
+    :param processes: If positive, split in Python with this many processes (see split_parallel())
+    :param cache_key: What names the directory: "fingerprint" (see compute_fingerprint()), which takes
+        milliseconds, or "md5", the checksum of the whole file, which is exact but reads all of it
+    :param verify: Whether to also compute the MD5 checksum of the file in a background thread, and
+        check it against the one recorded when the file was split (see verify_split())
+    :param stream: Whether to split in a background process (with split_parallel()), and return as soon
+        as the first chunk is written. The manifest lists the chunks written so far until the split is
+        complete (see sotastream.utils.manifest.is_complete()), and data sources pick up new chunks
+        as they appear. Stop the process with stop_background_splits() when done, which abandons an
+        unfinished split: the next call splits the file again from the start, rather than resume it
+        after the chunks already written.
+    :param cache_size: If positive, the size in bytes to keep tmpdir within after a new split, by
+        removing the least recently used directories that are not in use (see sotastream.utils.cache)
     :return: The directory where the chunks are stored, as a Path object
     """
+    assert codec in EXTENSIONS or codec == indexed.CODEC, f"Unknown codec {codec}"
     start_time = time.perf_counter()
 
-    split_func = split_native if native else split_subshell
-
-    # Compute the checksum
-    md5sum = compute_md5(filepath)
-    logger.info(f"md5sum({filepath}) = {md5sum} computed in {time.perf_counter() - start_time:.1f}s")
+    if stream:
+        # each chunk is renamed into place when it is complete, and then published in the manifest
+        split_func = functools.partial(
+            split_parallel, processes=processes or default_processes(), publish=True
+        )
+    elif processes > 0:
+        split_func = functools.partial(split_parallel, processes=processes)
+    elif codec == indexed.CODEC:
+        split_func = split_indexed
+    elif native:
+        split_func = split_native
+    elif not can_split_subshell(filepath, codec):
+        logger.warning("The tools for splitting in a subshell are missing; splitting in Python instead")
+        split_func = functools.partial(split_parallel, processes=default_processes())
+    else:
+        split_func = split_subshell
+
+    assert cache_key in CACHE_KEYS, f"Unknown cache key {cache_key}"
+
+    # Compute the cache key
+    if cache_key == "md5":
+        md5sum = key = compute_md5(filepath)
+    else:
+        md5sum = None
+        key = f"fp-{compute_fingerprint(filepath)}"
+    logger.info(f"{cache_key}({filepath}) = {key} computed in {time.perf_counter() - start_time:.3f}s")
 
     # Check if we already have the file split
-    destdir = Path(tmpdir) / md5sum
+    # gzip chunks are in a directory named by the key alone, as they were before there were other codecs
+    destdir = Path(tmpdir) / (key if codec == "gz" else f"{key}.{codec}")
     donefile = destdir / ".done"
-    if destdir.exists() and overwrite:
-        logger.info(f"Removing existing split directory {destdir}")
-        shutil.rmtree(destdir)
-    elif donefile.exists():
-        logger.info(f"Using cached splitting of {filepath} (checksum: {md5sum})")
-        return destdir
-
-    # If not, split the file
-    logger.info(f"Splitting file {filepath} to {tmpdir}...")
-    destdir.mkdir(parents=True, exist_ok=True)
+    if donefile.exists() and not overwrite and cache.hold(destdir):
+        return _use_cached(filepath, destdir, verify)
+    if cache_key == "fingerprint" and not overwrite:
+        # splits from before fingerprints were the default are named by the file's checksum
+        legacy_dir = _find_md5_split(filepath, tmpdir, codec)
+        if legacy_dir is not None and cache.hold(legacy_dir):
+            return _use_cached(filepath, legacy_dir, verify)
+
+    # If not, split the file, holding the directory's lock, so that of several processes splitting
+    # the same file at once (e.g., the MPI ranks of a node), one splits it, and the others wait for
+    # it and then use its split. They stream from it while it is split, if they can.
+    destdir.parent.mkdir(parents=True, exist_ok=True)
+    lock_path = destdir.parent / f"{destdir.name}{LOCK_SUFFIX}"
+    lockfd = cache.lock(lock_path, blocking=False)
+    if lockfd is None:
+        if (
+            stream
+            and not manifest.is_complete(str(destdir))
+            and not manifest.is_abandoned(str(destdir))
+            and cache.hold(destdir)
+        ):
+            logger.info(f"Streaming from {destdir} while another process splits {filepath}")
+            return destdir
+        logger.info(f"Waiting for another process to split {filepath} to {destdir}...")
+        lockfd = cache.lock(lock_path)
+    try:
+        if donefile.exists() and not overwrite and cache.hold(destdir):
+            return _use_cached(filepath, destdir, verify)
+        # what is left of earlier splits: the directory, if overwriting or if a split was interrupted,
+        # and the temporary directories of splits that were, unless other processes still use them
+        in_use = False
+        if destdir.exists():
+            kind = "existing" if overwrite else "unfinished"
+            in_use = not cache.remove_unused(destdir)
+            if in_use:
+                logger.warning(f"Keeping {kind} split directory {destdir}, which is in use")
+            else:
+                logger.info(f"Removed {kind} split directory {destdir}")
+        for path in destdir.parent.glob(f"{destdir.name}{TMP_SUFFIX}*"):
+            if cache.remove_unused(path):
+                logger.info(f"Removed unfinished split directory {path}")
+
+        # into a temporary directory, which is renamed when complete, or used as it is if the
+        # directory is still in use
+        splitdir = destdir.parent / f"{destdir.name}{TMP_SUFFIX}{os.getpid()}"
+        if splitdir.exists():
+            # kept by processes using it, left by one with the same process ID
+            splitdir = Path(tempfile.mkdtemp(prefix=splitdir.name + ".", dir=destdir.parent))
+        else:
+            splitdir.mkdir()
+        logger.info(f"Splitting file {filepath} to {tmpdir}...")
+        if stream:
+            # publishing the chunks as they are written, holding the lock (inherited by the
+            # background process) until the split is done
+            if not in_use:
+                os.rename(splitdir, destdir)
+                splitdir = destdir
+            cache.hold(splitdir)
+            manifest.write_manifest(str(splitdir), [], source=filepath, complete=False)
+            process = multiprocessing.get_context("fork").Process(
+                target=_split_in_background,
+                args=(filepath, splitdir, split_func, split_size, codec, md5sum),
+                name="splitter",
+            )
+            process.start()
+            BACKGROUND_SPLITS.append((process, filepath, splitdir))
+            while not manifest.read_manifest(str(splitdir)) and process.is_alive():
+                time.sleep(POLL_INTERVAL)
+            if not process.is_alive() and process.exitcode != 0:
+                raise RuntimeError(f"Splitting {filepath} failed with exit code {process.exitcode}")
+            logger.info(f"Streaming from {splitdir} while {filepath} is split")
+        else:
+            _split(filepath, splitdir, split_func, split_size, codec, md5sum)
+            if not in_use:
+                os.rename(splitdir, destdir)
+                splitdir = destdir
+            cache.hold(splitdir)
+        destdir = splitdir
+    finally:
+        os.close(lockfd)
+    if cache_size > 0:
+        cache.evict(tmpdir, cache_size)
+    if verify and md5sum is None:
+        threading.Thread(target=verify_split, args=(filepath, destdir), daemon=True).start()
+
+    return destdir
+
+
+def _find_md5_split(filepath: str, tmpdir: str, codec: str) -> Optional[Path]:
+    """
+    Looks for a finished split of a file in a directory named by its MD5 checksum, as with
+    --split-cache-key md5, without computing the checksum: the split must record the same file
+    path (in its .done file), and be newer than the last change of the file, content or metadata
+    (its ctime, which copies that keep the modification time, like cp -p, rsync -a, or touch -r,
+    update too). Its checksum is recorded (see MD5_FILE), so that --verify-md5 checks that it is
+    that of the file.
+    """
+    if not os.path.isdir(tmpdir):
+        return None
+    suffix = "" if codec == "gz" else f".{codec}"
+    file_ctime = os.stat(filepath).st_ctime
+    for entry in os.scandir(tmpdir):
+        name = entry.name[: len(entry.name) - len(suffix)] if suffix else entry.name
+        if not entry.is_dir() or not entry.name.endswith(suffix) or not MD5_NAME.fullmatch(name):
+            continue
+        donefile = Path(entry.path) / ".done"
+        try:
+            recorded = donefile.read_text().split(" finished splitting ")[0]
+            done_mtime = donefile.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if recorded in (filepath, os.path.abspath(filepath)) and done_mtime >= file_ctime:
+            md5_file = Path(entry.path) / MD5_FILE
+            if not md5_file.exists():
+                md5_file.write_text(name + "\n")
+            logger.info(f"Found a split of {filepath} named by its checksum: {entry.path}")
+            return Path(entry.path)
+    return None
+
+
+def _use_cached(filepath: str, destdir: Path, verify: bool) -> Path:
+    logger.info(f"Using cached splitting of {filepath} ({destdir.name})")
+    if manifest.read_manifest(str(destdir)) is None:
+        # split before there were manifests
+        logger.info(f"Writing the missing shard manifest of {destdir}")
+        manifest.write_manifest(str(destdir), source=filepath)
+    if verify:
+        threading.Thread(target=verify_split, args=(filepath, destdir), daemon=True).start()
+    return destdir
+
+
+def _split(
+    filepath: str, destdir: Path, split_func: Callable, split_size: int, codec: str, md5sum: str = None
+):
+    """Splits a file into destdir, and then writes its manifest and marks it as done."""
     start_time = time.perf_counter()
-    split_func(filepath, destdir, split_size)
+    # the details of the chunks, if the split function returns them, or else read from the chunks
+    # (by a pool of processes)
+    shards = split_func(filepath, destdir, split_size, codec=codec)
     logger.info(f"File {filepath} splitting took {time.perf_counter() - start_time:.1f}s")
+    shards = manifest.write_manifest(str(destdir), shards, source=filepath, processes=default_processes())
+    logger.info(f"Wrote the manifest of {len(shards)} shards, {sum(shard.lines for shard in shards):,} lines")
 
-    with open(donefile, "w") as outfh:
+    if md5sum is not None:
+        (destdir / MD5_FILE).write_text(md5sum + "\n")
+    with open(destdir / ".done", "w") as outfh:
         print(f"{filepath} finished splitting {datetime.datetime.now()}", file=outfh)
 
-    return destdir
+
+def _split_in_background(*args):
+    """_split(), in a process group of its own, so that it can be stopped with its pool of processes."""
+    os.setpgrp()
+    _split(*args)
 
 
-def split_native(filepath: str, destdir: Path, split_size: int):
+def stop_background_splits():
+    """
+    Stops the splits still running in the background (see split_file_into_chunks(stream=True)),
+    marking those stopped before the end as abandoned, so that other processes streaming from them
+    stop too, and later ones split the files again.
+    """
+    while BACKGROUND_SPLITS:
+        process, filepath, destdir = BACKGROUND_SPLITS.pop()
+        if process.is_alive():
+            logger.info(f"Stopping the unfinished split in process {process.pid}")
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        process.join()
+        if not manifest.is_complete(str(destdir)):
+            shards = manifest.read_manifest(str(destdir))
+            manifest.write_manifest(str(destdir), shards, source=filepath, complete=False, abandoned=True)
+            logger.warning(f"Abandoned the split of {filepath} after {len(shards)} shards")
+
+
+def verify_split(filepath: str, destdir: Path) -> bool:
+    """
+    Computes the MD5 checksum of a file and checks it against the one recorded in the directory
+    it was split into (recording it if there is none yet). Logs an error and returns False if
+    they differ, i.e., if the directory was split from a different file.
+    """
+    start_time = time.perf_counter()
+    md5sum = compute_md5(filepath)
+    md5_file = Path(destdir) / MD5_FILE
+    if not md5_file.exists():
+        md5_file.write_text(md5sum + "\n")
+        logger.info(f"md5sum({filepath}) = {md5sum} computed in {time.perf_counter() - start_time:.1f}s")
+        return True
+    recorded = md5_file.read_text().strip()
+    if recorded != md5sum:
+        logger.error(
+            f"md5sum({filepath}) = {md5sum}, but {destdir} was split from a file with md5sum {recorded}. "
+            f"Remove {destdir} to split it again."
+        )
+        return False
+    logger.info(f"Verified the split of {filepath} in {destdir} (md5sum {md5sum})")
+    return True
+
+
+def split_native(
+    filepath: str, destdir: Path, split_size: int, codec: str = "gz"
+) -> List[manifest.ShardInfo]:
     """
     Split directly in Python by reading the file.
     This version is slower than the subshell version.
@@ -79,39 +354,257 @@ def split_native(filepath: str, destdir: Path, split_size: int):
     :param filepath: The input file path
     :param destdir: The output directory
     :param split_size: The size of each chunk in lines
+    :param codec: The compression of the chunks
+    :return: The details of the chunks, for the manifest
     """
+    shards = []
 
     def get_chunkpath(index=0):
-        outfh = smart_open(destdir / f"part.{index:05d}.gz", "wt")
+        outfh = smart_open(destdir / _chunk_name(index, codec), "wt")
         index += 1
         return index, outfh
 
     with smart_open(filepath) as infh:
         chunkno, outfh = get_chunkpath()
+        # the lines of the current chunk, as data sources read them (see UTF8File)
+        num_lines = 0
         logger.info(f"Splitting {filepath} to {destdir}")
         for lineno, line in enumerate(infh, 1):
             line = line.rstrip("\r\n")
             if lineno % split_size == 0:
                 if outfh is not None:
                     outfh.close()
+                    shards.append(_chunk_info(destdir / _chunk_name(chunkno - 1, codec), num_lines, codec))
                 chunkno, outfh = get_chunkpath(chunkno)
+                num_lines = 0
             print(line, file=outfh)
+            num_lines += len((line + "\n").splitlines())
         outfh.close()
+        shards.append(_chunk_info(destdir / _chunk_name(chunkno - 1, codec), num_lines, codec))
+    return shards
+
 
+def split_indexed(
+    filepath: str, destdir: Path, split_size: int, codec: str = indexed.CODEC
+) -> List[manifest.ShardInfo]:
+    """
+    Split into indexed shards (part.NNNNN.sidx), in Python.
+    The lines are the same as those of the other shards when read with UTF8File.
 
-def split_subshell(filepath: str, destdir: Path, split_size: int):
+    :param filepath: The input file path
+    :param destdir: The output directory
+    :param split_size: The size of each chunk in lines
+    :param codec: Unused (indexed shards are not compressed)
+    :return: The details of the chunks, for the manifest
+    """
+    logger.info(f"Splitting {filepath} to indexed shards in {destdir}")
+    shards = []
+    writer = None
+
+    def close():
+        writer.close()
+        shards.append(_chunk_info(Path(writer.path), len(writer.offsets) - 1, indexed.CODEC))
+
+    for lineno, line in enumerate(UTF8File(filepath)):
+        if lineno % split_size == 0:
+            if writer is not None:
+                close()
+            writer = indexed.IndexedShardWriter(destdir / _chunk_name(lineno // split_size, indexed.CODEC))
+        writer.write(str(line))
+    if writer is not None:
+        close()
+    return shards
+
+
+def split_subshell(filepath: str, destdir: Path, split_size: int, codec: str = "gz"):
     """
     Split using a subshell (~8x faster).
 
     :param filepath: The input file path
     :param destdir: The output directory
     :param split_size: The size of each chunk in lines
+    :param codec: The compression of the chunks
     """
-    cmd = f"pigz -cd {filepath} | sed 's/\r//g' | split -d -a5 -l {split_size} --filter 'pigz > $FILE.gz' - {destdir}/part."
+    decompress = COMMANDS[codec_of(filepath)][0] if is_compressed(filepath) else "cat"
+    compress = COMMANDS[codec][1]
+    ext = EXTENSIONS[codec]
+    cmd = f"{decompress} {filepath} | sed 's/\r//g' | split -d -a5 -l {split_size} --filter '{compress} > $FILE{ext}' - {destdir}/part."
     logger.info(cmd)
     subprocess.run(cmd, shell=True, check=True)
 
 
+def can_split_subshell(filepath: str, codec: str = "gz") -> bool:
+    """Whether the commands that split_subshell() runs are installed."""
+    tools = ["sed", "split", COMMANDS[codec][1].split()[0]]
+    if is_compressed(filepath):
+        tools.append(COMMANDS[codec_of(filepath)][0].split()[0])
+    return all(shutil.which(tool) for tool in tools)
+
+
+def split_parallel(
+    filepath: str,
+    destdir: Path,
+    split_size: int,
+    codec: str = "gz",
+    processes: int = 4,
+    publish: bool = False,
+    max_pending_bytes: int = MAX_PENDING_BYTES,
+) -> List[manifest.ShardInfo]:
+    """
+    Split in Python, with a pool of processes, without any external tools.
+
+    An uncompressed file is divided into byte ranges that end at line ends, which the processes
+    split into chunks concurrently (so a chunk at the end of a range may be short). A compressed
+    file, which can only be decompressed from the start, is decompressed here, while the
+    processes compress and write the chunks. As with split_subshell(), lines end at \\n and
+    carriage returns are removed.
+
+    :param filepath: The input file path
+    :param destdir: The output directory
+    :param split_size: The size of each chunk in lines
+    :param codec: The compression of the chunks, or "indexed"
+    :param processes: The number of processes
+    :param publish: Whether to list each chunk in the manifest (as incomplete) as soon as it and
+        the chunks before it are written
+    :param max_pending_bytes: For a compressed file, the most data of chunks read but not yet written
+        to hold at a time (at least one chunk, and at most two per process)
+    :return: The details of the chunks, for the manifest
+    """
+    logger.info(f"Splitting {filepath} to {destdir} with {processes} processes")
+    written = []
+
+    def done(shard: manifest.ShardInfo):
+        written.append(shard)
+        if publish:
+            manifest.write_manifest(str(destdir), written, source=filepath, complete=False)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        if is_compressed(filepath):
+            # a bounded number and size of chunks in flight, to bound memory
+            pending = []
+            pending_bytes = 0
+            with open_compressed(filepath, "rb") as infh:
+                for chunkno, data in enumerate(_read_chunks(infh, split_size)):
+                    while pending and (
+                        len(pending) >= 2 * processes
+                        or pending_bytes + len(data) > max_pending_bytes
+                        or pending[0][0].done()
+                    ):
+                        future, size = pending.pop(0)
+                        done(future.result())
+                        pending_bytes -= size
+                    path = destdir / _chunk_name(chunkno, codec)
+                    pending.append((pool.submit(_write_chunk, path, data, codec), len(data)))
+                    pending_bytes += len(data)
+            for future, _ in pending:
+                done(future.result())
+        else:
+            ranges = _byte_ranges(filepath, max(processes, os.path.getsize(filepath) // MIN_RANGE_SIZE))
+            results = pool.map(
+                _split_range,
+                [filepath] * len(ranges),
+                ranges,
+                [destdir / f"range.{i:05d}" for i in range(len(ranges))],
+                [split_size] * len(ranges),
+                [codec] * len(ranges),
+            )
+            # number the chunks of all ranges in order
+            chunkno = 0
+            for shards in results:
+                for path, shard in shards:
+                    name = _chunk_name(chunkno, codec)
+                    os.replace(path, destdir / name)
+                    done(shard._replace(name=name))
+                    chunkno += 1
+    return written
+
+
+def _chunk_name(chunkno: int, codec: str) -> str:
+    ext = indexed.EXTENSION if codec == indexed.CODEC else EXTENSIONS[codec]
+    return f"part.{chunkno:05d}{ext}"
+
+
+def _byte_ranges(filepath: str, num_ranges: int) -> List[Tuple[int, int]]:
+    """Divides a file into about num_ranges byte ranges of about the same size, each ending at a line end."""
+    size = os.path.getsize(filepath)
+    bounds = [0]
+    with open(filepath, "rb") as infh:
+        for i in range(1, num_ranges):
+            pos = max(size * i // num_ranges, bounds[-1] + 1)
+            if pos >= size:
+                break
+            # to the start of the line that pos - 1 is part of
+            infh.seek(pos - 1)
+            infh.readline()
+            if infh.tell() >= size:
+                break
+            bounds.append(infh.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _read_chunks(infh, split_size: int, limit: int = None):
+    """
+    Reads a binary file from its current position (up to limit bytes), and returns its lines in
+    chunks of split_size lines, each as one block of bytes with its carriage returns removed.
+    """
+    lines = []
+    partial = b""
+    while limit is None or limit > 0:
+        block = infh.read(SPLIT_BLOCK_SIZE if limit is None else min(SPLIT_BLOCK_SIZE, limit))
+        if not block:
+            break
+        if limit is not None:
+            limit -= len(block)
+        block_lines = (partial + block.replace(b"\r", b"")).split(b"\n")
+        partial = block_lines.pop()
+        while block_lines:
+            take = split_size - len(lines)
+            lines += block_lines[:take]
+            del block_lines[:take]
+            if len(lines) == split_size:
+                yield b"\n".join(lines) + b"\n"
+                lines = []
+    if partial:
+        lines.append(partial)
+    if lines:
+        yield b"\n".join(lines) + b"\n"
+
+
+def _split_range(
+    filepath: str, byte_range: Tuple[int, int], prefix: Path, split_size: int, codec: str
+) -> List[Tuple[Path, manifest.ShardInfo]]:
+    """Splits a byte range of a file into chunks named {prefix}.NNNNN, and returns their paths and details."""
+    start, end = byte_range
+    shards = []
+    with open(filepath, "rb") as infh:
+        infh.seek(start)
+        for chunkno, data in enumerate(_read_chunks(infh, split_size, limit=end - start)):
+            path = Path(f"{prefix}.{chunkno:05d}")
+            shards.append((path, _write_chunk(path, data, codec)))
+    return shards
+
+
+def _write_chunk(path: Path, data: bytes, codec: str) -> manifest.ShardInfo:
+    """Writes a chunk (lines as bytes), renaming it into place when complete, and returns its details."""
+    if codec == indexed.CODEC:
+        num_lines = indexed.write_indexed(path, data.decode("utf-8").splitlines())
+    else:
+        # the lines as data sources read them (see UTF8File)
+        num_lines = len(data.decode("utf-8", errors="replace").splitlines())
+        tmp_path = f"{path}.tmp{EXTENSIONS[codec]}"
+        # the compression level of pigz and gzip -6, for speed
+        with open_compressed(tmp_path, "wb", compresslevel=6) as outfh:
+            outfh.write(data)
+        os.replace(tmp_path, path)
+    return _chunk_info(path, num_lines, codec)
+
+
+def _chunk_info(path: Path, num_lines: int, codec: str) -> manifest.ShardInfo:
+    """The details of a chunk just written, whose lines were counted while writing it."""
+    return manifest.ShardInfo(path.name, num_lines, os.path.getsize(path), compute_md5(str(path)), codec)
+
+
 def smart_open(filepath: str, mode: str = "rt", encoding: str = "utf-8"):
     """Convenience function for reading and writing compressed or plain text files.
 
@@ -120,11 +613,32 @@ def smart_open(filepath: str, mode: str = "rt", encoding: str = "utf-8"):
     :param encoding: The file encoding.
     :return: a file handle.
     """
-    if Path(filepath).suffix == ".gz":
-        return gzip.open(filepath, mode=mode, encoding=encoding, newline="\n")
+    if codec_of(filepath) is not None:
+        binary = open_compressed(filepath, "rb" if "r" in mode else "wb")
+        return io.TextIOWrapper(binary, encoding=encoding, newline="\n")
     return open(filepath, mode=mode, encoding=encoding, newline="\n")
 
 
+def compute_fingerprint(filepath: str) -> str:
+    """
+    Computes a fingerprint of a file, from its size, modification time, and inode, and the MD5
+    checksums of FINGERPRINT_SAMPLES blocks spread evenly over it (including its start and end).
+    It reads at most about 1 MB whatever the size of the file, and changes whenever the file is
+    rewritten, so it works as a cache key in place of a checksum of the whole file.
+
+    :param filepath: The file path as a string
+    :return: The fingerprint as a hexdigest.
+    """
+    stat = os.stat(filepath)
+    m = hashlib.md5(f"{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}".encode("utf-8"))
+    with open(filepath, "rb") as f:
+        last = max(stat.st_size - FINGERPRINT_BLOCK_SIZE, 0)
+        for i in range(FINGERPRINT_SAMPLES):
+            f.seek(last * i // (FINGERPRINT_SAMPLES - 1))
+            m.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return m.hexdigest()
+
+
 def compute_md5(filepath: str):
     """Computes an MD5 checksum over a file.
     Note that binary reading in this way is as fast as a subshell call.
@@ -335,3 +335,126 @@ def test_mixer(num_trials=100000):
 
     values = counter.values()
     assert max(values) - min(values) <= 0.01 * num_trials
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 7, 64, 1 << 20])
+@pytest.mark.parametrize("compressed", [False, True])
+def test_utf8file_streaming(tmp_path, block_size, compressed):
+    import gzip
+
+    rng = random.Random(block_size)
+    pieces = ["a", "bc", "\t", "ü", "日本", "\n", "\r", "\r\n", "\x85", " ", "\x0c", " "]
+    edge_cases = ["", "\r", "\n", "x\r", "\r\n\r\n", "x"]
+    texts = ["".join(rng.choices(pieces, k=200)) for _ in range(20)] + edge_cases
+    for i, text in enumerate(texts):
+        path = tmp_path / (f"{i}.gz" if compressed else f"{i}.txt")
+        data = text.encode("utf-8")
+        path.write_bytes(gzip.compress(data) if compressed else data)
+        lines = [str(line) for line in UTF8File(str(path), block_size=block_size)]
+        assert lines == [str(Line(line)) for line in text.splitlines()]
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_datasource_prefetch(tmp_path, shuffle):
+    import gzip
+
+    for i in range(7):
+        with gzip.open(tmp_path / f"part.{i:05d}.gz", "wt") as outfh:
+            for j in range(10):
+                print(f"chunk {i} line {j}", file=outfh)
+
+    def take(prefetch, n=200):
+        source = DataSource(str(tmp_path), buffer_size=25, seed=4, shuffle=shuffle, prefetch=prefetch)
+        return [str(next(source)) for _ in range(n)]
+
+    # prefetching changes when chunks are read, not what is read
+    assert take(prefetch=3) == take(prefetch=0)
+
+    # nor does packing the shuffle buffer
+    source = DataSource(str(tmp_path), buffer_size=25, seed=4, shuffle=shuffle, packed=True)
+    assert [str(next(source)) for _ in range(200)] == take(prefetch=0)
+
+
+def test_chunk_prefetch_checkpoint():
+    from infinibatch.iterators import create_source_iterator
+
+    refs = list(range(10))
+    read = lambda ref: [f"{ref}.{j}" for j in range(3)]
+    chunks = ChunkPrefetchIterator(create_source_iterator(refs, seed=1), read, num_chunks=4)
+    [next(chunks) for _ in range(5)]
+    checkpoint = chunks.getstate()
+    expected = [next(chunks) for _ in range(12)]
+    chunks.setstate(checkpoint)
+    assert [next(chunks) for _ in range(12)] == expected
+    chunks.close()
+
+
+def test_batch_stages():
+    """Batch stages and per-line stages run through PerLine produce what the per-line stages do"""
+    lines = list(ToUpper(Tagger(Multiply(ToLines(TEST_CORPUS), n=3), tag="<2x> ")))
+
+    batches = Batched(ToLines(TEST_CORPUS), batch_size=2)
+    batches = PerLine(batches, Multiply, n=3, batch_size=3)
+    batches = BatchToUpper(BatchTagger(batches, tag="<2x> "))
+    batches = list(batches)
+    assert [len(batch) for batch in batches] == [3] * (len(TEST_CORPUS) // 3) + [len(TEST_CORPUS) % 3]
+    assert list(Unbatched(batches)) == lines
+
+
+@pytest.mark.parametrize("check", [None, 0])
+def test_columns_stages(check):
+    """Batch stages give the same results on Columns as on lists of lines"""
+
+    def stages(batches):
+        batches = BatchToUpper(batches, fields=[0], check=check)
+        batches = BatchToLower(batches, fields=[1], check=check)
+        batches = BatchTagger(BatchCopy(batches, from_field=0, to_field=2), tag="<2x> ", fields=[1])
+        return BatchJustSourceTarget(batches)
+
+    random.seed(1)
+    expected = [str(line) for line in Unbatched(stages(Batched(ToLines(TEST_CORPUS), 4)))]
+    random.seed(1)
+    batches = list(stages(ToColumns(Batched(ToLines(TEST_CORPUS), 4))))
+    assert all(isinstance(batch, Columns) for batch in batches)
+    assert [text for batch in batches for text in batch.to_strings()] == expected
+
+
+def test_batch_mixer():
+    """BatchMixer mixes Columns like lists of lines, and draws lines in proportion to the weights"""
+    sources = [[Line(f"{name}{i}\t{i}") for i in range(300)] for name in "ab"]
+
+    random.seed(1)
+    batches = list(BatchMixer([Batched(source, 7) for source in sources], [0.8, 0.2], batch_size=10))
+    random.seed(1)
+    columns = list(
+        BatchMixer([ToColumns(Batched(source, 7)) for source in sources], [0.8, 0.2], batch_size=10)
+    )
+
+    lines = [str(line) for line in Unbatched(batches)]
+    assert lines == [text for batch in columns for text in batch.to_strings()]
+    assert all(len(batch) == 10 for batch in batches)
+    # each source's lines come in order
+    for name in "ab":
+        drawn = [line for line in lines if line.startswith(name)]
+        assert drawn == [f"{name}{i}\t{i}" for i in range(len(drawn))]
+    assert 0.6 < len([line for line in lines if line.startswith("a")]) / len(lines) < 0.95
+
+
+def test_packed_shuffle():
+    from infinibatch.iterators import BlockwiseShuffleIterator, NativeCheckpointableIterator
+
+    lines = [Line(f"line {i}\tzeile {i}") for i in range(100)] + [Line("padded \tfield")]
+    source = lambda: NativeCheckpointableIterator(lines)
+    expected = [str(line) for line in BlockwiseShuffleIterator(source(), 16, seed=3)]
+    assert [str(line) for line in PackedShuffleIterator(source(), 16, seed=3)] == expected
+
+    # by memory: the first block is full with 8 lines of 14 bytes, 9 offsets, and 8 flags
+    shuffled = PackedShuffleIterator(source(), block_bytes=8 * 14 + 9 * 8 + 8, seed=3)
+    output = [next(shuffled) for _ in range(20)]
+    assert sorted(map(str, output[:8])) == sorted(map(str, lines[:8]))
+
+    checkpoint = shuffled.getstate()
+    rest = [str(line) for line in shuffled]
+    shuffled.setstate(checkpoint)
+    assert [str(line) for line in shuffled] == rest
+    assert sorted(map(str, output + rest)) == sorted(map(str, lines))
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream import bench
+
+
+@pytest.mark.parametrize("distribution", bench.LENGTH_DISTRIBUTIONS)
+def test_synthetic_corpus(tmp_path, distribution):
+    corpus = bench.SyntheticCorpus(num_fields=3, mean_length=10, max_length=30, distribution=distribution)
+    corpus.write(tmp_path, num_lines=25, shard_size=10)
+
+    shards = sorted(path.name for path in tmp_path.iterdir())
+    assert shards == ["part.00000.gz", "part.00001.gz", "part.00002.gz"]
+    lines = []
+    for shard in shards:
+        with gzip.open(tmp_path / shard, "rt") as infh:
+            lines.extend(infh.read().splitlines())
+    assert len(lines) == 25
+    for line in lines:
+        fields = line.split("\t")
+        assert len(fields) == 3
+        assert all(1 <= len(field.split(" ")) <= 30 for field in fields)
+
+
+def test_bench(tmp_path):
+    output = tmp_path / "report.json"
+    args = ["--corpus-lines", "2000", "--shard-lines", "500", "-n", "1", "2", "-b", "500", "-q", "100"]
+    args += ["--lines", "3000", "--workdir", str(tmp_path), "--output", str(output)]
+    bench.main(args)
+
+    report = json.loads(output.read_text())
+    assert [result["num_processes"] for result in report["results"]] == [1, 2]
+    for result in report["results"]:
+        assert result["lines"] >= 3000
+        assert result["lines_per_second"] > 0
+        assert result["time_to_first_line"] <= result["seconds"]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import subprocess
+import sys
+import time
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.utils import cache
+from sotastream.utils.split import split_file_into_chunks
+
+
+@pytest.fixture(autouse=True)
+def release():
+    yield
+    cache.release()
+
+
+def write_corpus(path, num_lines, offset=0):
+    with gzip.open(path, "wt") as outfh:
+        for i in range(num_lines):
+            print(f"source {i + offset}\ttarget {i + offset}", file=outfh)
+
+
+def split(tmp_path, name, last_used):
+    if not (tmp_path / name).exists():
+        write_corpus(tmp_path / name, 1000, offset=len(name))
+    splitdir = split_file_into_chunks(str(tmp_path / name), tmpdir=str(tmp_path / "cache"), split_size=100)
+    os.utime(splitdir / cache.LAST_USED_FILE, (last_used, last_used))
+    return splitdir
+
+
+def test_evict(tmp_path):
+    now = time.time()
+    old, older, oldest = (
+        split(tmp_path, f"{name}.gz", now - i * 100) for i, name in enumerate(["a", "bb", "ccc"])
+    )
+    assert [entry.path for entry in cache.entries(tmp_path / "cache")] == [oldest, older, old]
+    size = sum(entry.bytes for entry in cache.entries(tmp_path / "cache"))
+
+    # in use by this process
+    assert cache.evict(tmp_path / "cache", 0) == []
+    cache.release()
+
+    # least recently used first, until within the budget
+    cache.hold(older)
+    removed = cache.evict(tmp_path / "cache", size - 1)
+    assert [entry.path for entry in removed] == [oldest]
+    removed = cache.evict(tmp_path / "cache", 0)
+    assert [entry.path for entry in removed] == [old]
+    assert older.exists()
+
+    # a removed directory is split again
+    cache.release()
+    cache.evict(tmp_path / "cache", 0)
+    assert split(tmp_path, "a.gz", now) == old and (old / ".done").exists()
+
+
+def test_cache_command(tmp_path, capsys):
+    now = time.time()
+    splitdirs = [split(tmp_path, f"{name}.gz", now - i * 100) for i, name in enumerate(["a", "bb"])]
+    (tmp_path / "cache" / f"{'0' * 32}{cache.TMP_SUFFIX}1").mkdir()
+    # not a split directory
+    (tmp_path / "cache" / "models").mkdir()
+    cache.release()
+
+    cache.main(["--split-tmpdir", str(tmp_path / "cache"), "list"])
+    listing = capsys.readouterr().out
+    assert "3 directories" in listing and "unfinished" in listing and str(tmp_path / "a.gz") in listing
+
+    assert cache.main(["--split-tmpdir", str(tmp_path / "cache"), "verify"]) == 1
+    cache.main(["--split-tmpdir", str(tmp_path / "cache"), "prune"])
+    assert sorted(path for path in (tmp_path / "cache").iterdir() if path.is_dir()) == sorted(
+        splitdirs + [tmp_path / "cache" / "models"]
+    )
+    assert cache.main(["--split-tmpdir", str(tmp_path / "cache"), "verify"]) == 0
+
+    # a damaged shard
+    with open(splitdirs[0] / "part.00003.gz", "r+b") as fh:
+        fh.seek(20)
+        fh.write(b"\0\0\0\0")
+    assert cache.main(["--split-tmpdir", str(tmp_path / "cache"), "verify", splitdirs[0].name]) == 1
+    # which is the exit code of the command
+    result = subprocess.run(
+        [sys.executable, "-m", "sotastream", "cache", "--split-tmpdir", str(tmp_path / "cache"), "verify"],
+        capture_output=True,
+    )
+    assert result.returncode == 1
+
+    cache.main(["--split-tmpdir", str(tmp_path / "cache"), "prune", "--older-than", str(50 / 86400)])
+    assert [path.exists() for path in splitdirs] == [True, False]
+
+    cache.main(["--split-tmpdir", str(tmp_path / "cache"), "prune", "--all"])
+    assert not splitdirs[0].exists() and (tmp_path / "cache" / "models").exists()
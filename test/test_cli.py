@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import subprocess
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.cli import (
+    OutputWriter,
+    WorkerPool,
+    create_parser,
+    maybe_split_files,
+    parse_max_epochs,
+    parse_size,
+    receive_when_ready,
+)
+
+from sotastream.transport import decode_frame
+from sotastream.utils import metrics
+
+from test_augmentors import TEST_CORPUS
+
+
+@pytest.mark.parametrize("queue_size", [0, 1, 4])
+def test_output_writer(queue_size):
+    output = io.BytesIO()
+    writer = OutputWriter(output, queue_size=queue_size, buffer_size=10)
+    payloads = [f"line {i}\tzeile {i}\n".encode("utf-8") for i in range(1000)]
+    for payload in payloads:
+        writer.write(memoryview(payload))
+    writer.close()
+
+    assert output.getvalue() == b"".join(payloads)
+    assert writer.high_water_mark <= queue_size
+
+
+class BrokenOutput(io.BytesIO):
+    def write(self, data):
+        raise BrokenPipeError()
+
+
+def test_output_writer_error():
+    writer = OutputWriter(BrokenOutput(), queue_size=2, buffer_size=10)
+    with pytest.raises(BrokenPipeError):
+        for i in range(1000):
+            writer.write(b"0123456789\n")
+        writer.close()
+
+
+def test_worker_restart(tmp_path):
+    with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+        for line in TEST_CORPUS:
+            print(line, file=outfh)
+    args = create_parser().parse_args(
+        ["-n", "2", "-b", "10", "-q", "5", "--seed", "1", "default", str(tmp_path)]
+    )
+    maybe_split_files(args)
+
+    pool = WorkerPool(args, 2, max_restarts=1)
+    stall_time = [0.0, 0.0]
+    try:
+        frames = receive_when_ready(pool, stall_time)
+        for _ in range(10):
+            next(frames)
+        pool.processes[0].kill()
+        for _ in range(100):
+            next(frames)
+        assert pool.restarts == [1, 0]
+        assert pool.active == [0, 1] and not pool.failed
+        frames.close()
+    finally:
+        pool.terminate()
+
+
+def test_collect_metrics(tmp_path):
+    with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+        for line in TEST_CORPUS:
+            print(line, file=outfh)
+    args = create_parser().parse_args(
+        ["-n", "2", "-b", "10", "-q", "5", "--metrics-interval", "1000", "default", str(tmp_path)]
+    )
+    maybe_split_files(args)
+
+    # the workers send their metrics when asked, long before they are due
+    pool = WorkerPool(args, 2)
+    try:
+        frames = receive_when_ready(pool, [0.0, 0.0])
+        for _ in range(10):
+            next(frames)
+        frames.close()
+        snapshots = {}
+        for worker_id, frame in pool.collect_metrics():
+            snapshots[worker_id] = metrics.decode_snapshot(decode_frame(frame)[-1])
+        assert sorted(snapshots) == [0, 1]
+    finally:
+        pool.terminate()
+
+
+def test_parse_size():
+    assert parse_size("512M") == 512 * 2**20
+    assert parse_size("1.5g") == 3 * 2**29
+    assert parse_size("64KB") == 64 * 1024
+    assert parse_size("1000") == 1000
+    with pytest.raises(Exception):
+        parse_size("lots")
+
+
+def test_max_epochs(tmp_path):
+    assert parse_max_epochs("2.5") == (None, 2.5)
+    assert parse_max_epochs("parallel=3") == ("parallel", 3.0)
+    with pytest.raises(Exception):
+        parse_max_epochs("parallel=0")
+
+    args = create_parser().parse_args(["--max-epochs", "parallel_data=2", "default", str(tmp_path)])
+    maybe_split_files(args)
+    assert args.source_max_epochs == {str(tmp_path): 2.0}
+    args = create_parser().parse_args(["--max-epochs", "backtrans=2", "default", str(tmp_path)])
+    with pytest.raises(ValueError):
+        maybe_split_files(args)
+
+    # reported as a usage error by the command line
+    result = subprocess.run(
+        [sys.executable, "-m", "sotastream", "--max-epochs", "backtrans=2", "default", str(tmp_path)],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 2
+    assert "unknown data source backtrans" in result.stderr and "Traceback" not in result.stderr
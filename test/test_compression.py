@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.augmentors import DataSource, UTF8File
+from sotastream.utils.compression import EXTENSIONS, codec_of, open_compressed
+from sotastream.utils.split import _byte_ranges, split_native, split_parallel, split_subshell
+
+from test_augmentors import TEST_CORPUS
+
+
+def available(codec):
+    if codec == "gz":
+        return True
+    module = {"zst": "zstandard", "lz4": "lz4"}[codec]
+    tool = {"zst": "zstd", "lz4": "lz4"}[codec]
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return shutil.which(tool) is not None
+
+
+CODECS = [
+    pytest.param(codec, marks=pytest.mark.skipif(not available(codec), reason=f"no {codec} support"))
+    for codec in EXTENSIONS
+]
+
+
+def write_corpus(path):
+    with open_compressed(path, "wb") as outfh:
+        outfh.write(("\n".join(TEST_CORPUS) + "\n").encode("utf-8"))
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_roundtrip(tmp_path, codec):
+    path = tmp_path / f"corpus.tsv{EXTENSIONS[codec]}"
+    assert codec_of(path) == codec
+    write_corpus(path)
+    with open_compressed(path) as infh:
+        assert infh.read() == ("\n".join(TEST_CORPUS) + "\n").encode("utf-8")
+    assert [str(line) for line in UTF8File(str(path))] == TEST_CORPUS
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("split", [split_native, split_subshell, split_parallel])
+def test_split(tmp_path, codec, split):
+    if split is split_subshell and shutil.which("pigz") is None:
+        pytest.skip("pigz is not installed")
+    corpus = tmp_path / "corpus.tsv.gz"
+    write_corpus(corpus)
+    destdir = tmp_path / "split"
+    destdir.mkdir()
+    split(str(corpus), destdir, 4, codec=codec)
+
+    shards = sorted(destdir.iterdir())
+    assert shards and all(codec_of(shard) == codec for shard in shards)
+    lines = [str(line) for shard in shards for line in UTF8File(str(shard))]
+    assert lines == TEST_CORPUS
+
+    # DataSource picks up the shards whatever their codec
+    source = DataSource(str(destdir), buffer_size=100, shuffle=False)
+    assert sorted(str(next(source)) for _ in TEST_CORPUS) == sorted(TEST_CORPUS)
+
+
+@pytest.mark.parametrize("codec", CODECS + ["indexed"])
+def test_split_parallel_ranges(tmp_path, codec):
+    corpus = tmp_path / "corpus.tsv"
+    lines = [f"line {i}\tzeile {i}" for i in range(1000)]
+    corpus.write_bytes(("\r\n".join(lines) + "\n").encode("utf-8"))
+
+    ranges = _byte_ranges(str(corpus), 7)
+    assert len(ranges) == 7 and ranges[0][0] == 0 and ranges[-1][1] == corpus.stat().st_size
+    data = corpus.read_bytes()
+    assert all(
+        data[end - 1 : end] == b"\n" and end == next_start
+        for (_, end), (next_start, _) in zip(ranges, ranges[1:])
+    )
+
+    destdir = tmp_path / "split"
+    destdir.mkdir()
+    split_parallel(str(corpus), destdir, 30, codec=codec, processes=7)
+    shards = sorted(destdir.iterdir())
+    assert [shard.name for shard in shards] == [f"part.{i:05d}{shards[0].suffix}" for i in range(len(shards))]
+    # carriage returns are removed, and the lines are in order
+    assert [str(line) for shard in shards for line in UTF8File(str(shard))] == lines
@@ -8,6 +8,7 @@ sys.dont_write_bytecode = True
 import pytest
 
 from sotastream.data import Line
+from sotastream.augmentors import Batched, ToColumns, ToRows, Unbatched
 from sotastream.filters import *
 
 from test_augmentors import ToLines, TEST_CORPUS
@@ -34,3 +35,36 @@ def test_bitext_filter(corpus):
 
         assert len(wholeline) == length
         assert len(bitextline) == min(length, 2)
+
+
+def test_batch_filters():
+    lines = ["a\tb\tc", "\tb", "c\td", "e\t", "x\ty"]
+    expected = [str(line) for line in BitextFilter(RegexFilter(SkipBlanks(ToLines(lines)), pattern="c"))]
+
+    batches = BatchBitextFilter(BatchRegexFilter(BatchSkipBlanks(Batched(ToLines(lines), 2)), pattern="c"))
+    assert [[str(line) for line in batch] for batch in batches] == [["a\tb"], [], ["x\ty"]]
+    assert expected == ["a\tb", "x\ty"]
+
+    # the requested fields only, however many lines were skipped
+    lines = ["a\tb\tc", "a\t\tc", "a\tb\t", "\tb\tc", "a\tb\tc"]
+    fields = [1, 2]
+    batches = BatchSkipBlanks(Batched(ToLines(lines), 2), fields=fields)
+    assert [str(line) for batch in batches for line in batch] == ["a\tb\tc", "\tb\tc", "a\tb\tc"]
+    fields = [0, 1, 2]
+    batches = BatchSkipBlanks(Batched(ToLines(lines), 2), fields=fields)
+    assert [str(line) for batch in batches for line in batch] == ["a\tb\tc", "a\tb\tc"]
+    assert fields == [0, 1, 2]
+
+
+def test_length_filters():
+    lines = ["a b c\td e", "a\tb c d e f g", "\tb", "a b\tc", "a b c d e f\tg h i j k l", "x"]
+    filters = dict(min_length=1, max_length=5, max_ratio=3)
+    expected = [str(line) for line in LengthFilter(ToLines(lines), **filters)]
+    assert expected == ["a b c\td e", "a b\tc"]
+
+    for batches in (Batched(ToLines(lines), 4), ToColumns(Batched(ToLines(lines), 4))):
+        kept = [str(line) for line in Unbatched(ToRows(BatchLengthFilter(batches, **filters)))]
+        assert kept == expected
+
+    kept = [str(line) for line in LengthFilter(ToLines(lines), max_length=10, unit="chars")]
+    assert kept == ["a b c\td e", "a b\tc"]
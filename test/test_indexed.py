@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.augmentors import DataSource, UTF8File
+from sotastream.data import Line
+from sotastream.utils.indexed import IndexedShard, IndexedShardIterator, write_indexed
+from sotastream.utils.split import split_file_into_chunks
+
+from test_augmentors import TEST_CORPUS
+from test_line import inputs
+
+
+def write_shards(dirpath, num_shards, num_lines):
+    for i in range(num_shards):
+        write_indexed(dirpath / f"part.{i:05d}.sidx", (f"shard {i} line {j}" for j in range(num_lines)))
+
+
+def test_roundtrip(tmp_path):
+    path = tmp_path / "part.00000.sidx"
+    assert write_indexed(path, TEST_CORPUS + inputs) == len(TEST_CORPUS + inputs)
+    shard = IndexedShard(path)
+    assert len(shard) == len(TEST_CORPUS + inputs)
+    assert shard[3] == TEST_CORPUS[3]
+    assert list(shard) == TEST_CORPUS + inputs
+    shard.close()
+    assert [str(line) for line in UTF8File(str(path))] == [str(Line(line)) for line in TEST_CORPUS + inputs]
+
+    write_indexed(path, [])
+    assert len(IndexedShard(path)) == 0
+
+    path.write_bytes(path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        IndexedShard(path)
+
+
+def test_shuffle(tmp_path):
+    write_shards(tmp_path, 3, 20)
+    paths = [str(path) for path in sorted(tmp_path.iterdir())]
+
+    lines = IndexedShardIterator(paths, seed=1)
+    epochs = [[next(lines) for _ in range(60)] for _ in range(2)]
+    # every pass is a permutation of all lines, shard by shard, and passes differ
+    for epoch in epochs:
+        assert sorted(epoch) == sorted(line for path in paths for line in IndexedShard(path))
+        assert all(len({line.split()[1] for line in epoch[i : i + 20]}) == 1 for i in range(0, 60, 20))
+    assert epochs[0] != epochs[1]
+    assert next(IndexedShardIterator(paths, seed=1)) == epochs[0][0]
+
+    unshuffled = IndexedShardIterator(paths, shuffle=False)
+    assert [next(unshuffled) for _ in range(60)] == [
+        f"shard {i} line {j}" for i in range(3) for j in range(20)
+    ]
+
+    # each instance gets its own shards
+    ranks = [IndexedShardIterator(paths, seed=1, num_instances=2, instance_rank=rank) for rank in range(2)]
+    assert {next(ranks[0]).split()[1] for _ in range(40)} == {"0", "2"}
+    assert {next(ranks[1]).split()[1] for _ in range(20)} == {"1"}
+
+
+def test_checkpoint(tmp_path):
+    write_shards(tmp_path, 3, 7)
+    lines = IndexedShardIterator([str(path) for path in tmp_path.iterdir()], seed=2)
+    [next(lines) for _ in range(19)]
+    checkpoint = lines.getstate()
+    expected = [next(lines) for _ in range(30)]
+    lines.setstate(checkpoint)
+    assert [next(lines) for _ in range(30)] == expected
+    lines.close()
+
+
+def test_split_and_read(tmp_path):
+    corpus = tmp_path / "corpus.gz"
+    with gzip.open(corpus, "wt") as outfh:
+        for i in range(25):
+            print(f"source {i}\ttarget {i}", file=outfh)
+
+    splitdir = split_file_into_chunks(
+        str(corpus), tmpdir=str(tmp_path / "split"), split_size=10, codec="indexed"
+    )
+    assert sorted(path.name for path in splitdir.glob("part.*")) == [f"part.0000{i}.sidx" for i in range(3)]
+
+    source = DataSource(str(splitdir), seed=3)
+    lines = [str(next(source)) for _ in range(50)]
+    assert sorted(lines) == sorted([f"source {i}\ttarget {i}" for i in range(25)] * 2)
@@ -7,7 +7,7 @@ sys.dont_write_bytecode = True
 
 import pytest
 
-from sotastream.data import Line
+from sotastream.data import Columns, Line
 
 from test_augmentors import TEST_CORPUS, ToLines
 from itertools import zip_longest
@@ -38,3 +38,53 @@ def test_str(text):
     line = Line(text)
     assert str(line) == text
     assert len(line) == len(text.split("\t"))
+
+
+def test_str_passthrough():
+    text = "Das ist ein Test\tThis is a test."
+    # an untouched line hands back the very same string
+    assert str(Line(text)) is text
+
+    # fields are stripped as before
+    assert str(Line("a \tb\r\tc ")) == "a\tb\tc"
+    assert Line("a \tb") == Line("a\tb")
+
+
+@pytest.mark.parametrize("text", inputs)
+@pytest.mark.parametrize("end_range", [0, 1, 2, 3, 10])
+def test_project(text, end_range):
+    expected = "\t".join(text.split("\t")[:end_range])
+    assert str(Line(text).project(end_range)) == expected
+
+    parsed = Line(text)
+    parsed[0]
+    assert str(parsed.project(end_range)) == expected
+
+
+def test_lazy_mutation():
+    line = Line("a\tb")
+    line.fields.append("c")
+    assert str(line) == "a\tb\tc"
+
+    line = Line("a\tb")
+    line[3] = "d"
+    assert str(line) == "a\tb\t\td"
+    assert copy(Line("a\tb")) == Line(fields=["a", "b"])
+
+
+def test_columns():
+    batch = Columns.from_lines(ToLines(inputs))
+    assert len(batch) == len(inputs)
+    assert len(batch.fields) == 5
+    assert batch.to_strings() == inputs
+    assert [str(line) for line in batch.to_lines()] == inputs
+    assert list(batch.lengths(0)) == [0, 0, 4, 11, 2, 3]
+    assert list(batch.lengths(1, unit="chars")) == [0, 29, 0, 0, 7, 9]
+
+    assert batch.rows(1, 3).to_strings() == inputs[1:3]
+    assert batch.take([5, 0]).to_strings() == [inputs[5], inputs[0]]
+    assert batch.select([i % 2 == 1 for i in range(len(inputs))]).to_strings() == inputs[1::2]
+    assert Columns.concat([batch.rows(0, 2), batch.rows(2, 6)]).to_strings() == inputs
+
+    batch.project(2)
+    assert batch.to_strings() == [str(Line(text).project(2)) for text in inputs]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.augmentors import DataSource
+from sotastream.utils import manifest
+from sotastream.utils.split import split_file_into_chunks
+
+from test_indexed import write_shards
+
+
+def write_corpus(path, num_lines):
+    with gzip.open(path, "wt") as outfh:
+        for i in range(num_lines):
+            print(f"source {i}\ttarget {i}", file=outfh)
+
+
+@pytest.mark.parametrize("codec", ["gz", "indexed"])
+def test_split_writes_manifest(tmp_path, codec):
+    write_corpus(tmp_path / "corpus.gz", 25)
+    splitdir = split_file_into_chunks(
+        str(tmp_path / "corpus.gz"), tmpdir=str(tmp_path / "split"), split_size=10, codec=codec, native=True
+    )
+    shards = manifest.read_manifest(str(splitdir))
+    assert len(shards) == 3 and sum(shard.lines for shard in shards) == 25
+    assert all(shard.codec == codec for shard in shards)
+    assert shards[0] == manifest.shard_info(str(splitdir / shards[0].name))
+    with open(splitdir / manifest.NAME) as infh:
+        assert json.load(infh)["lines"] == 25
+
+    # cached splits from before manifests get one
+    (splitdir / manifest.NAME).unlink()
+    split_file_into_chunks(
+        str(tmp_path / "corpus.gz"), tmpdir=str(tmp_path / "split"), split_size=10, codec=codec, native=True
+    )
+    assert manifest.read_manifest(str(splitdir)) == shards
+
+
+def test_manifest_command(tmp_path):
+    write_shards(tmp_path, 2, 4)
+    assert manifest.read_manifest(str(tmp_path)) is None
+    manifest.main([str(tmp_path)])
+    shards = manifest.read_manifest(str(tmp_path))
+    assert [(shard.name, shard.lines) for shard in shards] == [("part.00000.sidx", 4), ("part.00001.sidx", 4)]
+
+
+def test_datasource_uses_manifest(tmp_path):
+    for i, num_lines in enumerate([30, 10, 10, 10]):
+        with gzip.open(tmp_path / f"part.{i:05d}.gz", "wt") as outfh:
+            for j in range(num_lines):
+                print(f"shard {i} line {j}", file=outfh)
+    manifest.write_manifest(str(tmp_path))
+    # not in the manifest, so not read
+    write_corpus(tmp_path / "part.00004.gz", 10)
+
+    # balanced by line count: the big shard on its own
+    seen = []
+    for worker_id in range(2):
+        source = DataSource(str(tmp_path), buffer_size=30, seed=1, worker_id=worker_id, num_workers=2)
+        seen.append({str(next(source)).split()[1] for _ in range(30)})
+    assert sorted(seen) == [{"0"}, {"1", "2", "3"}]
+
+    # more workers than shards: line ranges of the shards
+    seen = []
+    for worker_id in range(6):
+        source = DataSource(str(tmp_path), buffer_size=10, seed=1, worker_id=worker_id, num_workers=6)
+        seen.append({str(next(source)) for _ in range(10)})
+    assert all(len(lines) == 10 for lines in seen)
+    assert len(set.union(*seen)) == 60
+
+
+@pytest.mark.parametrize("with_manifest", [False, True])
+@pytest.mark.parametrize("packed", [False, True])
+def test_datasource_max_epochs(tmp_path, with_manifest, packed):
+    for i in range(3):
+        with gzip.open(tmp_path / f"part.{i:05d}.gz", "wt") as outfh:
+            for j in range(7):
+                print(f"shard {i} line {j}", file=outfh)
+    if with_manifest:
+        manifest.write_manifest(str(tmp_path))
+
+    # each worker ends after 1.5 passes over its share, whether or not its size was known up front
+    lines = []
+    for worker_id in range(2):
+        source = DataSource(
+            str(tmp_path),
+            buffer_size=10,
+            seed=1,
+            worker_id=worker_id,
+            num_workers=2,
+            max_epochs=1.5,
+            packed=packed,
+        )
+        lines += [str(line) for line in source]
+    assert len(lines) == 21 + 11
+    assert set(lines) <= {f"shard {i} line {j}" for i in range(3) for j in range(7)}
+
+
+@pytest.mark.parametrize("with_manifest", [False, True])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_datasource_one_epoch(tmp_path, with_manifest, prefetch):
+    for i in range(3):
+        with gzip.open(tmp_path / f"part.{i:05d}.gz", "wt") as outfh:
+            for j in range(70):
+                print(f"shard {i} line {j}", file=outfh)
+    if with_manifest:
+        manifest.write_manifest(str(tmp_path))
+
+    # every line once, although the shuffle buffer is not a multiple of the pass
+    source = DataSource(str(tmp_path), buffer_size=50, seed=1, max_epochs=1, prefetch=prefetch)
+    assert sorted(str(line) for line in source) == sorted(
+        f"shard {i} line {j}" for i in range(3) for j in range(70)
+    )
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.augmentors import Mixer
+from sotastream.data import Line
+from sotastream.filters import RegexFilter, SkipBlanks
+from sotastream.utils import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def values(samples, name):
+    return {
+        tuple(sorted(labels.items())): value for sample_name, labels, value in samples if sample_name == name
+    }
+
+
+def test_counters_and_gauges():
+    c = metrics.counter("test_total", kind="a")
+    c.value += 2
+    c.inc()
+    assert metrics.counter("test_total", kind="a") is c
+    metrics.gauge("test_gauge", lambda: 42)
+
+    samples = metrics.snapshot()
+    assert ("test_total", {"kind": "a"}, 3) in samples
+    assert ("test_gauge", {}, 42) in samples
+    assert metrics.decode_snapshot(metrics.encode_snapshot(samples)) == samples
+
+    text = metrics.format_prometheus(samples)
+    assert '# TYPE test_total counter\ntest_total{kind="a"} 3\n' in text
+    assert '# TYPE test_gauge gauge\ntest_gauge 42\n' in text
+    assert metrics.parse_prometheus(text) == [("test_gauge", {}, 42), ("test_total", {"kind": "a"}, 3)]
+
+    escaped = [("test_total", {"path": 'a "b"\\c'}, 1)]
+    assert metrics.parse_prometheus(metrics.format_prometheus(escaped)) == escaped
+
+
+def test_mixer_and_filter_metrics():
+    mixer = Mixer([iter(["a"] * 100), iter(["b"] * 100)], [0.5, 0.5], name="test")
+    drawn = [next(mixer) for _ in range(50)]
+    draws = values(metrics.snapshot(), "sotastream_mixer_draws_total")
+    assert draws[(("mixer", "test"), ("source", "0"))] == drawn.count("a")
+    assert draws[(("mixer", "test"), ("source", "1"))] == drawn.count("b")
+
+    lines = [Line("a\tb"), Line("\tb"), Line("c\td"), Line("e\t")]
+    kept = list(RegexFilter(SkipBlanks(lines), pattern="c"))
+    assert len(kept) == 1
+    dropped = values(metrics.snapshot(), "sotastream_filter_dropped_total")
+    assert dropped == {(("filter", "SkipBlanks"),): 2, (("filter", "RegexFilter"),): 1}
+
+
+def test_stream_metrics(tmp_path):
+    stream_metrics = metrics.StreamMetrics(2, stall_time=[0.5, 0.0], restarts=[0, 1])
+    stream_metrics.add_batch(0, 10, 100, 30)
+    stream_metrics.add_batch(1, 5, 50, 15)
+    stream_metrics.set_worker_snapshot(0, [("sotastream_filter_dropped_total", {"filter": "X"}, 3)])
+    stream_metrics.set_worker_snapshot(1, [("sotastream_filter_dropped_total", {"filter": "X"}, 4)])
+
+    samples = stream_metrics.samples()
+    assert values(samples, "sotastream_lines_total") == {(): 15}
+    assert values(samples, "sotastream_worker_bytes_total") == {(("worker", 0),): 100, (("worker", 1),): 50}
+    assert values(samples, "sotastream_worker_restarts_total")[(("worker", 1),)] == 1
+    dropped = values(samples, "sotastream_filter_dropped_total")
+    assert dropped[(("filter", "X"), ("worker", 0))] == 3
+    assert dropped[(("filter", "X"), ("worker", "all"))] == 7
+
+    path = tmp_path / "metrics.prom"
+    stream_metrics.write(str(path))
+    assert "sotastream_tokens_total 45\n" in path.read_text()
+
+
+def test_stream_metrics_writer(tmp_path):
+    stream_metrics = metrics.StreamMetrics(1)
+    stream_metrics.add_batch(0, 10, 100, 30)
+    path = tmp_path / "metrics.prom"
+    # written on schedule, without any batches arriving
+    stream_metrics.start_writing(str(path), 0.05)
+    try:
+        for _ in range(100):
+            if path.exists():
+                break
+            time.sleep(0.05)
+        assert "sotastream_lines_total 10\n" in path.read_text()
+    finally:
+        stream_metrics.stop_writing()
+
+    # logging does not reset the recent rates of the next report
+    stream_metrics.add_batch(0, 10, 100, 30)
+    stream_metrics.log()
+    recent = values(stream_metrics.samples(), "sotastream_recent_lines_per_second")[()]
+    assert recent > 0
+    assert values(stream_metrics.samples(), "sotastream_recent_lines_per_second")[()] == 0
+
+
+def test_source_progress():
+    stream_metrics = metrics.StreamMetrics(2)
+    for worker_id, (lines, epoch_lines) in enumerate([(25, 10), (30, 20)]):
+        samples = [
+            ("sotastream_source_lines_total", {"source": "a"}, lines),
+            ("sotastream_source_epoch_lines", {"source": "a"}, epoch_lines),
+            ("sotastream_source_lines_total", {"source": "b"}, 7),
+            ("sotastream_source_epoch_lines", {"source": "b"}, 5 if worker_id == 0 else 0),
+        ]
+        stream_metrics.set_worker_snapshot(worker_id, samples)
+
+    sources = stream_metrics.sources()
+    assert sources["a"] == {
+        "lines": 55,
+        "epoch_lines": 30,
+        "epochs": round(55 / 30, 4),
+        "full_epochs": 1,
+        "worker_epochs": [2.5, 1.5],
+    }
+    # the size of b is not known to all workers yet
+    assert sources["b"]["epochs"] is None and sources["b"]["worker_epochs"] == [1.4, None]
+    epochs = values(stream_metrics.samples(), "sotastream_source_epochs")
+    assert epochs[(("source", "a"), ("worker", "all"))] == round(55 / 30, 4)
+    assert (("source", "b"), ("worker", "all")) not in epochs
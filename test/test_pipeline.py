@@ -7,6 +7,7 @@ least prevents breaking the pipeline builds.
 """
 
 
+import gzip
 import sys
 
 sys.dont_write_bytecode = True
@@ -75,3 +76,28 @@ def test_pipeline(name, data_sources):
             break
 
     cleanup_pipeline(data_files)
+
+
+@pytest.mark.parametrize("name, data_sources", PIPELINES)
+def test_next_batch(name, data_sources):
+    """Reading a pipeline in batches gives the same lines as iterating over it"""
+    pipeline, data_files = create_pipeline(name, data_sources)
+    lines = [str(line) for _, line in zip(range(30), pipeline)]
+    cleanup_pipeline(data_files)
+
+    pipeline, data_files = create_pipeline(name, data_sources)
+    batches = [pipeline.next_batch(n) for n in (1, 7, 4, 18)]
+    assert [len(batch) for batch in batches] == [1, 7, 4, 18]
+    assert [str(line) for batch in batches for line in batch] == lines
+    cleanup_pipeline(data_files)
+
+
+def test_next_batch_keeps_batches():
+    """next_batch() does not change the batches that the stages yield"""
+    pipeline, data_files = create_pipeline("default", [TEST_CORPUS])
+    yielded = [[Line(f"{i} {j}") for j in range(3)] for i in range(4)]
+    pipeline.batches = iter(yielded)
+    assert [str(line) for line in pipeline.next_batch(5)] == ["0 0", "0 1", "0 2", "1 0", "1 1"]
+    assert [str(line) for line in pipeline.next_batch(5)] == ["1 2", "2 0", "2 1", "2 2", "3 0"]
+    assert [len(batch) for batch in yielded] == [3, 3, 3, 3]
+    cleanup_pipeline(data_files)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from infinibatch.iterators import CheckpointableIterator
+
+from sotastream.augmentors import DataSource, Mixer, Multiply, ToUpper
+from sotastream.data import Line
+from sotastream.filters import RegexFilter
+from sotastream.utils import metrics, profiling
+
+
+@pytest.fixture(autouse=True)
+def profile_stages():
+    metrics.reset()
+    profiling.enable(sample_every=2)
+    yield
+    profiling.disable()
+    metrics.reset()
+
+
+def test_disabled():
+    profiling.disable()
+    stream = ToUpper(iter([Line("a\tb")]))
+    assert list(stream) == [Line("A\tB")]
+    assert not metrics.snapshot()
+    # class stages are left as they are
+    stream = Mixer([iter([Line("a")])], [1.0])
+    assert not hasattr(stream, "_stage_output")
+    assert str(next(stream)) == "a"
+
+
+def test_stage_counts():
+    sources = [(Line(f"line {i}\tzeile {i}") for i in range(j, 1000, 2)) for j in range(2)]
+    stream = Mixer(sources, [0.5, 0.5])
+    stream = RegexFilter(ToUpper(stream), pattern="[02468]$")
+    stream = Multiply(stream, n=3)
+    output = [line for _, line in zip(range(12), stream)]
+    assert all(len(line) == 3 and line[0] == line[2] for line in output)
+
+    report = profiling.summarize(metrics.snapshot())
+    assert set(report) == {"Mixer", "ToUpper", "RegexFilter", "Multiply"}
+    assert report["Multiply"]["items_out"] == 12
+    assert report["Multiply"]["items_in"] == 12
+    assert report["Multiply"]["drop_ratio"] == 0
+    assert report["RegexFilter"]["items_out"] == 12
+    assert report["RegexFilter"]["drop_ratio"] == round(1 - 12 / report["RegexFilter"]["items_in"], 4)
+    assert all(stage["est_seconds"] >= 0 for stage in report.values())
+    assert sum(stage["time_share"] for stage in report.values()) == pytest.approx(1, abs=0.01)
+
+
+def test_named_stages():
+    # instances of a stage given different names are reported separately
+    inner = Mixer([iter([Line("a")] * 100), iter([Line("b")] * 100)], [0.5, 0.5], name="casing")
+    stream = Mixer([inner, iter([Line("c")] * 100)], [0.5, 0.5])
+    output = [str(next(stream)) for _ in range(20)]
+
+    report = profiling.summarize(metrics.snapshot())
+    assert set(report) == {"Mixer", "Mixer[casing]"}
+    assert report["Mixer"]["items_out"] == 20
+    assert report["Mixer[casing]"]["items_out"] == sum(line != "c" for line in output)
+    assert report["Mixer"]["items_in"] == 20
+
+
+def test_stage_types(tmp_path):
+    # class stages keep their type
+    stream = Mixer([iter([Line("a")] * 10)], [1.0])
+    assert isinstance(stream, Mixer)
+
+    class NamedMixer(Mixer):
+        pass
+
+    stream = NamedMixer([iter([Line("a")] * 10)], [1.0])
+    assert [str(next(stream)) for _ in range(3)] == ["a"] * 3
+
+    # and function stages keep returning checkpointable iterators
+    with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+        for i in range(10):
+            print(f"line {i}", file=outfh)
+    source = DataSource(str(tmp_path), buffer_size=10, seed=1)
+    assert isinstance(source, CheckpointableIterator)
+    checkpoint = source.getstate()
+    lines = [str(next(source)) for _ in range(5)]
+    source.setstate(checkpoint)
+    assert [str(next(source)) for _ in range(5)] == lines
+
+    report = profiling.summarize(metrics.snapshot())
+    assert report["Mixer"]["items_out"] == 3
+    assert report["DataSource"]["items_out"] == 10
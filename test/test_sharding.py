@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.augmentors import DataSource, UTF8File
+from sotastream.utils import manifest
+from sotastream.utils.indexed import IndexedShardIterator, write_indexed
+from sotastream.utils.sharding import GrowingShardIterator, ShardPart, assign_shards, global_partition
+
+from test_indexed import write_shards
+
+
+def test_balance_whole_shards():
+    paths = [f"part.{i:05d}.gz" for i in range(6)]
+    sizes = [100, 10, 10, 50, 50, 80]
+    assignments = [assign_shards(paths, p, 3, sizes=sizes) for p in range(3)]
+    # every shard once, each partition with 100 lines
+    assert sorted(part.path for parts in assignments for part in parts) == paths
+    assert all(part.num_parts == 1 for parts in assignments for part in parts)
+    loads = [sum(sizes[paths.index(part.path)] for part in parts) for parts in assignments]
+    assert loads == [100, 100, 100]
+    # independent of the order of the paths
+    assert assign_shards(paths[::-1], 0, 3, sizes=sizes[::-1]) == assignments[0]
+
+
+def test_split_shards():
+    paths = ["a.gz", "b.gz"]
+    num_lines = {"a.gz": 30, "b.gz": 10}
+    parts = [assign_shards(paths, p, 5, num_lines=num_lines) for p in range(5)]
+    assert all(len(part) == 1 for part in parts)
+    parts = [part[0] for part in parts]
+    # in proportion to the sizes
+    assert [(part.path, part.part, part.num_parts) for part in parts] == [
+        ("a.gz", 0, 4),
+        ("a.gz", 1, 4),
+        ("a.gz", 2, 4),
+        ("a.gz", 3, 4),
+        ("b.gz", 0, 1),
+    ]
+    lines = [
+        line
+        for part in parts
+        for line in part.select(f"{part.path} {i}" for i in range(num_lines[part.path]))
+    ]
+    assert sorted(lines) == sorted(f"{path} {i}" for path in paths for i in range(num_lines[path]))
+
+    # without line counts, parts take every num_parts-th line
+    part = ShardPart("a.gz", 1, 3)
+    assert part.line_range() is None
+    assert list(part.select(range(10))) == [1, 4, 7]
+    assert list(ShardPart("a.gz", 1, 3, 10).select(range(10))) == [3, 4, 5]
+
+
+def test_global_partition(monkeypatch):
+    monkeypatch.delenv("OMPI_COMM_WORLD_SIZE", raising=False)
+    monkeypatch.delenv("OMPI_COMM_WORLD_RANK", raising=False)
+    assert global_partition(2, 4) == (2, 4)
+    monkeypatch.setenv("OMPI_COMM_WORLD_SIZE", "3")
+    monkeypatch.setenv("OMPI_COMM_WORLD_RANK", "1")
+    assert global_partition(2, 4) == (6, 12)
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_workers_share_shard(tmp_path, indexed):
+    # more workers than shards: each reads a disjoint part
+    if indexed:
+        write_shards(tmp_path, 1, 30)
+    else:
+        import gzip
+
+        with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+            for j in range(30):
+                print(f"shard 0 line {j}", file=outfh)
+
+    seen = []
+    for worker_id in range(3):
+        source = DataSource(str(tmp_path), buffer_size=10, seed=1, worker_id=worker_id, num_workers=3)
+        seen.append({str(next(source)) for _ in range(10)})
+    assert all(len(lines) == 10 for lines in seen)
+    assert set.union(*seen) == {f"shard 0 line {j}" for j in range(30)}
+
+
+def test_workers_share_shard_processed(tmp_path):
+    with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+        for j in range(30):
+            print(f"shard 0 line {j}", file=outfh)
+    manifest.write_manifest(str(tmp_path))
+
+    # the parts are taken from the lines of the shard, before a processor drops some
+    def even_lines(path):
+        return (line for line in UTF8File(path) if int(str(line).split()[-1]) % 2 == 0)
+
+    seen = []
+    for worker_id in range(3):
+        source = DataSource(
+            str(tmp_path), processChunk=even_lines, buffer_size=5, seed=1, worker_id=worker_id, num_workers=3
+        )
+        seen.append({str(next(source)) for _ in range(5)})
+    assert all(len(lines) == 5 for lines in seen)
+    assert set.union(*seen) == {f"shard 0 line {j}" for j in range(0, 30, 2)}
+
+    # which a processor that does not read the shard with UTF8File cannot do
+    def gzip_lines(path):
+        with gzip.open(path, "rt") as infh:
+            yield from infh
+
+    source = DataSource(str(tmp_path), processChunk=gzip_lines, buffer_size=10, seed=1, num_workers=3)
+    with pytest.raises(ValueError):
+        next(source)
+
+    # nor can partitions with no lines
+    source = DataSource(str(tmp_path), buffer_size=10, seed=1, worker_id=0, num_workers=32)
+    with pytest.raises(ValueError):
+        next(source)
+
+
+def test_indexed_parts(tmp_path):
+    write_indexed(tmp_path / "part.00000.sidx", (str(i) for i in range(10)))
+    path = str(tmp_path / "part.00000.sidx")
+    lines = IndexedShardIterator([ShardPart(path, 1, 2)], seed=1)
+    epoch = [next(lines) for _ in range(5)]
+    assert sorted(epoch) == ["5", "6", "7", "8", "9"]
+
+
+def test_growing_shards(tmp_path):
+    def write_shard(i, num_lines=5):
+        with gzip.open(tmp_path / f"part.{i:05d}.gz", "wt") as outfh:
+            for j in range(num_lines):
+                print(f"shard {i} line {j}", file=outfh)
+        return manifest.shard_info(str(tmp_path / f"part.{i:05d}.gz"))
+
+    shards = [write_shard(0)]
+    manifest.write_manifest(str(tmp_path), shards, complete=False)
+    chunks = [GrowingShardIterator(str(tmp_path), p, 2, seed=1) for p in range(2)]
+    # the only shard so far is partition 0's, which reads it again until there are more
+    assert [next(chunks[0]).path for _ in range(2)] == [str(tmp_path / "part.00000.gz")] * 2
+
+    # new shards join the current pass, every other one per partition
+    shards += [write_shard(i) for i in range(1, 4)]
+    manifest.write_manifest(str(tmp_path), shards, complete=False)
+    assert {os.path.basename(next(chunks[0]).path) for _ in range(4)} == {"part.00000.gz", "part.00002.gz"}
+    assert {os.path.basename(next(chunks[1]).path) for _ in range(2)} == {"part.00001.gz", "part.00003.gz"}
+
+    # once complete, assigned by size from the next pass
+    shards += [write_shard(4, 15)]
+    manifest.write_manifest(str(tmp_path), shards)
+    checkpoint = chunks[0].getstate()
+    passes = [os.path.basename(next(chunks[0]).path) for _ in range(6)]
+    chunks[0].setstate(checkpoint)
+    assert [os.path.basename(next(chunks[0]).path) for _ in range(6)] == passes
+    # a partition starting now gets the same shards as assign_shards(): by line count, the big one
+    # and one other
+    num_lines = {str(tmp_path / shard.name): shard.lines for shard in shards}
+    final = assign_shards(sorted(num_lines), 0, 2, num_lines=num_lines)
+    chunks = GrowingShardIterator(str(tmp_path), 0, 2, seed=1)
+    assert sorted(next(chunks) for _ in range(len(final))) == final
+    assert len(final) == 2 and str(tmp_path / "part.00004.gz") in {part.path for part in final}
+
+
+def test_abandoned_growing_shards(tmp_path):
+    with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+        print("shard 0 line 0", file=outfh)
+    shards = manifest.write_manifest(str(tmp_path), complete=False)
+    chunks = GrowingShardIterator(str(tmp_path))
+    assert next(chunks).path == str(tmp_path / "part.00000.gz")
+    # stopped by the process splitting it: the iterator fails instead of reading the shard forever
+    manifest.write_manifest(str(tmp_path), shards, complete=False, abandoned=True)
+    assert manifest.is_abandoned(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        next(chunks)
+
+
+def test_datasource_reads_growing_shards(tmp_path):
+    with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+        for j in range(10):
+            print(f"shard 0 line {j}", file=outfh)
+    manifest.write_manifest(str(tmp_path), complete=False)
+    source = DataSource(str(tmp_path), buffer_size=10, seed=1)
+    assert {str(next(source)) for _ in range(10)} == {f"shard 0 line {j}" for j in range(10)}
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import gzip
+import multiprocessing
+import os
+import sys
+import time
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from concurrent.futures import ProcessPoolExecutor
+
+from sotastream.utils import cache, manifest, split
+from sotastream.utils.split import compute_fingerprint, compute_md5, split_file_into_chunks, verify_split
+
+
+def write_corpus(path, num_lines, offset=0):
+    with gzip.open(path, "wt") as outfh:
+        for i in range(num_lines):
+            print(f"source {i + offset}\ttarget {i + offset}", file=outfh)
+
+
+def test_fingerprint(tmp_path, monkeypatch):
+    monkeypatch.setattr(split, "FINGERPRINT_BLOCK_SIZE", 16)
+    path = tmp_path / "corpus.gz"
+    write_corpus(path, 1000)
+    fingerprint = compute_fingerprint(str(path))
+    assert compute_fingerprint(str(path)) == fingerprint
+
+    # a changed sampled block, even with the same size and modification time
+    stat = path.stat()
+    data = bytearray(path.read_bytes())
+    data[(len(data) - 16) * 7 // (split.FINGERPRINT_SAMPLES - 1)] ^= 1
+    path.write_bytes(data)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert compute_fingerprint(str(path)) != fingerprint
+
+    # a newer modification time
+    fingerprint = compute_fingerprint(str(path))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert compute_fingerprint(str(path)) != fingerprint
+
+
+@pytest.mark.parametrize("cache_key", split.CACHE_KEYS)
+def test_split_cache(tmp_path, cache_key):
+    corpus = tmp_path / "corpus.gz"
+    write_corpus(corpus, 25)
+    splitdir = split_file_into_chunks(
+        str(corpus), tmpdir=str(tmp_path / "cache"), split_size=10, cache_key=cache_key
+    )
+    if cache_key == "md5":
+        assert splitdir.name == compute_md5(str(corpus))
+    else:
+        assert splitdir.name == f"fp-{compute_fingerprint(str(corpus))}"
+
+    # a cache hit does not split again
+    (splitdir / "part.00000.gz").unlink()
+    assert (
+        split_file_into_chunks(
+            str(corpus), tmpdir=str(tmp_path / "cache"), split_size=10, cache_key=cache_key
+        )
+        == splitdir
+    )
+    assert not (splitdir / "part.00000.gz").exists()
+
+
+def test_md5_named_split(tmp_path):
+    corpus = tmp_path / "corpus.gz"
+    write_corpus(corpus, 25)
+    cache_dir = str(tmp_path / "cache")
+    md5_dir = split_file_into_chunks(str(corpus), tmpdir=cache_dir, split_size=10, cache_key="md5")
+    # as split before checksums were recorded
+    (md5_dir / split.MD5_FILE).unlink()
+
+    # found by the path it records, with its checksum recorded from its name
+    assert split_file_into_chunks(str(corpus), tmpdir=cache_dir, split_size=10) == md5_dir
+    assert (md5_dir / split.MD5_FILE).read_text().strip() == md5_dir.name
+    assert verify_split(str(corpus), md5_dir)
+
+    # but not once the file has changed since, even if it keeps its modification time (as with cp -p)
+    stat = corpus.stat()
+    time.sleep(0.01)
+    write_corpus(corpus, 25, offset=1)
+    os.utime(corpus, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.utime(md5_dir / ".done", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    splitdir = split_file_into_chunks(str(corpus), tmpdir=cache_dir, split_size=10)
+    assert splitdir.name == f"fp-{compute_fingerprint(str(corpus))}"
+
+
+@pytest.mark.parametrize("native,codec", [(True, "gz"), (False, "indexed")])
+def test_split_manifest(tmp_path, native, codec):
+    # the details of the chunks as counted while splitting, the same as read from them
+    corpus = tmp_path / "corpus.gz"
+    write_corpus(corpus, 25)
+    with gzip.open(corpus, "at") as outfh:
+        print("source\x0b25\ttarget 25", file=outfh)
+    splitdir = split_file_into_chunks(
+        str(corpus), tmpdir=str(tmp_path / "cache"), split_size=10, native=native, codec=codec
+    )
+    shards = manifest.read_manifest(str(splitdir))
+    assert shards == [manifest.shard_info(path) for path in manifest.list_shards(str(splitdir))]
+    assert sum(shard.lines for shard in shards) == 27
+
+
+def test_verify_split(tmp_path):
+    corpus = tmp_path / "corpus.gz"
+    write_corpus(corpus, 25)
+    splitdir = split_file_into_chunks(str(corpus), tmpdir=str(tmp_path / "cache"), split_size=10)
+    # recorded on the first verification, then checked
+    assert not (splitdir / split.MD5_FILE).exists()
+    assert verify_split(str(corpus), splitdir)
+    assert (splitdir / split.MD5_FILE).read_text().strip() == compute_md5(str(corpus))
+    assert verify_split(str(corpus), splitdir)
+
+    other = tmp_path / "other.gz"
+    write_corpus(other, 25, offset=1)
+    assert not verify_split(str(other), splitdir)
+
+
+def test_stream_while_splitting(tmp_path):
+    write_corpus(tmp_path / "corpus.gz", 250)
+    splitdir = split_file_into_chunks(
+        str(tmp_path / "corpus.gz"), tmpdir=str(tmp_path / "split"), split_size=10, stream=True
+    )
+    # back as soon as there is a chunk to read
+    assert manifest.read_manifest(str(splitdir))
+    split.stop_background_splits()
+    if not (splitdir / ".done").exists():
+        # stopped before the end: split again next time
+        assert not manifest.is_complete(str(splitdir)) and manifest.is_abandoned(str(splitdir))
+        splitdir = split_file_into_chunks(
+            str(tmp_path / "corpus.gz"), tmpdir=str(tmp_path / "split"), split_size=10
+        )
+
+    assert manifest.is_complete(str(splitdir))
+    shards = manifest.read_manifest(str(splitdir))
+    assert len(shards) == 25 and sum(shard.lines for shard in shards) == 250
+
+
+def test_concurrent_splits(tmp_path, monkeypatch):
+    corpus = tmp_path / "corpus.gz"
+    write_corpus(corpus, 25)
+    log = tmp_path / "splits.log"
+    split_native = split.split_native
+
+    def logged_split(filepath, destdir, *args, **kwargs):
+        with open(log, "a") as outfh:
+            print(destdir, file=outfh)
+        time.sleep(0.5)
+        return split_native(filepath, destdir, *args, **kwargs)
+
+    # an interrupted split, left behind
+    (tmp_path / "cache" / f"fp-{compute_fingerprint(str(corpus))}{split.TMP_SUFFIX}1").mkdir(parents=True)
+
+    # processes forked from here split with logged_split
+    monkeypatch.setattr(split, "split_native", logged_split)
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context("fork")) as pool:
+        splitdirs = list(
+            pool.map(
+                functools.partial(
+                    split_file_into_chunks, tmpdir=str(tmp_path / "cache"), split_size=10, native=True
+                ),
+                [str(corpus)] * 4,
+            )
+        )
+    # split once, into a temporary directory, and used by all
+    assert len(set(splitdirs)) == 1
+    assert len(log.read_text().splitlines()) == 1
+    assert split.TMP_SUFFIX in log.read_text()
+    assert sorted(path.name for path in splitdirs[0].parent.iterdir()) == [
+        splitdirs[0].name,
+        splitdirs[0].name + split.LOCK_SUFFIX,
+    ]
+    assert sum(shard.lines for shard in manifest.read_manifest(str(splitdirs[0]))) == 25
+
+
+def test_split_in_use(tmp_path):
+    corpus = tmp_path / "corpus.gz"
+    write_corpus(corpus, 25)
+    cache_dir = str(tmp_path / "cache")
+    # held by this process until released
+    splitdir = split_file_into_chunks(str(corpus), tmpdir=cache_dir, split_size=10)
+
+    # split again elsewhere, keeping the directory in use
+    other = split_file_into_chunks(str(corpus), tmpdir=cache_dir, split_size=10, overwrite=True)
+    assert other.name.startswith(splitdir.name + split.TMP_SUFFIX)
+    assert manifest.is_complete(str(splitdir)) and manifest.is_complete(str(other))
+
+    # and in place once it is no longer used, removing the other
+    cache.release()
+    assert split_file_into_chunks(str(corpus), tmpdir=cache_dir, split_size=10, overwrite=True) == splitdir
+    assert not other.exists()
+    cache.release()
+
+
+def test_split_parallel_pending_bytes(tmp_path, monkeypatch):
+    # at most one chunk in flight at a time, however many processes
+    write_corpus(tmp_path / "corpus.gz", 100)
+    futures = []
+    submit = split.ProcessPoolExecutor.submit
+
+    def checked_submit(self, *args):
+        # every chunk submitted before has been written
+        assert all(future.done() for future in futures)
+        futures.append(submit(self, *args))
+        return futures[-1]
+
+    monkeypatch.setattr(split.ProcessPoolExecutor, "submit", checked_submit)
+    (tmp_path / "split").mkdir()
+    shards = split.split_parallel(
+        str(tmp_path / "corpus.gz"), tmp_path / "split", 10, processes=4, max_pending_bytes=1
+    )
+    assert len(shards) == 10 and sum(shard.lines for shard in shards) == 100
+    assert split.default_processes() <= split.MAX_DEFAULT_PROCESSES
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+from multiprocessing import Process
+
+from sotastream.transport import (
+    BATCH,
+    TRANSPORTS,
+    AdaptiveBatchSize,
+    create_transport,
+    decode_frame,
+    encode_batch,
+)
+
+from test_augmentors import TEST_CORPUS
+
+
+def produce(transport, batches):
+    for batch in batches:
+        transport.send(encode_batch(batch))
+    transport.close_writer()
+
+
+def consume(transport):
+    received = []
+    while True:
+        try:
+            _, num_lines, _, _, payload = decode_frame(transport.recv())
+        except EOFError:
+            return received
+        received.append(str(payload, "utf-8").split("\n")[:-1])
+        assert len(received[-1]) == num_lines
+        del payload
+        transport.release()
+
+
+@pytest.mark.parametrize("name", sorted(TRANSPORTS.keys()))
+def test_roundtrip(name):
+    # A tiny ring forces wrap-arounds, waiting for free space, and inline (oversized) blocks
+    transport = create_transport(name, size=1024)
+    batches = [TEST_CORPUS[i : i + 3] for i in range(len(TEST_CORPUS))] * 5 + [TEST_CORPUS * 10, [""]]
+
+    worker = Process(target=produce, args=(transport, batches))
+    worker.start()
+    transport.writer.close()  # only the worker writes
+    try:
+        assert consume(transport) == batches
+    finally:
+        worker.join()
+        transport.close()
+
+
+def test_encode_batch():
+    lines = ["a\tb", "a\tb\tc", "", "a\tb"]
+    frame = decode_frame(encode_batch(lines))
+    assert frame.kind == BATCH
+    assert frame.num_lines == 4
+    assert frame.num_fields == {1: 1, 2: 2, 3: 1}
+    assert frame.num_tokens == 7
+    assert bytes(frame.payload) == b"a\tb\na\tb\tc\n\na\tb\n"
+
+
+def test_adaptive_batch_size():
+    batch_size = AdaptiveBatchSize(target_bytes=1000, max_latency=1.0, max_size=10_000)
+    assert batch_size.size == AdaptiveBatchSize.INITIAL_SIZE
+
+    # grows by at most a factor of two per batch, up to the byte target (10 bytes per line)
+    sizes = []
+    for _ in range(10):
+        batch_size.update(batch_size.size, batch_size.size * 10, 0.001)
+        sizes.append(batch_size.size)
+    assert sizes[:3] == [32, 64, 100] and sizes[-1] == 100
+
+    # shrinks right away when producing lines gets slow
+    batch_size.update(100, 1000, 10.0)
+    assert batch_size.size == 10